@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Micro-benchmark for the local file hashing path (throughput in GB/s)
+# Usage: devel/benchmark_hashing.py [path] [--size-mb N] [--algorithm sha1]
+# If no path is given, a file of random data is created in a temporary directory.
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kachery._hashing import compute_file_hash
+
+def _old_compute_file_hash(path: str, algorithm: str) -> str:
+    # the implementation prior to the shared hashing engine (64 KiB file.read blocks)
+    BLOCKSIZE = 65536
+    hashsum = getattr(hashlib, algorithm)()
+    with open(path, 'rb') as file:
+        buf = file.read(BLOCKSIZE)
+        while len(buf) > 0:
+            hashsum.update(buf)
+            buf = file.read(BLOCKSIZE)
+    return hashsum.hexdigest()
+
+def _time_it(label, size, fn, num_repeats):
+    elapsed = []
+    for _ in range(num_repeats):
+        timer = time.time()
+        hash0 = fn()
+        elapsed.append(time.time() - timer)
+    best = min(elapsed)
+    print('{:<40} {:8.3f} GB/s  ({})'.format(label, size / best / 1e9, hash0))
+    return hash0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark file hashing throughput')
+    parser.add_argument('path', nargs='?', default=None)
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--algorithm', default='sha1')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.path
+        if path is None:
+            path = os.path.join(tmpdir, 'data.bin')
+            with open(path, 'wb') as f:
+                for _ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+        size = os.path.getsize(path)
+        print('Hashing {} ({} bytes, page cache warm after the first run)'.format(path, size))
+        _old_compute_file_hash(path, args.algorithm)
+        h_old = _time_it('file.read 64 KiB (before)', size, lambda: _old_compute_file_hash(path, args.algorithm), args.repeats)
+        for block_size in [256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024]:
+            h_new = _time_it('readinto {} KiB (after)'.format(block_size // 1024), size, lambda: compute_file_hash(path, algorithm=args.algorithm, block_size=block_size), args.repeats)
+            assert h_new == h_old
+
+if __name__ == '__main__':
+    main()
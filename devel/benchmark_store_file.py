@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Benchmark for hashing a large file (sha1 and manifest) while it is stored in the cache
+# Usage: devel/benchmark_store_file.py [path] [--size-mb N] [--num-workers N]
+# If no path is given, a file of random data is created in a temporary directory.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from kachery.localhashcache import LocalHashCache
+from kachery._hashing import compute_file_sha1_and_manifest, default_num_hash_workers
+
+def _hash_then_copy(hc, path, num_workers):
+    # the parallel hashing engine followed by a copy into the cache (two reads of the file)
+    sha1, manifest = compute_file_sha1_and_manifest(path, num_workers=num_workers)
+    hc.copyFileToCache(path, _known_hash=sha1)
+    return sha1, manifest
+
+def _ingest(hc, path, num_workers):
+    # a single streamed copy, with the manifest chunks (from the streamed buffers) hashed on num_workers threads
+    _, hashes, manifest = hc.ingestFile(path, compute_manifest=True, num_hash_workers=num_workers)
+    return hashes['sha1'], manifest
+
+def _time_it(label, size, fn, num_repeats):
+    elapsed = []
+    for _ in range(num_repeats):
+        timer = time.time()
+        ret = fn()
+        elapsed.append(time.time() - timer)
+    best = min(elapsed)
+    print('{:<50} {:8.3f} GB/s'.format(label, size / best / 1e9))
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hashing a large file while storing it in the cache')
+    parser.add_argument('path', nargs='?', default=None)
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--num-workers', type=int, default=default_num_hash_workers())
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.path
+        if path is None:
+            path = os.path.join(tmpdir, 'data.bin')
+            with open(path, 'wb') as f:
+                for _ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+        size = os.path.getsize(path)
+        print('Storing {} ({} bytes, page cache warm after the first run)'.format(path, size))
+        hc = LocalHashCache(algorithm='sha1')
+        hc.setDirectory(os.path.join(tmpdir, 'cache'))
+
+        def run(fn, num_workers):
+            sha1, manifest = fn(hc, path, num_workers)
+            # so that the next run stores it again
+            os.unlink(hc._get_path(sha1))
+            return sha1, manifest
+
+        expected = run(_hash_then_copy, args.num_workers)
+        for label, fn, num_workers in [
+            ('parallel hash, then copy ({} workers)'.format(args.num_workers), _hash_then_copy, args.num_workers),
+            ('ingest, single-threaded manifest', _ingest, 1),
+            ('ingest, manifest on {} workers'.format(args.num_workers), _ingest, args.num_workers)
+        ]:
+            assert _time_it(label, size, lambda: run(fn, num_workers), args.repeats) == expected
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 from .core import set_config, get_config, config
-from .core import load_file, load_text, load_object, load_npy, load_bytes, get_file_info, open_file, load_dir, get_object_hash, get_file_hash
-from .core import store_file, store_text, store_object, store_npy, store_dir
+from .core import load_file, load_files, load_text, load_object, load_npy, load_bytes, load_buffer, get_file_info, get_file_infos, open_file, load_dir, get_object_hash, get_file_hash
+from .core import store_file, store_text, store_object, store_npy, store_dir, store_bytes, open_store_writer
 from .core import read_dir
-from .core import reset
+from .core import reset, get_memo_cache_stats
 
 from .parser_helpers import _add_download_args, _add_upload_args, _set_download_config_from_parsed_args, _set_upload_config_from_parsed_args
 from .core import _config_dir
\ No newline at end of file
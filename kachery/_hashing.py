@@ -0,0 +1,318 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Tuple, Union, List, Dict
+
+# can be overridden with the KACHERY_HASH_BLOCK_SIZE environment variable
+DEFAULT_HASH_BLOCK_SIZE = 256 * 1024
+
+def hash_block_size() -> int:
+    txt = os.environ.get('KACHERY_HASH_BLOCK_SIZE', '')
+    if txt:
+        return int(txt)
+    return DEFAULT_HASH_BLOCK_SIZE
+
+def compute_file_hash(path: str, *, algorithm: str, block_size: Optional[int]=None) -> Optional[str]:
+    hashes = compute_file_hashes(path, algorithms=[algorithm], block_size=block_size)
+    if hashes is None:
+        return None
+    return hashes[algorithm]
+
+def compute_file_hashes(path: str, *, algorithms: List[str], block_size: Optional[int]=None) -> Optional[Dict[str, str]]:
+    """Compute several hashes of a file in a single read
+
+    The file is read with readinto() into a single reused buffer (no bytes
+    object is allocated per block) and the kernel is told that the access is
+    sequential so that it can read ahead aggressively. Each block is fed to
+    the digests of all the requested algorithms.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+    algorithms : List[str]
+        Any of 'sha1' and 'md5'
+    block_size : Optional[int], optional
+        Size of the read buffer, by default hash_block_size()
+
+    Returns
+    -------
+    Optional[Dict[str, str]]
+        The hex digest for each algorithm, or None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    if block_size is None:
+        block_size = hash_block_size()
+    hashsums = [(algorithm, getattr(hashlib, algorithm)()) for algorithm in algorithms]
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as file:
+        advise_sequential(file.fileno())
+        while True:
+            num_read = file.readinto(buf)
+            if not num_read:
+                break
+            for _, hashsum in hashsums:
+                hashsum.update(view[:num_read])
+    return dict([(algorithm, hashsum.hexdigest()) for algorithm, hashsum in hashsums])
+
+def advise_sequential(fd: int) -> None:
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def default_num_hash_workers() -> int:
+    return max(1, min(4, os.cpu_count() or 1))
+
+_MANIFEST_LARGE_FILE_SIZE = 1000 * 1000 * 1000
+
+def manifest_chunk_size(size: int) -> int:
+    # Determine the chunk size based on the file size
+    if size < _MANIFEST_LARGE_FILE_SIZE:
+        return 10000000
+    else:
+        return 20000000
+
+def compute_file_sha1_and_manifest(path: str, *, num_workers: Optional[int]=None, chunk_size: Optional[int]=None) -> Tuple[Union[str, None], Union[dict, None]]:
+    """Compute the sha1 of a file together with its per-chunk sha1 manifest
+
+    The chunks are read with positional reads and their digests computed by a
+    pool of num_workers threads (hashlib releases the GIL), while the calling
+    thread feeds the chunks, in order, into the whole-file digest. At most
+    2 * num_workers chunks are held in memory at any time.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+    num_workers : Optional[int], optional
+        Number of threads reading and hashing chunks, by default default_num_hash_workers()
+    chunk_size : Optional[int], optional
+        Size of the manifest chunks, by default manifest_chunk_size(size)
+
+    Returns
+    -------
+    Tuple[Union[str, None], Union[dict, None]]
+        The sha1 and the manifest, or (None, None) if the file does not exist
+    """
+    algorithm = 'sha1'
+    manifest = {
+        'size': 0,
+        'sha1': '',
+        'chunks': []
+    }
+    if not os.path.exists(path):
+        return None, None
+    size0 = os.path.getsize(path)
+    if (size0 > 1024 * 1024 * 100):
+        print('Computing {} and manifest of {}'.format(algorithm, path))
+    if chunk_size is None:
+        chunk_size = manifest_chunk_size(size0)
+    if num_workers is None:
+        num_workers = default_num_hash_workers()
+    if not hasattr(os, 'pread'):
+        # positional reads are not available (e.g., windows)
+        num_workers = 1
+
+    chunk_ranges = [(pos, min(pos + chunk_size, size0)) for pos in range(0, size0, chunk_size)]
+    hashsum = getattr(hashlib, algorithm)()
+    with open(path, 'rb') as file:
+        advise_sequential(file.fileno())
+        if num_workers <= 1:
+            for start, end in chunk_ranges:
+                buf = file.read(end - start)
+                hashsum.update(buf)
+                manifest['chunks'].append(_manifest_chunk(start, end, _hexdigest_of_buffer(buf, algorithm=algorithm)))
+        else:
+            fd = file.fileno()
+            def read_and_hash_chunk(start: int, end: int) -> Tuple[bytes, str]:
+                buf = _pread_all(fd, end - start, start)
+                return buf, _hexdigest_of_buffer(buf, algorithm=algorithm)
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                max_in_flight = 2 * num_workers
+                futures: list = []
+                next_index = 0
+                for ii, (start, end) in enumerate(chunk_ranges):
+                    while next_index < len(chunk_ranges) and next_index < ii + max_in_flight:
+                        futures.append(executor.submit(read_and_hash_chunk, *chunk_ranges[next_index]))
+                        next_index = next_index + 1
+                    buf, chunk_digest = futures[ii].result()
+                    futures[ii] = None
+                    hashsum.update(buf)
+                    manifest['chunks'].append(_manifest_chunk(start, end, chunk_digest))
+
+    sha1 = hashsum.hexdigest()
+    manifest['sha1'] = sha1
+    manifest['size'] = size0
+    return sha1, manifest
+
+class StreamHasher:
+    def __init__(self, *, algorithms: List[str], manifest: bool=False, size: Optional[int]=None, num_workers: int=1):
+        """Incrementally compute digests (and optionally the sha1 manifest) of a stream of bytes
+
+        Produces exactly the same digests and manifest as compute_file_hashes and
+        compute_file_sha1_and_manifest would for the same content. When the
+        total size is not known in advance, the manifest chunk size (which
+        depends on the total size) cannot be chosen up front, so chunk digests
+        are tracked for both candidate chunk sizes until the stream grows past
+        the threshold. With num_workers > 1, the bytes of each manifest chunk
+        are collected and the chunk is hashed on a pool of that many threads
+        (hashlib releases the GIL), while the calling thread computes the
+        whole-stream digests. At most 2 * num_workers chunks are held in
+        memory at any time.
+
+        Parameters
+        ----------
+        algorithms : List[str]
+            Any of 'sha1' and 'md5'
+        manifest : bool, optional
+            Whether to compute the sha1 manifest, by default False
+        size : Optional[int], optional
+            The total size if known in advance, by default None
+        num_workers : int, optional
+            Number of threads hashing the manifest chunks, by default 1 (the calling thread)
+        """
+        self._hashsums = [(algorithm, getattr(hashlib, algorithm)()) for algorithm in algorithms]
+        self._size = size
+        self._num_bytes = 0
+        self._chunk_trackers: List[_ChunkTracker] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if manifest:
+            if num_workers > 1:
+                self._executor = ThreadPoolExecutor(max_workers=num_workers)
+            max_in_flight = 2 * num_workers
+            if size is not None:
+                self._chunk_trackers.append(_ChunkTracker(manifest_chunk_size(size), executor=self._executor, max_in_flight=max_in_flight))
+            else:
+                self._chunk_trackers.append(_ChunkTracker(manifest_chunk_size(0), executor=self._executor, max_in_flight=max_in_flight))
+                self._chunk_trackers.append(_ChunkTracker(manifest_chunk_size(_MANIFEST_LARGE_FILE_SIZE), executor=self._executor, max_in_flight=max_in_flight))
+
+    def update(self, buf) -> None:
+        for _, hashsum in self._hashsums:
+            hashsum.update(buf)
+        self._num_bytes = self._num_bytes + len(buf)
+        if self._chunk_trackers:
+            if (self._size is None) and (len(self._chunk_trackers) == 2) and (self._num_bytes >= _MANIFEST_LARGE_FILE_SIZE):
+                # the small chunk size can no longer apply
+                self._chunk_trackers = self._chunk_trackers[1:]
+            for ct in self._chunk_trackers:
+                ct.update(buf)
+
+    def numBytes(self) -> int:
+        return self._num_bytes
+
+    def hexdigests(self) -> Dict[str, str]:
+        return dict([(algorithm, hashsum.hexdigest()) for algorithm, hashsum in self._hashsums])
+
+    def manifest(self) -> Optional[dict]:
+        if not self._chunk_trackers:
+            return None
+        size0 = self._num_bytes
+        chunk_size = manifest_chunk_size(size0)
+        ct = [c for c in self._chunk_trackers if c.chunkSize() == chunk_size][0]
+        sha1 = [hashsum for algorithm, hashsum in self._hashsums if algorithm == 'sha1'][0].hexdigest()
+        return {
+            'size': size0,
+            'sha1': sha1,
+            'chunks': ct.chunks()
+        }
+
+    def close(self) -> None:
+        # shuts down the pool of threads hashing the manifest chunks, if any
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+class _ChunkTracker:
+    def __init__(self, chunk_size: int, *, executor: Optional[ThreadPoolExecutor]=None, max_in_flight: int=0):
+        # Without an executor, each chunk is hashed as its bytes arrive. With one, the bytes of a
+        # chunk are collected and the completed chunk is hashed by the executor.
+        self._chunk_size = chunk_size
+        self._executor = executor
+        self._max_in_flight = max_in_flight
+        # each is a manifest chunk or, while it is being hashed, (start, end, future)
+        self._chunks: List[Union[dict, Tuple[int, int, Future]]] = []
+        self._num_in_flight = 0
+        self._current_start = 0
+        self._current_num_bytes = 0
+        self._current_hashsum = hashlib.sha1()
+        self._current_buf = bytearray()
+
+    def chunkSize(self) -> int:
+        return self._chunk_size
+
+    def update(self, buf) -> None:
+        view = memoryview(buf)
+        while len(view) > 0:
+            n = min(len(view), self._chunk_size - self._current_num_bytes)
+            if self._executor is None:
+                self._current_hashsum.update(view[:n])
+            else:
+                self._current_buf += view[:n]
+            self._current_num_bytes = self._current_num_bytes + n
+            view = view[n:]
+            if self._current_num_bytes == self._chunk_size:
+                self._finish_chunk()
+
+    def chunks(self) -> List[dict]:
+        self._wait_for_chunks(0)
+        ret: List[dict] = [c for c in self._chunks if isinstance(c, dict)]
+        if self._current_num_bytes > 0:
+            if self._executor is None:
+                sha1 = self._current_hashsum.hexdigest()
+            else:
+                sha1 = _hexdigest_of_buffer(self._current_buf, algorithm='sha1')
+            ret.append(_manifest_chunk(self._current_start, self._current_start + self._current_num_bytes, sha1))
+        return ret
+
+    def _finish_chunk(self) -> None:
+        end = self._current_start + self._current_num_bytes
+        if self._executor is None:
+            self._chunks.append(_manifest_chunk(self._current_start, end, self._current_hashsum.hexdigest()))
+            self._current_hashsum = hashlib.sha1()
+        else:
+            self._wait_for_chunks(self._max_in_flight - 1)
+            self._chunks.append((self._current_start, end, self._executor.submit(_hexdigest_of_buffer, self._current_buf, algorithm='sha1')))
+            self._num_in_flight = self._num_in_flight + 1
+            self._current_buf = bytearray()
+        self._current_start = end
+        self._current_num_bytes = 0
+
+    def _wait_for_chunks(self, max_in_flight: int) -> None:
+        # the chunks complete in order of submission, oldest first
+        ii = len(self._chunks) - self._num_in_flight
+        while self._num_in_flight > max(0, max_in_flight):
+            start, end, future = self._chunks[ii]
+            self._chunks[ii] = _manifest_chunk(start, end, future.result())
+            self._num_in_flight = self._num_in_flight - 1
+            ii = ii + 1
+
+def _manifest_chunk(start: int, end: int, sha1: str) -> dict:
+    return {
+        'start': start,
+        'end': end,
+        'sha1': sha1
+    }
+
+def _hexdigest_of_buffer(buf: bytes, *, algorithm: str) -> str:
+    hh = getattr(hashlib, algorithm)()
+    hh.update(buf)
+    return hh.hexdigest()
+
+def _pread_all(fd: int, size: int, offset: int) -> bytes:
+    buf = os.pread(fd, size, offset)
+    if len(buf) == size:
+        return buf
+    # short read (e.g., network file systems)
+    parts = [buf]
+    num_read = len(buf)
+    while num_read < size:
+        buf = os.pread(fd, size - num_read, offset + num_read)
+        if not buf:
+            raise Exception('Unexpected end of file while reading chunk at offset {}'.format(offset))
+        parts.append(buf)
+        num_read = num_read + len(buf)
+    return b''.join(parts)
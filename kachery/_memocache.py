@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Tuple
+
+class MemoCache:
+    def __init__(self):
+        """In-process LRU map from a key (e.g., kind + algorithm + hash) to a value, bounded by the total size of the values
+
+        Since the content behind a hash never changes, entries never need to be
+        invalidated; they are only evicted (least recently used first) to
+        respect the size bound, which is given on each insertion so that it can
+        be changed at any time with set_config.
+        """
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, int]]' = OrderedDict()
+        self._num_bytes = 0
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_evictions = 0
+
+    def get(self, key: Hashable) -> Any:
+        # returns None if not found
+        with self._lock:
+            x = self._entries.get(key, None)
+            if x is None:
+                self._num_misses = self._num_misses + 1
+                return None
+            self._entries.move_to_end(key)
+            self._num_hits = self._num_hits + 1
+            return x[0]
+
+    def set(self, key: Hashable, value: Any, *, size: int, max_bytes: int) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size <= max_bytes:
+                self._entries[key] = (value, size)
+                self._num_bytes = self._num_bytes + size
+            while self._num_bytes > max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._num_evictions = self._num_evictions + 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+            self._num_hits = 0
+            self._num_misses = 0
+            self._num_evictions = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                num_hits=self._num_hits,
+                num_misses=self._num_misses,
+                num_evictions=self._num_evictions,
+                num_entries=len(self._entries),
+                num_bytes=self._num_bytes
+            )
+
+    def _remove(self, key: Hashable) -> None:
+        _, size = self._entries.pop(key)
+        self._num_bytes = self._num_bytes - size
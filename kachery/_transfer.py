@@ -0,0 +1,121 @@
+import os
+import sys
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Dict, Set, Tuple, IO, Iterator
+_win32 = (sys.platform == 'win32')
+if not _win32:
+    import fcntl
+
+TRANSFER_STRATEGIES = ['link', 'reflink', 'copy_file_range', 'copy', 'auto']
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+# (device of source, device of destination directory) -> strategies that failed
+_unsupported: Dict[Tuple[int, int], Set[str]] = dict()
+_unsupported_lock = threading.Lock()
+
+def check_transfer_strategy(strategy: str) -> None:
+    if strategy not in TRANSFER_STRATEGIES:
+        raise Exception('Unexpected transfer strategy: {} (must be one of {})'.format(strategy, ', '.join(TRANSFER_STRATEGIES)))
+
+def transfer_file(src: str, dst: str, *, strategy: str) -> str:
+    """Make dst a file with the same content as src
+
+    'link' makes a hard link, 'reflink' a copy-on-write clone (FICLONE, for
+    example on XFS and btrfs), 'copy_file_range' an in-kernel copy, and 'copy'
+    a regular copy. 'auto' tries reflink, then copy_file_range, then copy,
+    remembering which of them are not supported between the two file systems
+    involved. It never makes a hard link, since a later modification of dst
+    would then modify src as well.
+
+    Returns
+    -------
+    str
+        The strategy that was used
+    """
+    check_transfer_strategy(strategy)
+    if strategy != 'auto':
+        _transfer_file(src, dst, strategy=strategy)
+        return strategy
+    for strategy0 in ['reflink', 'copy_file_range']:
+        if try_transfer_file(src, dst, strategy=strategy0):
+            return strategy0
+    _transfer_file(src, dst, strategy='copy')
+    return 'copy'
+
+def try_transfer_file(src: str, dst: str, *, strategy: str) -> bool:
+    # like transfer_file but returns False (and remembers) if the strategy does not work here
+    if not is_transfer_strategy_supported(src, dst, strategy=strategy):
+        return False
+    try:
+        _transfer_file(src, dst, strategy=strategy)
+        return True
+    except OSError:
+        with _unsupported_lock:
+            _unsupported.setdefault(_device_key(src, dst), set()).add(strategy)
+        _remove_if_exists(dst)
+        return False
+
+def is_transfer_strategy_supported(src: str, dst: str, *, strategy: str) -> bool:
+    # False if the strategy is known not to work (on this platform or between these file systems)
+    if strategy == 'reflink' and ((not sys.platform.startswith('linux')) or _win32):
+        return False
+    if strategy == 'copy_file_range' and (not hasattr(os, 'copy_file_range')):
+        return False
+    with _unsupported_lock:
+        return strategy not in _unsupported.get(_device_key(src, dst), set())
+
+def _transfer_file(src: str, dst: str, *, strategy: str) -> None:
+    if strategy == 'link':
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        os.link(src, dst)
+    elif strategy == 'reflink':
+        if _win32:
+            raise OSError('reflink is not supported on this platform')
+        with open(src, 'rb') as fsrc:
+            with _open_for_transfer(dst) as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    elif strategy == 'copy_file_range':
+        size0 = os.path.getsize(src)
+        with open(src, 'rb') as fsrc:
+            with _open_for_transfer(dst) as fdst:
+                num_copied = 0
+                while num_copied < size0:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size0 - num_copied)
+                    if n == 0:
+                        # some file systems silently do not support it
+                        raise OSError('copy_file_range made no progress')
+                    num_copied = num_copied + n
+    elif strategy == 'copy':
+        shutil.copyfile(src, dst)
+    else:
+        raise Exception('Unexpected transfer strategy: {}'.format(strategy))
+
+@contextmanager
+def _open_for_transfer(dst: str) -> Iterator[IO]:
+    # dst is removed if the transfer fails, rather than left truncated
+    fdst = open(dst, 'wb')
+    try:
+        with fdst:
+            yield fdst
+    except BaseException:
+        _remove_if_exists(dst)
+        raise
+
+def _device_key(src: str, dst: str) -> Tuple[int, int]:
+    try:
+        dev_src = os.stat(src).st_dev
+        dev_dst = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    except OSError:
+        return (-1, -1)
+    return (dev_src, dev_dst)
+
+def _remove_if_exists(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -0,0 +1,87 @@
+import os
+import threading
+from typing import Optional, Union, Tuple
+
+# All the HTTP traffic of the client goes through here. The connection pools
+# (one per host, kept alive between requests) belong to a single adapter that
+# is shared by all threads, while each thread has its own Session (sessions
+# are not guaranteed to be thread-safe, the connection pools are).
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 120.0
+
+_settings = dict(
+    pool_size=DEFAULT_POOL_SIZE,
+    connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+    read_timeout=DEFAULT_READ_TIMEOUT
+)
+_state: dict = dict(
+    adapter=None,
+    pid=None,
+    generation=0
+)
+_state_lock = threading.Lock()
+_thread_local = threading.local()
+
+def configure_transport(*, pool_size: Optional[int]=None, connect_timeout: Optional[float]=None, read_timeout: Optional[float]=None) -> None:
+    # pool_size is the number of connections kept alive per host (more concurrent
+    # requests open connections that are not kept); the timeouts are in seconds
+    with _state_lock:
+        if (pool_size is not None) and (pool_size != _settings['pool_size']):
+            _settings['pool_size'] = pool_size
+            # the sessions pick up a new adapter the next time they are used
+            _reset()
+        if connect_timeout is not None:
+            _settings['connect_timeout'] = connect_timeout
+        if read_timeout is not None:
+            _settings['read_timeout'] = read_timeout
+
+def get_session():
+    """Return the requests Session of the current thread
+
+    All sessions share one connection pool per host.
+    """
+    with _state_lock:
+        if _state['pid'] != os.getpid():
+            # connections must not be shared with a parent process
+            _reset()
+        if _state['adapter'] is None:
+            _state['adapter'] = _create_adapter(_settings['pool_size'])
+        adapter = _state['adapter']
+        generation = _state['generation']
+    session = getattr(_thread_local, 'session', None)
+    if (session is None) or (getattr(_thread_local, 'generation', None) != generation):
+        import requests
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _thread_local.session = session
+        _thread_local.generation = generation
+    return session
+
+def timeout() -> Tuple[float, float]:
+    return (_settings['connect_timeout'], _settings['read_timeout'])
+
+def http_get(url: str, *, headers: Optional[dict]=None, stream: bool=False):
+    return get_session().get(url, headers=headers, stream=stream, timeout=timeout())
+
+def http_head(url: str):
+    return get_session().head(url, timeout=timeout())
+
+def http_post(url: str, *, data: Union[bytes, object, None]=None, json: Optional[dict]=None):
+    return get_session().post(url, data=data, json=json, timeout=timeout())
+
+def _create_adapter(pool_size: int):
+    try:
+        from requests.adapters import HTTPAdapter
+    except:
+        raise Exception('Error importing requests')
+    # retries are handled by the callers
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+
+def _reset() -> None:
+    # must be called with _state_lock held
+    _state['adapter'] = None
+    _state['pid'] = os.getpid()
+    _state['generation'] = _state['generation'] + 1
@@ -0,0 +1,365 @@
+import os
+import time
+import asyncio
+import functools
+import weakref
+from typing import Union, Optional, Tuple, List
+import simplejson
+from . import core
+from .core import _load_config, _is_hash_url, _parse_kachery_url, _hash_of_string, _hash_caches
+from .core import _form_check_url, _form_download_url, _form_upload_url, _format_file_size
+from ._hashing import StreamHasher, hash_block_size
+from .localhashcache import _random_string
+
+# Async versions of load_file, load_bytes, get_file_info, store_file and read_dir,
+# for use from asyncio code, e.g., asyncio.gather over many uris.
+#
+# The HTTP requests go through one aiohttp session per event loop, so that the
+# number of concurrent connections is bounded (see the aio_max_connections
+# config key), and the file I/O and hashing is run in the default executor of
+# the loop. The local cache is the same as for the synchronous functions.
+# Operations that do not involve the network are delegated to the synchronous
+# functions (in the executor), and so are downloads of files larger than
+# download_segment_size (or with a manifest), which are already downloaded as
+# concurrent byte ranges and can be resumed.
+
+_sessions: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+async def load_file(path: str, dest: Optional[str]=None, **kwargs) -> Union[str, None]:
+    config = _load_config(**kwargs)
+    if not _is_hash_url(path):
+        return await _run(core.load_file, path, dest=dest, config=config)
+    hash0, algorithm = await _determine_file_hash_from_url(path, config=config)
+    if hash0 is None:
+        return None
+    assert algorithm is not None
+    if not config['from_remote_only']:
+        path0 = await _run(_hash_caches[algorithm].findFile, hash0)
+        if path0 is not None:
+            if dest:
+                await _run(core.transfer_file, path0, dest, strategy=config['transfer_strategy'])
+                return dest
+            return path0
+    if config['fr']['url'] is None:
+        return None
+    url0, size0 = await _check_remote_file(algorithm=algorithm, hash=hash0, config=config)
+    if size0 == 0:
+        # the server has trouble with the empty file, which load_file handles separately
+        return await _run(core.load_file, '{}://{}'.format(algorithm, hash0), dest=dest, config=config)
+    if url0 is None:
+        return None
+    assert size0 is not None
+    if (size0 > config['download_segment_size']) or ('manifest=' in path):
+        # downloaded as concurrent (and resumable) byte ranges
+        return await _run(core.load_file, path, dest=dest, config=config)
+    return await _download_file(url0, algorithm=algorithm, hash=hash0, size=size0, dest=dest)
+
+async def load_bytes(path: str, start: Union[int, None]=None, end: Union[int, None]=None, **kwargs) -> Union[bytes, None]:
+    config = _load_config(**kwargs)
+    if (not _is_hash_url(path)) or (start is None and end is None):
+        path0 = await load_file(path, config=config)
+        if path0 is None:
+            return None
+        return await _run(core._load_bytes_from_local_file, path0, start=start, end=end, config=config)
+    hash0, algorithm = await _determine_file_hash_from_url(path, config=config)
+    if hash0 is None:
+        return None
+    assert algorithm is not None
+    hc = _hash_caches[algorithm]
+    if not config['from_remote_only']:
+        path0 = await _run(hc.findFile, hash0)
+        if path0 is not None:
+            return await _run(core._load_bytes_from_local_file, path0, start=start, end=end, config=config)
+    if config['fr']['url'] is None:
+        return None
+    url0, size0 = await _check_remote_file(algorithm=algorithm, hash=hash0, config=config)
+    if size0 == 0:
+        return bytes()
+    if url0 is None:
+        return None
+    assert size0 is not None
+    if start is None:
+        start = 0
+    if end is None:
+        end = size0
+    if start < 0 or start > size0 or end < start or end > size0:
+        raise Exception('Invalid start/end range for file of size {}: {} - {}'.format(size0, start, end))
+    if start == end:
+        return bytes()
+    # ranges are kept in the partially downloaded file for the hash, like for open_file
+    data = await _run(hc.readFileRange, hash0, size=size0, start=start, end=end)
+    if data is not None:
+        return data
+    data = await _download_range(url0, start=start, end=end)
+    await _run(hc.writeFileRange, hash0, size=size0, start=start, data=data)
+    return data
+
+async def get_file_info(path: str, hash_only: bool=False, **kwargs) -> Union[dict, None]:
+    config = _load_config(**kwargs)
+    if not _is_hash_url(path):
+        return await _run(core.get_file_info, path, hash_only=hash_only, config=config)
+    hash0, algorithm = await _determine_file_hash_from_url(path, config=config)
+    if hash0 is None:
+        return None
+    assert algorithm is not None
+    if not config['from_remote_only']:
+        if hash_only:
+            return {algorithm: hash0}
+        path0 = await _run(_hash_caches[algorithm].findFile, hash0)
+        if path0 is not None:
+            ret = dict(path=path0, size=os.path.getsize(path0))
+            ret[algorithm] = hash0
+            return ret
+    if config['fr']['url'] is None:
+        return None
+    url0, size0 = await _check_remote_file(algorithm=algorithm, hash=hash0, config=config)
+    if size0 == 0:
+        # same as get_file_info
+        return dict(url='empty-file', size=0)
+    if url0 is None:
+        return None
+    ret = dict(url=url0, size=size0)
+    ret[algorithm] = hash0
+    return ret
+
+async def store_file(path: str, basename: Union[str, None]=None, **kwargs) -> Union[str, None]:
+    config = _load_config(**kwargs)
+    if basename is None:
+        basename = os.path.basename(path)
+    if _is_hash_url(path):
+        return await _run(core.store_file, path, basename=basename, config=config)
+    algorithm = config['algorithm']
+    hash0, manifest0 = await _run(core._store_file_locally, path, no_manifest=False, config=config)
+    if config['to']['url'] is not None:
+        await _upload_to_remote(path=path, data=None, algorithm=algorithm, hash=hash0, config=config)
+    manifest_sha1 = None
+    if manifest0 is not None:
+        # stored like store_object(manifest) would store it
+        manifest_sha1 = await _store_bytes(simplejson.dumps(manifest0).encode('utf-8'), algorithm='sha1', config=config)
+    return core._format_stored_file_uri(algorithm=algorithm, hash=hash0, basename=basename, manifest_sha1=manifest_sha1)
+
+async def read_dir(path: str, *, recursive: bool=True, **kwargs) -> Union[dict, None]:
+    config = _load_config(**kwargs)
+    if not _is_hash_url(path):
+        return await _run(core.read_dir, path, recursive=recursive, config=config)
+    protocol, algorithm, hash0, additional_path = _parse_kachery_url(path)
+    if not protocol.endswith('dir'):
+        raise Exception('Not a directory: {}'.format(path))
+    if await load_file('{}://{}'.format(algorithm, hash0), config=config) is None:
+        return None
+    # the directory object is now local (subdirectories stored as separate objects are loaded in the executor)
+    return await _run(core.read_dir, path, recursive=recursive, config=config)
+
+async def close() -> None:
+    # closes the HTTP session of the running event loop (a new one is created if needed)
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+async def _run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+def _get_session():
+    try:
+        import aiohttp
+    except ImportError:
+        raise Exception('kachery.aio requires aiohttp: pip install kachery[aio]')
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop, None)
+    if (session is None) or session.closed:
+        config = core._global_config
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config['aio_max_connections']),
+            timeout=aiohttp.ClientTimeout(sock_connect=config['http_connect_timeout'], sock_read=config['http_timeout'])
+        )
+        _sessions[loop] = session
+    return session
+
+async def _determine_file_hash_from_url(url: str, *, config: dict) -> Tuple[Union[str, None], Union[str, None]]:
+    protocol, algorithm, hash0, additional_path = _parse_kachery_url(url)
+    if not protocol.endswith('dir'):
+        return hash0, algorithm
+    if await load_file('{}://{}'.format(algorithm, hash0), config=config) is None:
+        return None, None
+    return await _run(core._determine_file_hash_from_url, url, config=config)
+
+async def _check_remote_file(*, algorithm: str, hash: str, config: dict) -> Tuple[Union[str, None], Union[int, None]]:
+    if hash == _hash_of_string('', algorithm=algorithm):
+        # the server has trouble with the empty file (see _check_remote_file in core)
+        return None, 0
+    # recent checks are recorded in the hash database (see _check_remote_file in core)
+    check = await _run(core._lookup_remote_check, algorithm=algorithm, hash=hash, config=config)
+    if check is None:
+        url_check = _form_check_url(algorithm=algorithm, hash=hash, config=config)
+        check_resp = await _http_get_json(url_check, use_cache_on_found=True)
+        if not check_resp['success']:
+            print('Warning: Problem checking for file: ' + check_resp['error'])
+            return None, None
+        check = (check_resp['found'], check_resp.get('size', None))
+        await _run(core._record_remote_check, algorithm=algorithm, hash=hash, found=check[0], size=check[1], config=config)
+    if not check[0]:
+        return None, None
+    return _form_download_url(algorithm=algorithm, hash=hash, config=config), check[1]
+
+async def _http_get_json(url: str, use_cache_on_found: bool=False, retry_delays: Optional[List[float]]=None) -> dict:
+    # shares the cache of found files with core._http_get_json
+    cache = getattr(core._http_get_json, 'cache')
+    if use_cache_on_found and (url in cache):
+        return cache[url]
+    if retry_delays is None:
+        retry_delays = [0.2, 0.5]
+    session = _get_session()
+    for retry_delay in retry_delays + [None]:
+        try:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                ret = await resp.json(content_type=None)
+            break
+        except Exception:
+            if retry_delay is None:
+                return dict(success=False, error='Unable to open url: ' + url)
+            print('Retrying http request in {} sec: {}'.format(retry_delay, url))
+            await asyncio.sleep(retry_delay)
+    if use_cache_on_found and ret['success'] and ret['found']:
+        cache[url] = ret
+    return ret
+
+async def _download_range(url: str, *, start: int, end: int) -> bytes:
+    session = _get_session()
+    retry_delays = [0.2, 0.5, 2]
+    for retry_delay in retry_delays + [None]:
+        try:
+            # so that the range is of the file itself, not of a compressed representation
+            async with session.get(url, headers={'Range': 'bytes={}-{}'.format(start, end - 1), 'Accept-Encoding': 'identity'}) as resp:
+                resp.raise_for_status()
+                data = await resp.read()
+            if resp.status != 206 and len(data) != end - start:
+                # the server ignored the range
+                data = data[start:end]
+            if len(data) != end - start:
+                raise Exception('Unexpected number of bytes in response: {} <> {}'.format(len(data), end - start))
+            return data
+        except Exception as e:
+            if retry_delay is None:
+                raise Exception('Problem downloading bytes {}-{} of {}: {}'.format(start, end, url, str(e)))
+            await asyncio.sleep(retry_delay)
+    raise Exception('Unexpected')
+
+async def _download_file(url: str, *, algorithm: str, hash: str, size: int, dest: Optional[str]) -> str:
+    # streams the file to a temporary file next to its destination, hashing it on the way
+    hc = _hash_caches[algorithm]
+    if dest is None:
+        target_path = await _run(hc._get_path, hash, create=True)
+    else:
+        target_path = dest
+    path_tmp = target_path + '.downloading.' + _random_string(6)
+    if size > 10000:
+        print('Downloading file --- ({}): {} -> {}'.format(_format_file_size(size), url, target_path))
+    timer = time.time()
+    session = _get_session()
+    retry_delays = [0.2, 0.5, 2]
+    try:
+        for retry_delay in retry_delays + [None]:
+            hasher = StreamHasher(algorithms=[algorithm])
+            try:
+                f = await _run(open, path_tmp, 'wb')
+                try:
+                    async with session.get(url) as resp:
+                        resp.raise_for_status()
+                        async for chunk in resp.content.iter_chunked(hash_block_size()):
+                            await _run(_write_and_hash, f, hasher, chunk)
+                finally:
+                    await _run(f.close)
+                break
+            except Exception as e:
+                if retry_delay is None:
+                    raise Exception('Problem downloading {}: {}'.format(url, str(e)))
+                print('Retrying download in {} sec: {}'.format(retry_delay, url))
+                await asyncio.sleep(retry_delay)
+        if hasher.numBytes() != size:
+            raise Exception('size of downloaded file does not match expected {} {} <> {}'.format(url, hasher.numBytes(), size))
+        hash_b = hasher.hexdigests()[algorithm]
+        if hash_b != hash:
+            raise Exception('hash of downloaded file does not match expected {} {} <> {}'.format(url, hash_b, hash))
+        await _run(_finish_download, hc, path_tmp, target_path, hash=hash, alternate_target_path=(dest is not None))
+    finally:
+        await _run(_remove_if_exists, path_tmp)
+    if size > 10000:
+        print('Downloaded file ({}) in {} sec.'.format(_format_file_size(size), time.time() - timer))
+    return target_path
+
+def _write_and_hash(f, hasher: StreamHasher, chunk: bytes) -> None:
+    f.write(chunk)
+    hasher.update(chunk)
+
+def _remove_if_exists(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+def _finish_download(hc, path_tmp: str, target_path: str, *, hash: str, alternate_target_path: bool) -> None:
+    if alternate_target_path:
+        os.replace(path_tmp, target_path)
+        hc.reportFileHash(target_path, hash=hash)
+    elif not os.path.exists(target_path):
+        os.replace(path_tmp, target_path)
+
+async def _store_bytes(data: bytes, *, algorithm: str, config: dict) -> str:
+    # returns the hash
+    if not config['to_remote_only']:
+        _, hashes0, _ = await _run(_hash_caches[algorithm].storeBytes, data)
+        hash0 = hashes0[algorithm]
+    else:
+        hash0 = _hash_of_bytes(data, algorithm=algorithm)
+    if config['to']['url'] is not None:
+        await _upload_to_remote(path=None, data=data, algorithm=algorithm, hash=hash0, config=config)
+    return hash0
+
+def _hash_of_bytes(data: bytes, *, algorithm: str) -> str:
+    hasher = StreamHasher(algorithms=[algorithm])
+    hasher.update(data)
+    return hasher.hexdigests()[algorithm]
+
+async def _upload_to_remote(*, path: Optional[str], data: Optional[bytes], hash: str, algorithm: str, config: dict) -> None:
+    # exactly one of path and data is given (see _upload_to_remote in core)
+    if data is not None:
+        size0 = len(data)
+        label = '<{} in memory>'.format(_format_file_size(size0))
+    else:
+        assert path is not None
+        size0 = os.path.getsize(path)
+        label = path
+    if size0 == 0:
+        return
+    config2 = dict(config, fr=config['to'])
+    url_ch, size_ch = await _check_remote_file(algorithm=algorithm, hash=hash, config=config2)
+    if url_ch is not None:
+        if size_ch != size0:
+            raise Exception('Unexpected: size of file on remote server does not match local file {} - {} <> {}'.format(label, size_ch, size0))
+        return
+    url0 = _form_upload_url(algorithm=algorithm, hash=hash, config=config)
+    if size0 > 10000:
+        print('Uploading to kachery --- ({}): {} -> {}'.format(_format_file_size(size0), label, url0))
+    timer = time.time()
+    session = _get_session()
+    body = data if data is not None else _read_file_chunks(str(path))
+    async with session.post(url0, data=body, headers={'Content-Length': str(size0)}) as resp:
+        if resp.status != 200:
+            raise Exception('Problem posting file data: {} {}'.format(resp.status, await resp.text()))
+        resp_obj = await resp.json(content_type=None)
+    if size0 > 10000:
+        print('File uploaded ({}) in {} sec'.format(_format_file_size(size0), time.time() - timer))
+    if not resp_obj.get('success', False):
+        raise Exception('Problem posting file data: ' + resp_obj.get('error', ''))
+    await _run(core._record_remote_check, algorithm=algorithm, hash=hash, found=True, size=size0, config=config2)
+
+async def _read_file_chunks(path: str):
+    f = await _run(open, path, 'rb')
+    try:
+        while True:
+            chunk = await _run(f.read, hash_block_size())
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await _run(f.close)
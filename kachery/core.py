@@ -6,16 +6,23 @@ import json
 import hashlib
 import tempfile
 import time
-import urllib.request as request
 import shutil
 import io
 import sys
+import mmap
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 import math
+import threading
 from copy import deepcopy
 from .filelock import FileLock
 from .localhashcache import LocalHashCache
-from ._temporarydirectory import TemporaryDirectory
 from ._update_config_repos import _update_config_repos
+from ._hashing import compute_file_sha1_and_manifest, default_num_hash_workers, StreamHasher, hash_block_size
+from ._transfer import transfer_file, check_transfer_strategy
+from ._memocache import MemoCache
+from ._transport import http_get, http_post, configure_transport
 
 _global_config=dict(
     to=dict(
@@ -32,7 +39,21 @@ _global_config=dict(
     to_remote_only=False,
     algorithm='sha1',
     verbose=False,
-    use_hard_links=False
+    use_hard_links=False,
+    num_hash_workers=None,
+    extra_hash_algorithms=None,
+    transfer_strategy='auto',
+    memo_cache_max_bytes=0,
+    num_download_workers=4,
+    download_segment_size=16 * 1024 * 1024,
+    http_pool_size=16,
+    http_connect_timeout=10.0,
+    http_timeout=120.0,
+    aio_max_connections=64,
+    remote_check_ttl=24 * 3600,
+    remote_check_negative_ttl=60,
+    num_ingest_workers=4,
+    dir_cache_max_bytes=64 * 1024 * 1024
 )
 
 _global_data: dict=dict(
@@ -44,6 +65,12 @@ _hash_caches = dict(
     md5=LocalHashCache(algorithm='md5')
 )
 
+# parsed content of hashed files (see load_text, load_object)
+_memo_cache = MemoCache()
+
+# parsed directory objects with the index of their paths (see _load_dir_object_index)
+_dir_cache = MemoCache()
+
 class config:
     def __init__(self, *,
         to: Union[dict, str, None]=None,
@@ -52,7 +79,21 @@ class config:
         to_remote_only: Union[bool, None]=None,
         verbose: Union[bool, None]=None,
         algorithm: Union[str, None]=None,
-        use_hard_links: Union[bool, None]=None
+        use_hard_links: Union[bool, None]=None,
+        num_hash_workers: Union[int, None]=None,
+        extra_hash_algorithms: Union[List[str], None]=None,
+        transfer_strategy: Union[str, None]=None,
+        memo_cache_max_bytes: Union[int, None]=None,
+        num_download_workers: Union[int, None]=None,
+        download_segment_size: Union[int, None]=None,
+        http_pool_size: Union[int, None]=None,
+        http_connect_timeout: Union[float, None]=None,
+        http_timeout: Union[float, None]=None,
+        aio_max_connections: Union[int, None]=None,
+        remote_check_ttl: Union[float, None]=None,
+        remote_check_negative_ttl: Union[float, None]=None,
+        num_ingest_workers: Union[int, None]=None,
+        dir_cache_max_bytes: Union[int, None]=None
     ):
         self._config = dict(
             to=to, fr=fr,
@@ -60,7 +101,21 @@ class config:
             to_remote_only=to_remote_only,
             verbose=verbose,
             algorithm=algorithm,
-            use_hard_links=use_hard_links
+            use_hard_links=use_hard_links,
+            num_hash_workers=num_hash_workers,
+            extra_hash_algorithms=extra_hash_algorithms,
+            transfer_strategy=transfer_strategy,
+            memo_cache_max_bytes=memo_cache_max_bytes,
+            num_download_workers=num_download_workers,
+            download_segment_size=download_segment_size,
+            http_pool_size=http_pool_size,
+            http_connect_timeout=http_connect_timeout,
+            http_timeout=http_timeout,
+            aio_max_connections=aio_max_connections,
+            remote_check_ttl=remote_check_ttl,
+            remote_check_negative_ttl=remote_check_negative_ttl,
+            num_ingest_workers=num_ingest_workers,
+            dir_cache_max_bytes=dir_cache_max_bytes
         )
         self._old_config = None
     def __enter__(self):
@@ -76,7 +131,21 @@ def set_config(*,
         to_remote_only: Union[bool, None]=None,
         verbose: Union[bool, None]=None,
         algorithm: Union[str, None]=None,
-        use_hard_links: Union[bool, None]=None
+        use_hard_links: Union[bool, None]=None,
+        num_hash_workers: Union[int, None]=None,
+        extra_hash_algorithms: Union[List[str], None]=None,
+        transfer_strategy: Union[str, None]=None,
+        memo_cache_max_bytes: Union[int, None]=None,
+        num_download_workers: Union[int, None]=None,
+        download_segment_size: Union[int, None]=None,
+        http_pool_size: Union[int, None]=None,
+        http_connect_timeout: Union[float, None]=None,
+        http_timeout: Union[float, None]=None,
+        aio_max_connections: Union[int, None]=None,
+        remote_check_ttl: Union[float, None]=None,
+        remote_check_negative_ttl: Union[float, None]=None,
+        num_ingest_workers: Union[int, None]=None,
+        dir_cache_max_bytes: Union[int, None]=None
 ) -> None:
     if to is not None:
         if isinstance(to, str):
@@ -98,6 +167,54 @@ def set_config(*,
         _global_config['algorithm'] = algorithm
     if use_hard_links is not None:
         _global_config['use_hard_links'] = use_hard_links
+    if num_hash_workers is not None:
+        # number of threads used to compute the manifests of large files
+        _global_config['num_hash_workers'] = num_hash_workers
+    if extra_hash_algorithms is not None:
+        # other algorithms (e.g., ['md5']) to compute in the same read whenever a local file needs to be hashed
+        # so that a later request for them is answered from the stat record
+        _global_config['extra_hash_algorithms'] = extra_hash_algorithms
+    if transfer_strategy is not None:
+        # how files are put into the cache and copied out of it (load_file with dest, load_dir):
+        # 'link', 'reflink', 'copy_file_range', 'copy' or 'auto' (see _transfer.transfer_file)
+        check_transfer_strategy(transfer_strategy)
+        _global_config['transfer_strategy'] = transfer_strategy
+    if memo_cache_max_bytes is not None:
+        # size bound of the in-process cache used by load_text and load_object for hash urls (0 disables it)
+        _global_config['memo_cache_max_bytes'] = memo_cache_max_bytes
+    if num_download_workers is not None:
+        # number of concurrent range requests used to download a large file (1 for a single stream)
+        _global_config['num_download_workers'] = num_download_workers
+    if download_segment_size is not None:
+        _global_config['download_segment_size'] = download_segment_size
+    if http_pool_size is not None:
+        # connections kept alive per host, shared by all threads (applies to the whole process)
+        _global_config['http_pool_size'] = http_pool_size
+        configure_transport(pool_size=http_pool_size)
+    if http_connect_timeout is not None:
+        _global_config['http_connect_timeout'] = http_connect_timeout
+        configure_transport(connect_timeout=http_connect_timeout)
+    if http_timeout is not None:
+        # seconds without receiving any data before a request fails
+        _global_config['http_timeout'] = http_timeout
+        configure_transport(read_timeout=http_timeout)
+    if aio_max_connections is not None:
+        # bound on the concurrent connections of kachery.aio (per event loop, read when its session is created)
+        _global_config['aio_max_connections'] = aio_max_connections
+    if remote_check_ttl is not None:
+        # seconds during which the result of checking for a file on a remote server is reused
+        # (by all processes using the same hash database), for files that were found (0 disables it)
+        _global_config['remote_check_ttl'] = remote_check_ttl
+    if remote_check_negative_ttl is not None:
+        # same for files that were not found
+        _global_config['remote_check_negative_ttl'] = remote_check_negative_ttl
+    if num_ingest_workers is not None:
+        # number of files of a directory hashed (and stored) concurrently by store_dir and read_dir, and uploaded concurrently by store_dir
+        _global_config['num_ingest_workers'] = num_ingest_workers
+    if dir_cache_max_bytes is not None:
+        # size bound (of the json) of the in-process cache of parsed directory objects used to resolve
+        # paths in sha1dir:// urls (0 disables it)
+        _global_config['dir_cache_max_bytes'] = dir_cache_max_bytes
 
 def _get_server_config_for_name(name: str, *, write: bool) -> dict:
     if '~' in name:
@@ -208,7 +325,7 @@ def load_file(path: str, dest: str=None, **kwargs)-> Union[str, None]:
             ret, _, _ = _find_file_locally(path, config=config)
             if ret:
                 if dest:
-                    shutil.copyfile(ret, dest)
+                    transfer_file(ret, dest, strategy=config['transfer_strategy'])
                     return dest
                 return ret
         if fr['url'] is not None:
@@ -219,7 +336,7 @@ def load_file(path: str, dest: str=None, **kwargs)-> Union[str, None]:
                 if fname_empty is None:
                     raise Exception('Unexpected fname_empty is None')
                 if dest:
-                    shutil.copyfile(str(fname_empty), dest)
+                    transfer_file(str(fname_empty), dest, strategy=config['transfer_strategy'])
                     return dest
                 return fname_empty
 
@@ -227,38 +344,185 @@ def load_file(path: str, dest: str=None, **kwargs)-> Union[str, None]:
                 assert algorithm is not None
                 assert hash0 is not None
                 assert size0 is not None
-                return _hash_caches[algorithm].downloadFile(url=url0, hash=hash0, size=size0, target_path=dest)
+                manifest = _load_manifest_for_url(path, config=config) if algorithm == 'sha1' else None
+                return _hash_caches[algorithm].downloadFile(url=url0, hash=hash0, size=size0, target_path=dest, num_workers=config['num_download_workers'], segment_size=config['download_segment_size'], manifest=manifest)
             else:
                 return None
         return None
     else:
         if os.path.isfile(path):
             if dest:
-                shutil.copyfile(path, dest)
+                transfer_file(path, dest, strategy=config['transfer_strategy'])
                 return dest
             return path
         else:
             return None
     
+def load_files(paths: List[str], dests: Optional[List[Optional[str]]]=None, max_workers: int=16, **kwargs) -> List[Union[str, None, Exception]]:
+    """Load a list of files (see load_file)
+
+    The files found in the local cache are loaded first, and the others are
+    checked for and downloaded from the remote server concurrently.
+
+    Parameters
+    ----------
+    paths : List[str]
+        The paths or hash urls
+    dests : Optional[List[Optional[str]]], optional
+        The destinations (see load_file), by default None
+    max_workers : int, optional
+        Maximum number of files loaded concurrently from the remote server, by default 16
+
+    Returns
+    -------
+    List[Union[str, None, Exception]]
+        For each path (in the same order), the local path, None if the file
+        was not found, or the Exception raised while loading it
+    """
+    config = _load_config(**kwargs)
+    if dests is None:
+        dests = [None for _ in paths]
+    if len(dests) != len(paths):
+        raise Exception('Number of dests does not match number of paths: {} <> {}'.format(len(dests), len(paths)))
+    return _run_batch(
+        lambda path, dest, config: load_file(path, dest=dest, config=config),
+        list(zip(paths, dests)), max_workers=max_workers, config=config
+    )
+
+def _run_batch(func, items: List[tuple], *, max_workers: int, config: dict) -> list:
+    # func(*item, config=...) for each item (whose first element is the path): first against the local
+    # cache only, in this thread, and then for the hash urls that were not found, against the remote
+    # server, in a thread pool. Errors are returned in place of the results.
+    results: list = [None for _ in items]
+    config_local = dict(config, fr=dict(url=None, channel=None, password=None))
+    remote_inds: List[int] = []
+    for ii, item in enumerate(items):
+        if not (_is_hash_url(item[0]) and config['from_remote_only']):
+            try:
+                results[ii] = func(*item, config=config_local)
+            except Exception as e:
+                results[ii] = e
+                continue
+        if (results[ii] is None) and _is_hash_url(item[0]) and (config['fr']['url'] is not None):
+            remote_inds.append(ii)
+    # identical items are only processed once
+    unique_inds: Dict[tuple, int] = dict()
+    for ii in remote_inds:
+        unique_inds.setdefault(items[ii], ii)
+    if unique_inds:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_inds)))) as executor:
+            futures = dict([(item, executor.submit(func, *item, config=config)) for item in unique_inds.keys()])
+            for ii in remote_inds:
+                try:
+                    results[ii] = futures[items[ii]].result()
+                except Exception as e:
+                    results[ii] = e
+    return results
+
+def _load_manifest_for_url(path: str, *, config: dict) -> Union[dict, None]:
+    # the manifest given by ?manifest=<sha1> (see store_file), if any
+    if '?' not in path:
+        return None
+    manifest_sha1 = None
+    for item in path.split('?', 1)[1].split('&'):
+        if item.startswith('manifest='):
+            manifest_sha1 = item[len('manifest='):]
+    if not manifest_sha1:
+        return None
+    try:
+        manifest = load_object('sha1://' + manifest_sha1, config=config)
+    except Exception as e:
+        print('Warning: unable to load manifest {}: {}'.format(manifest_sha1, str(e)))
+        return None
+    if manifest is None:
+        print('Warning: unable to find manifest {}'.format(manifest_sha1))
+    return manifest
+
 def load_text(path: str, **kwargs) -> Union[str, None]:
-    path2 = load_file(path, **kwargs)
+    config = _load_config(**kwargs)
+    memo_key = _get_memo_key(path, kind='text', config=config)
+    if memo_key is not None:
+        txt = _memo_cache.get(memo_key)
+        if txt is not None:
+            return txt
+    path2 = load_file(path, config=config)
     if not path2:
         return None
     with open(path2, 'r') as f:
-        return f.read()
+        txt = f.read()
+        # in bytes, like the bound (len(txt) counts characters)
+        size0 = os.fstat(f.fileno()).st_size
+    if memo_key is not None:
+        _memo_cache.set(memo_key, txt, size=size0, max_bytes=config['memo_cache_max_bytes'])
+    return txt
 
 def load_object(path: str, **kwargs) -> Union[dict, None]:
-    path2 = load_file(path, **kwargs)
+    config = _load_config(**kwargs)
+    memo_key = _get_memo_key(path, kind='object', config=config)
+    if memo_key is not None:
+        # the object is kept pickled so that each caller gets its own copy
+        # (unpickling is considerably faster than parsing the json)
+        pickled = _memo_cache.get(memo_key)
+        if pickled is not None:
+            return pickle.loads(pickled)
+    path2 = load_file(path, config=config)
     if not path2:
         return None
     with open(path2, 'r') as f:
-        return simplejson.load(f)
+        obj = simplejson.load(f)
+    if memo_key is not None:
+        pickled = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        _memo_cache.set(memo_key, pickled, size=len(pickled), max_bytes=config['memo_cache_max_bytes'])
+    return obj
+
+def _get_memo_key(path: str, *, kind: str, config: dict) -> Union[Tuple[str, str, str], None]:
+    # None if the memo cache is disabled or does not apply
+    if not config['memo_cache_max_bytes']:
+        return None
+    if not _is_hash_url(path):
+        return None
+    hash0, algorithm = _determine_file_hash_from_url(path, config=config)
+    if (hash0 is None) or (algorithm is None):
+        return None
+    return (kind, algorithm, hash0)
+
+def get_memo_cache_stats() -> dict:
+    """Return the hit/miss counters and the size of the in-process cache of load_text and load_object
+
+    The cache is enabled with set_config(memo_cache_max_bytes=...).
+    """
+    return _memo_cache.stats()
 
-def load_npy(path: str, **kwargs) -> Union[np.ndarray, None]:
+def load_npy(path: str, mmap_mode: Union[str, None]=None, **kwargs) -> Union[np.ndarray, None]:
+    # with mmap_mode='r' (or 'c') the array is memory-mapped from the cached file
+    # rather than read into memory, so that processes on one machine share the page cache
+    if mmap_mode not in [None, 'r', 'c']:
+        raise Exception('Unsupported mmap_mode for load_npy: {} (files in the store must not be modified)'.format(mmap_mode))
     path2 = load_file(path, **kwargs)
     if not path2:
         return None
-    return np.load(path2)
+    return np.load(path2, mmap_mode=mmap_mode)
+
+def load_buffer(path: str, **kwargs) -> Union[memoryview, None]:
+    """Load the content of a file as a read-only memoryview, without copying
+
+    The returned buffer is backed by a memory map of the local (cached) file,
+    so that the data is shared via the page cache rather than copied into
+    the memory of each process.
+    """
+    path2 = load_file(path, **kwargs)
+    if not path2:
+        return None
+    return _mmap_file_readonly(path2)
+
+def _mmap_file_readonly(path: str) -> memoryview:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            return memoryview(b'')
+        # the map remains valid after the file is closed
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm)
 
 def load_bytes(path: str, start: Union[int, None]=None, end: Union[int, None]=None, write_to_stdout=False, **kwargs) -> Union[bytes, None]:
     config = _load_config(**kwargs)
@@ -316,7 +580,9 @@ def load_bytes(path: str, start: Union[int, None]=None, end: Union[int, None]=No
         else:
             return None
 
-def _load_remote_file_block(path: str, *, url: str, size: int, config: dict, start: int, end: int):
+def _load_remote_file_block(path: str, *, url: str, size: int, config: dict, start: int, end: int) -> memoryview:
+    # the range is served from the cache if the whole file is there, otherwise from (and stored in)
+    # the partially downloaded file for the hash, so that blocks are reused at any alignment
     if _is_hash_url(path):
         hash0, algorithm0 = _determine_file_hash_from_url(url=path, config=config)
     else:
@@ -325,24 +591,22 @@ def _load_remote_file_block(path: str, *, url: str, size: int, config: dict, sta
     if hash0 is None:
         raise Exception('Unable to compute hash of file: {}'.format(path))
     assert algorithm0 is not None
-    code: Dict[str, Union[str, int]]=dict(
-        start=start,
-        end=end
-    )
-    code[algorithm0] = hash0
-    code_hash = _sha1_of_object(code)
     hc = _hash_caches[algorithm0]
-    path0 = hc.find_file_by_code(code=code_hash)
-    if path0:
-        return path0
+    path0 = hc.findFile(hash=hash0)
+    if path0 is not None:
+        return _mmap_file_readonly(path0)[start:end]
+    bytes0 = hc.readFileRange(hash0, size=size, start=start, end=end)
+    if bytes0 is not None:
+        return memoryview(bytes0)
     bytes0 = _load_bytes_from_remote_file(url=url, config=config, size=size, start=start, end=end)
-    if not bytes0:
-        return None
-    return hc.store_file_by_code(code=code_hash, data=bytes0)
-    
-
-
-def open_file(path: str, block_size=10 * 1024 * 1024, **kwargs):
+    if (bytes0 is None) or (len(bytes0) != end - start):
+        raise Exception('Problem loading bytes {} - {} of file: {}'.format(start, end, path))
+    hc.writeFileRange(hash0, size=size, start=start, data=bytes0)
+    return memoryview(bytes0)
+
+def open_file(path: str, block_size=10 * 1024 * 1024, read_ahead: int=0, max_cached_blocks: int=4, **kwargs):
+    # for a remote file, read_ahead is the number of subsequent blocks that are loaded
+    # in background threads, and max_cached_blocks the number of recently used blocks kept mapped in memory
     config = _load_config(**kwargs)
     verbose = config['verbose']
     info = get_file_info(path, **kwargs)
@@ -355,76 +619,244 @@ def open_file(path: str, block_size=10 * 1024 * 1024, **kwargs):
     elif 'url' in info:
         if verbose:
             print('opening from url', info['url'])
-        return _RemoteFile(path, url=info['url'], size=info['size'], block_size=block_size, config=config)
+        return _RemoteFile(path, url=info['url'], size=info['size'], block_size=block_size, read_ahead=read_ahead, max_cached_blocks=max_cached_blocks, config=config)
     else:
         raise Exception('Unexpected info')
 
-def load_dir(path: str, dest: str, **kwargs)-> None:
+def load_dir(path: str, dest: str, max_workers: int=16, **kwargs) -> Dict[str, Union[str, Exception]]:
+    """Load a directory (see store_dir) into dest
+
+    The directory object is resolved once, the directory structure is
+    created, and the files are then loaded by a pool of threads: from the
+    local cache (using the transfer strategy) if they are there, and
+    otherwise from the remote server. Each distinct content is loaded
+    once. If dest already exists (e.g., from an interrupted load), the
+    files that are already in place with the right content are kept.
+
+    Parameters
+    ----------
+    path : str
+        The sha1dir:// (or md5dir://) uri, or a local directory
+    dest : str
+        The destination directory
+    max_workers : int, optional
+        Maximum number of files loaded concurrently, by default 16
+
+    Returns
+    -------
+    Dict[str, Union[str, Exception]]
+        For each file (by relative path): 'existing', 'from_cache',
+        'downloaded' or 'created' (for empty files), or the Exception
+        raised while loading it. A file with the same content as another
+        one is transferred from it, and gets its status ('from_cache' if that
+        one was 'existing').
+    """
     print('Loading directory {} -> {}'.format(path, dest))
-    if os.path.exists(dest):
-        raise Exception('Destination directory already exists: {}'.format(dest))
-    os.mkdir(dest)
+    if os.path.exists(dest) and (not os.path.isdir(dest)):
+        raise Exception('Destination exists and is not a directory: {}'.format(dest))
     config = _load_config(**kwargs)
-    dd = read_dir(path=path, recursive=False, config=config)
-    for filename in dd['files']:
-        load_file(path + '/' + filename, dest=os.path.join(dest, filename), config=config)
-    for dirname in dd['dirs']:
-        load_dir(path + '/' + dirname, dest=os.path.join(dest, dirname), config=config)
+    dd = read_dir(path=path, recursive=True, config=config)
+    if dd is None:
+        raise Exception('Unable to read directory: {}'.format(path))
+    file_entries: List[Tuple[str, dict]] = []
+    _make_dirs_for_dir_object(dd, dest=dest, relpath='', file_entries=file_entries)
+
+    def is_in_place(dest_file: str, entry: dict, hash0: str, algorithm: str) -> bool:
+        # whether dest_file already has the content, otherwise it is removed
+        if not os.path.lexists(dest_file):
+            return False
+        if os.path.isfile(dest_file) and (os.path.getsize(dest_file) == entry['size']):
+            # the hash is usually known from the stat of a previously loaded file
+            if _compute_local_file_hash(dest_file, algorithm=algorithm, config=config) == hash0:
+                return True
+        os.unlink(dest_file)
+        return False
+
+    def load_dir_file(relpath: str, entry: dict) -> str:
+        dest_file = os.path.join(dest, relpath)
+        hash0, algorithm = _get_hash_of_file_entry(entry)
+        if hash0 is None:
+            raise Exception('No hash for file in directory object: {}'.format(relpath))
+        assert algorithm is not None
+        if is_in_place(dest_file, entry, hash0, algorithm):
+            return 'existing'
+        if entry['size'] == 0:
+            with open(dest_file, 'wb'):
+                pass
+            return 'created'
+        path0 = _hash_caches[algorithm].findFile(hash0) if not config['from_remote_only'] else None
+        if path0 is not None:
+            transfer_file(path0, dest_file, strategy=config['transfer_strategy'])
+            _hash_caches[algorithm].reportFileHash(dest_file, hash=hash0)
+            return 'from_cache'
+        if load_file('{}://{}'.format(algorithm, hash0), dest=dest_file, config=config) is None:
+            raise Exception('Unable to find file: {}'.format(relpath))
+        return 'downloaded'
+
+    def load_dir_files(group: List[Tuple[str, dict]]) -> List[Union[str, Exception]]:
+        # the files of a group have the same content: it is loaded once, and then transferred to the others
+        relpath0, entry0 = group[0]
+        try:
+            status0: Union[str, Exception] = load_dir_file(relpath0, entry0)
+        except Exception as e:
+            return [e for _ in group]
+        statuses = [status0]
+        hash0, algorithm = _get_hash_of_file_entry(entry0)
+        for relpath, entry in group[1:]:
+            dest_file = os.path.join(dest, relpath)
+            try:
+                if is_in_place(dest_file, entry, hash0, algorithm):
+                    statuses.append('existing')
+                    continue
+                transfer_file(os.path.join(dest, relpath0), dest_file, strategy=config['transfer_strategy'])
+                _hash_caches[algorithm].reportFileHash(dest_file, hash=hash0)
+                statuses.append('from_cache' if status0 == 'existing' else status0)
+            except Exception as e:
+                statuses.append(e)
+        return statuses
+
+    # group the files by content (files without a hash are on their own, and fail)
+    groups: Dict[Tuple[Optional[str], str], List[Tuple[str, dict]]] = OrderedDict()
+    for relpath, entry in file_entries:
+        hash0, algorithm = _get_hash_of_file_entry(entry)
+        key = (algorithm, hash0) if hash0 is not None else (None, relpath)
+        groups.setdefault(key, []).append((relpath, entry))
+
+    statuses: Dict[str, Union[str, Exception]] = dict()
+    if groups:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(groups)))) as executor:
+            futures = [(group, executor.submit(load_dir_files, group)) for group in groups.values()]
+            for group, future in futures:
+                for (relpath, _), status in zip(group, future.result()):
+                    if isinstance(status, Exception):
+                        print('Warning: unable to load {}: {}'.format(relpath, str(status)))
+                    statuses[relpath] = status
+    ret: Dict[str, Union[str, Exception]] = dict([(relpath, statuses[relpath]) for relpath, _ in file_entries])
+    counts = dict([(status, len([v for v in ret.values() if v == status])) for status in ['existing', 'from_cache', 'downloaded', 'created']])
+    num_failed = len([v for v in ret.values() if isinstance(v, Exception)])
+    print('Loaded directory {} -> {}: {} files already present, {} from the local cache, {} downloaded, {} empty, {} failed'.format(
+        path, dest, counts['existing'], counts['from_cache'], counts['downloaded'], counts['created'], num_failed
+    ))
+    return ret
+
+def _make_dirs_for_dir_object(dd: dict, *, dest: str, relpath: str, file_entries: List[Tuple[str, dict]]) -> None:
+    # creates dest and its subdirectories, and collects the (relative path, entry) of the files
+    if not os.path.isdir(dest):
+        os.mkdir(dest)
+    for filename, entry in dd['files'].items():
+        file_entries.append((relpath + filename, entry))
+    for dirname, subdir in dd['dirs'].items():
+        _make_dirs_for_dir_object(subdir, dest=os.path.join(dest, dirname), relpath=relpath + dirname + '/', file_entries=file_entries)
 
 class _RemoteFile:
-    def __init__(self, path: str, *, url: str, size: int, block_size: int, config: dict):
+    def __init__(self, path: str, *, url: str, size: int, block_size: int, config: dict, read_ahead: int=0, max_cached_blocks: int=4):
         self._path = path
         self._url = url
         self._size = size
         self._block_size = block_size
         self._config = config
+        self._read_ahead = read_ahead
+        self._max_cached_blocks = max(1, max_cached_blocks)
         self._current_pos = 0
-        self._block_paths: Dict[str] = dict()
-        self._current_block_num = None
-        self._current_block_file = None
+        # block_num -> memoryview of the mapped block file, least recently used first
+        self._cached_blocks: 'OrderedDict[int, memoryview]' = OrderedDict()
+        # block_num -> future of a block that is being loaded in the background
+        self._prefetches: Dict[int, Future] = dict()
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._stats = dict(
+            num_cache_hits=0,
+            num_prefetch_hits=0,
+            num_prefetch_stalls=0,
+            num_blocks_loaded=0,
+            stall_time=0.0
+        )
     def __enter__(self):
         return self
     def __exit__(self, type, value: object, traceback) -> None:
-        if self._current_block_file is not None:
-            self._current_block_file.close()
+        self.close()
+    def close(self) -> None:
+        if self._executor is not None:
+            for ff in self._prefetches.values():
+                ff.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._prefetches = dict()
+        self._cached_blocks = OrderedDict()
     def seek(self, offset):
         self._current_pos = offset
-    def read(self, size):
+    def tell(self) -> int:
+        return self._current_pos
+    def read(self, size=-1):
         p1 = self._current_pos
-        p2 = self._current_pos + size
-        return self._read(p1, p2)
+        if (size is None) or (size < 0):
+            p2 = self._size
+        else:
+            p2 = min(self._current_pos + size, self._size)
+        if p2 <= p1:
+            return b''
+        ret = self._read(p1, p2)
+        self._current_pos = p2
+        return ret
+    def stats(self) -> dict:
+        # how the blocks were obtained: from the in-memory cache, from a completed prefetch,
+        # by waiting for a prefetch in progress (a stall), or loaded synchronously
+        return deepcopy(self._stats)
     def _read(self, p1, p2):
         b_start = math.floor(p1 / self._block_size)
         b_end = math.floor((p2 - 1) / self._block_size)
-        if b_start == b_end:
-            self._load_block_file(b_start)
-            f = self._current_block_file
-            f.seek(p1 - b_start * self._block_size)
-            return f.read(p2 - p1)
+        buffers = []
+        for bb in range(b_start, b_end + 1):
+            block = self._get_block(bb)
+            offset = bb * self._block_size
+            buffers.append(block[max(p1, offset) - offset:min(p2, offset + self._block_size) - offset])
+        self._start_prefetches(b_end + 1)
+        return b''.join(buffers)
+    def _get_block(self, block_num: int) -> memoryview:
+        if block_num in self._cached_blocks:
+            self._cached_blocks.move_to_end(block_num)
+            self._stats['num_cache_hits'] += 1
+            return self._cached_blocks[block_num]
+        if block_num in self._prefetches:
+            ff = self._prefetches.pop(block_num)
+            if ff.done():
+                self._stats['num_prefetch_hits'] += 1
+                block = ff.result()
+            else:
+                self._stats['num_prefetch_stalls'] += 1
+                timer = time.time()
+                block = ff.result()
+                self._stats['stall_time'] += time.time() - timer
         else:
-            buffers = []
-            buffers.append(self._read(p1, (b_start + 1) * self._block_size ))
-            for bb in range(b_start + 1, b_end):
-                buffers.append(self._read(bb * self._block_size, (bb + 1) * self._block_size))
-            buffers.append(self._read(b_end * self._block_size, p2))
-            return b''.join(buffers)
-    def _get_block_path(self, block_num) -> Union[str, None]:
+            self._stats['num_blocks_loaded'] += 1
+            block = self._load_block(block_num)
+        self._cached_blocks[block_num] = block
+        while len(self._cached_blocks) > self._max_cached_blocks:
+            self._cached_blocks.popitem(last=False)
+        return block
+    def _start_prefetches(self, block_num: int) -> None:
+        if self._read_ahead <= 0:
+            return
+        num_blocks = math.ceil(self._size / self._block_size)
+        for bb in range(block_num, min(block_num + self._read_ahead, num_blocks)):
+            if (bb not in self._cached_blocks) and (bb not in self._prefetches):
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._read_ahead)
+                self._prefetches[bb] = self._executor.submit(self._load_block, bb)
+    def _load_block(self, block_num: int) -> memoryview:
+        start = block_num * self._block_size
+        end = min((block_num + 1) * self._block_size, self._size)
         if block_num == 0 and self._block_size >= self._size:
             # in this case we are loading the entire file
             # we need to put load_from='remote' in case the config has remote_only (a bit tricky)
-            return load_file(path=self._path, config=self._config, from_remote_only=False)
-        if block_num not in self._block_paths:
-            self._block_paths[block_num] = _load_remote_file_block(path=self._path, url=self._url, size=self._size, config=self._config, start=block_num * self._block_size, end=min((block_num + 1) * self._block_size, self._size))
-        return self._block_paths[block_num]
-    def _load_block_file(self, block_num):
-        if self._current_block_num == block_num:
-            return
-        block_path = self._get_block_path(block_num)
-        assert block_path is not None
-        if self._current_block_file is not None:
-            self._current_block_file.close()
-        self._current_block_file = open(block_path, 'rb')
-        self._current_block_num = block_num
+            path0 = load_file(path=self._path, config=self._config, from_remote_only=False)
+            if path0 is None:
+                raise Exception('Unable to load file: {}'.format(self._path))
+            block = _mmap_file_readonly(path0)
+        else:
+            block = _load_remote_file_block(path=self._path, url=self._url, size=self._size, config=self._config, start=start, end=end)
+        if len(block) != end - start:
+            raise Exception('Unexpected size of block {} of file {}: {} <> {}'.format(block_num, self._path, len(block), end - start))
+        return block
 
 def get_object_hash(obj: dict):
     return _sha1_of_object(obj)
@@ -479,6 +911,33 @@ def get_file_info(path: str, hash_only=False, **kwargs) -> Union[dict, None]:
         else:
             return None
 
+def get_file_infos(paths: List[str], hash_only: bool=False, max_workers: int=16, **kwargs) -> List[Union[dict, None, Exception]]:
+    """Get the info of a list of files (see get_file_info)
+
+    The files found in the local cache are handled first, and the others are
+    checked for on the remote server concurrently.
+
+    Parameters
+    ----------
+    paths : List[str]
+        The paths or hash urls
+    hash_only : bool, optional
+        See get_file_info, by default False
+    max_workers : int, optional
+        Maximum number of concurrent requests to the remote server, by default 16
+
+    Returns
+    -------
+    List[Union[dict, None, Exception]]
+        For each path (in the same order), the info, None if the file was not
+        found, or the Exception raised while getting the info
+    """
+    config = _load_config(**kwargs)
+    return _run_batch(
+        lambda path, config: get_file_info(path, hash_only=hash_only, config=config),
+        [(path,) for path in paths], max_workers=max_workers, config=config
+    )
+
 def store_file(path: str, basename: Union[str, None]=None, git_annex_mode: bool=False, _no_manifest: bool=False, **kwargs) -> Union[str, None]:
     if basename is None:
         basename = os.path.basename(path)
@@ -490,26 +949,67 @@ def store_file(path: str, basename: Union[str, None]=None, git_annex_mode: bool=
     config = _load_config(**kwargs)
     to = config['to']
     algorithm = config['algorithm']
-    if algorithm == 'sha1' and (not _no_manifest) and (os.path.getsize(path) > 4000000):
-        hash0, manifest0 = _compute_local_file_sha1_and_manifest(path)
-    else:
-        hash0 = _compute_local_file_hash(path, algorithm=algorithm, config=config)
-        manifest0 = None
-        
-    if not hash0:
-        raise Exception('Unable to compute {} hash of file: {}'.format(algorithm, path))
-    if not config['to_remote_only']:
-        _store_local_file_in_cache(path, algorithm=algorithm, hash=hash0, config=config)
+    hash0, manifest0 = _store_file_locally(path, no_manifest=_no_manifest, config=config)
     if (to['url'] is not None) and (not git_annex_mode):
         _upload_local_file(path, algorithm=algorithm, hash=hash0, config=config)
-    if manifest0 is None:
-        return '{}://{}/{}'.format(algorithm, hash0, basename)
+    return _form_stored_file_uri(algorithm=algorithm, hash=hash0, basename=basename, manifest=manifest0, config=config)
+
+def _store_file_locally(path: str, *, no_manifest: bool, config: dict) -> Tuple[str, Union[dict, None]]:
+    # hash the file (and compute its manifest) and put it in the cache unless to_remote_only
+    algorithm = config['algorithm']
+    compute_manifest = algorithm == 'sha1' and (not no_manifest) and (os.path.getsize(path) > 4000000)
+    if (not config['to_remote_only']) and (not _is_local_file_in_cache(path, algorithm=algorithm, config=config)):
+        # copy (or link/reflink) the file into the cache while hashing it (at most a single read)
+        _, hashes0, manifest0 = _hash_caches[algorithm].ingestFile(path, also_compute=config['extra_hash_algorithms'], compute_manifest=compute_manifest, strategy=_ingest_transfer_strategy(config), num_hash_workers=config['num_hash_workers'] or default_num_hash_workers())
+        hash0 = hashes0[algorithm]
     else:
-        manifest_uri = store_object(manifest0, _no_manifest=True)
+        if compute_manifest:
+            hash0, manifest0 = _compute_local_file_sha1_and_manifest(path, num_workers=config['num_hash_workers'])
+            if hash0:
+                _hash_caches[algorithm].reportFileHash(path, hash=hash0)
+        else:
+            hash0 = _compute_local_file_hash(path, algorithm=algorithm, config=config)
+            manifest0 = None
+        if not hash0:
+            raise Exception('Unable to compute {} hash of file: {}'.format(algorithm, path))
+        if not config['to_remote_only']:
+            _store_local_file_in_cache(path, algorithm=algorithm, hash=hash0, config=config)
+    return hash0, manifest0
+
+def store_bytes(data: bytes, basename: Union[str, None]=None, _no_manifest: bool=False, **kwargs) -> Union[str, None]:
+    # like store_file, but for an in-memory buffer (no temporary file)
+    if basename is None:
+        basename = 'file.dat'
+    config = _load_config(**kwargs)
+    to = config['to']
+    algorithm = config['algorithm']
+    compute_manifest = algorithm == 'sha1' and (not _no_manifest) and (len(data) > 4000000)
+    if not config['to_remote_only']:
+        _, hashes0, manifest0 = _hash_caches[algorithm].storeBytes(data, also_compute=config['extra_hash_algorithms'], compute_manifest=compute_manifest)
+    else:
+        hasher = StreamHasher(algorithms=[algorithm], manifest=compute_manifest, size=len(data))
+        hasher.update(data)
+        hashes0 = hasher.hexdigests()
+        manifest0 = hasher.manifest()
+    hash0 = hashes0[algorithm]
+    if to['url'] is not None:
+        _upload_data(data, algorithm=algorithm, hash=hash0, config=config)
+    return _form_stored_file_uri(algorithm=algorithm, hash=hash0, basename=basename, manifest=manifest0, config=config)
+
+def _form_stored_file_uri(*, algorithm: str, hash: str, basename: str, manifest: Optional[dict], config: dict) -> str:
+    if manifest is None:
+        return '{}://{}/{}'.format(algorithm, hash, basename)
+    else:
+        # stored where the file is stored, so that it can be used for loading the file
+        manifest_uri = store_object(manifest, _no_manifest=True, config=config)
         assert manifest_uri is not None
-        manifest_sha1 = get_file_hash(manifest_uri)
-        return '{}://{}/{}?manifest={}'.format(algorithm, hash0, basename, manifest_sha1)
-    
+        return _format_stored_file_uri(algorithm=algorithm, hash=hash, basename=basename, manifest_sha1=get_file_hash(manifest_uri))
+
+def _format_stored_file_uri(*, algorithm: str, hash: str, basename: str, manifest_sha1: Optional[str]) -> str:
+    if manifest_sha1 is None:
+        return '{}://{}/{}'.format(algorithm, hash, basename)
+    return '{}://{}/{}?manifest={}'.format(algorithm, hash, basename, manifest_sha1)
+
 # def _compute_manifest_of_buf(data):
 #     algorithm = 'sha1'
 #     manifest = {
@@ -556,62 +1056,13 @@ def store_file(path: str, basename: Union[str, None]=None, git_annex_mode: bool=
 #     manifest['size'] = size0
 #     return manifest
 
-def _compute_local_file_sha1_and_manifest(path):
-    algorithm = 'sha1'
-    manifest = {
-        'size': 0,
-        'sha1': '',
-        'chunks': []
-    }
-    if not os.path.exists(path):
-        return None, None
-    size0 = os.path.getsize(path)
-    if (size0 > 1024 * 1024 * 100):
-        print('Computing {} and manifest of {}'.format(algorithm, path))
+def _compute_local_file_sha1_and_manifest(path: str, num_workers: Optional[int]=None) -> Tuple[Union[str, None], Union[dict, None]]:
+    return compute_file_sha1_and_manifest(path, num_workers=num_workers)
 
-    # Determine the chunk size based on the file size
-    if size0 < 1000 * 1000 * 1000:
-        chunk_size = 10000000
-    else:
-        chunk_size = 20000000
-    # num_chunks = math.ceil(size0 / chunk_size)
-
-    hashsum = getattr(hashlib, algorithm)()
-    with open(path, 'rb') as file:
-        pos = 0
-        while pos < size0:
-            
-            this_chunk_size = min(chunk_size, size0 - pos)
-
-            this_chunk_hashsum = getattr(hashlib, algorithm)()
-            buf = file.read(this_chunk_size)
-            this_chunk_hashsum.update(buf)
-            
-            hashsum.update(buf)
-            
-            chunk = {
-                'start': pos,
-                'end': pos + this_chunk_size,
-                'sha1': this_chunk_hashsum.hexdigest()
-            }
-            manifest['chunks'].append(chunk)
-            
-            pos = pos + this_chunk_size
-            
-    sha1 = hashsum.hexdigest()
-    manifest['sha1'] = sha1
-    manifest['size'] = size0
-    return sha1, manifest
-
-    
 def store_text(text: str, basename: Union[str, None]=None, **kwargs) -> Union[str, None]:
     if basename is None:
         basename = 'file.txt'
-    with TemporaryDirectory() as tmpdir:
-        fname = tmpdir + '/text.txt'
-        with open(fname, 'w') as f:
-            f.write(text)
-        return store_file(fname, basename=basename, **kwargs)
+    return store_bytes(text.encode('utf-8'), basename=basename, **kwargs)
 
 def store_object(object: dict, basename: Union[str, None]=None, indent: Union[int, None]=None, **kwargs) -> Union[str, None]:
     if basename is None:
@@ -622,12 +1073,96 @@ def store_object(object: dict, basename: Union[str, None]=None, indent: Union[in
 def store_npy(array: np.ndarray, basename: Union[str, None]=None, **kwargs) -> Union[str, None]:
     if basename is None:
         basename = 'file.npy'
-    with TemporaryDirectory() as tmpdir:
-        fname = tmpdir + '/array.npy'
-        np.save(fname, array)
-        return store_file(fname, basename=basename, **kwargs)
+    with open_store_writer(basename=basename, **kwargs) as f:
+        np.save(f, array)
+    return f.uri()
+
+def open_store_writer(basename: Union[str, None]=None, _no_manifest: bool=False, **kwargs) -> '_StoreWriter':
+    """Open a file-like object for storing data that is produced incrementally
+
+    The bytes are hashed as they are written to a temporary file in the
+    cache, which is renamed to its content address on close. Example:
+    ```
+    with ka.open_store_writer(basename='x.npy') as f:
+        np.save(f, x)
+    uri = f.uri()
+    ```
+    """
+    if basename is None:
+        basename = 'file.dat'
+    config = _load_config(**kwargs)
+    return _StoreWriter(basename=basename, no_manifest=_no_manifest, config=config)
 
-def store_dir(dirpath: str, label: Union[str, None]=None, git_annex_mode: bool=False, **kwargs):
+class _StoreWriter:
+    def __init__(self, *, basename: str, no_manifest: bool, config: dict):
+        self._basename = basename
+        self._config = config
+        self._uri: Union[str, None] = None
+        algorithm = config['algorithm']
+        self._writer = _hash_caches[algorithm].openWriter(
+            also_compute=config['extra_hash_algorithms'],
+            compute_manifest=(algorithm == 'sha1') and (not no_manifest)
+        )
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._writer.abort()
+        elif self._uri is None:
+            self.close()
+    def write(self, data) -> int:
+        return self._writer.write(data)
+    def writable(self) -> bool:
+        return True
+    def tell(self) -> int:
+        return self._writer.tell()
+    def flush(self) -> None:
+        pass
+    def uri(self) -> Union[str, None]:
+        return self._uri
+    def close(self) -> Union[str, None]:
+        if self._uri is not None:
+            return self._uri
+        config = self._config
+        algorithm = config['algorithm']
+        try:
+            hashes0, manifest0 = self._writer.finish()
+            hash0 = hashes0[algorithm]
+            if config['to_remote_only']:
+                # upload from the temporary file, which is then removed
+                path0 = self._writer.tmpPath()
+            else:
+                path0 = self._writer.commit()
+            if config['to']['url'] is not None:
+                _upload_local_file(path0, algorithm=algorithm, hash=hash0, config=config)
+        finally:
+            self._writer.abort()
+        if (manifest0 is not None) and (manifest0['size'] <= 4000000):
+            manifest0 = None
+        self._uri = _form_stored_file_uri(algorithm=algorithm, hash=hash0, basename=self._basename, manifest=manifest0, config=config)
+        return self._uri
+
+def store_dir(dirpath: str, label: Union[str, None]=None, git_annex_mode: bool=False, incremental: bool=False, **kwargs):
+    """Store a directory and return its sha1dir:// (or md5dir://) uri
+
+    With incremental=True, each subdirectory is stored as its own object, to
+    which its parent refers by hash (see _store_dir_object_incremental). When
+    the directory is stored again after some files changed, only the objects
+    along the changed paths are new (and uploaded), and so is the uri of the
+    directory. The files are still listed, but unchanged files are not read
+    again (their hashes are known from their stat).
+
+    Parameters
+    ----------
+    dirpath : str
+        Path of the directory
+    label : Union[str, None], optional
+        Appended to the uri, by default the name of the directory
+    git_annex_mode : bool, optional
+        Use the hashes of git-annex links instead of storing the files, by default False
+    incremental : bool, optional
+        Store the subdirectories as separate objects, by default False
+    """
     config = _load_config(**kwargs)
     if label is None:
         label = os.path.basename(dirpath)
@@ -635,6 +1170,8 @@ def store_dir(dirpath: str, label: Union[str, None]=None, git_annex_mode: bool=F
     X = read_dir(dirpath, recursive=True, git_annex_mode=git_annex_mode, store_files=True, config=config)
     if not X:
         return None
+    if incremental:
+        X = _store_subdir_objects(X, config=config)
     path1 = store_object(X, config=config)
     assert path1 is not None
     hash0, algorithm = _determine_file_hash_from_url(url=path1, config=config)
@@ -646,40 +1183,132 @@ def read_dir(path: str, *, recursive: bool=True, git_annex_mode: bool=False, sto
         protocol, algorithm, hash0, additional_path = _parse_kachery_url(path)
         if not protocol.endswith('dir'):
             raise Exception('Not a directory: {}'.format(path))
-        dd = load_object('{}://{}'.format(algorithm, hash0), config=config)
-        if dd is None:
+        x = _lookup_dir_object_path(algorithm=algorithm, hash=hash0, path=additional_path, config=config)
+        if x is None:
             return None
-        if additional_path:
-            list0 = additional_path.split('/')
-        else:
-            list0 = []
-        ii = 0
-        while ii < len(list0):
-            assert dd is not None
-            name0 = list0[ii]
-            if name0 in dd['dirs']:
-                dd = dd['dirs'][name0]
-            elif name0 in dd['files']:
-                raise Exception('Not a directory: {}'.format(path))
-            else:
-                return None
-            ii = ii + 1
-        if dd:
-            if not recursive:
-                for dname in dd['dirs']:
-                    dd['dirs'][dname] = {}
-        return dd
+        if x[0] != 'dir':
+            raise Exception('Not a directory: {}'.format(path))
+        return _copy_dir_object(x[1], recursive=recursive, config=config)
     else:
         return _read_file_system_dir(path, recursive=recursive, include_hashes=True, store_files=store_files, git_annex_mode=git_annex_mode, config=config)
 
+# With store_dir(..., incremental=True), the entry of a subdirectory in its parent is a reference to a
+# separately stored directory object: {<algorithm>: <hash>} rather than {files: ..., dirs: ...}. These
+# are loaded when they are reached.
+
+def _store_subdir_objects(dd: dict, *, config: dict) -> dict:
+    # stores the subdirectories (deepest first) and replaces them by references
+    algorithm = config['algorithm']
+    ret = dict(files=dd['files'], dirs=dict())
+    for dname, subdir in dd['dirs'].items():
+        subdir_uri = store_object(_store_subdir_objects(subdir, config=config), config=config)
+        assert subdir_uri is not None
+        ret['dirs'][dname] = {algorithm: _parse_kachery_url(subdir_uri)[2]}
+    return ret
+
+def _lookup_dir_object_path(*, algorithm: str, hash: str, path: str, config: dict) -> Union[Tuple[str, dict], None]:
+    # ('file', <file entry>) or ('dir', <directory object>) for a relative path in a directory object,
+    # ('not_dir', {}) if the path goes through a file, or None if it is not found. Only the objects of
+    # the subdirectories stored separately along the path are loaded.
+    index = _load_dir_object_index(algorithm=algorithm, hash=hash, config=config)
+    if index is None:
+        return None
+    x = index.get(path, None)
+    if x is None:
+        parts = path.split('/')
+        for ii in range(len(parts) - 1, 0, -1):
+            y = index.get('/'.join(parts[:ii]), None)
+            if y is not None:
+                if y[0] == 'dir' and _is_subdir_ref(y[1]):
+                    hash1, algorithm1 = _get_hash_of_file_entry(y[1])
+                    assert (hash1 is not None) and (algorithm1 is not None)
+                    return _lookup_dir_object_path(algorithm=algorithm1, hash=hash1, path='/'.join(parts[ii:]), config=config)
+                if y[0] == 'file':
+                    return ('not_dir', {})
+                return None
+        return None
+    if x[0] == 'dir' and _is_subdir_ref(x[1]):
+        hash1, algorithm1 = _get_hash_of_file_entry(x[1])
+        assert (hash1 is not None) and (algorithm1 is not None)
+        return _lookup_dir_object_path(algorithm=algorithm1, hash=hash1, path='', config=config)
+    return x
+
+def _load_dir_object_index(*, algorithm: str, hash: str, config: dict) -> Union[Dict[str, Tuple[str, dict]], None]:
+    # The paths of a directory object (not including those of the subdirectories stored separately),
+    # '' being the object itself. These are kept in an in-process cache (see dir_cache_max_bytes), so
+    # that resolving a path in a directory does not load and parse the object again. The entries must
+    # not be modified.
+    key = (algorithm, hash)
+    index = _dir_cache.get(key) if config['dir_cache_max_bytes'] else None
+    if index is not None:
+        return index
+    path0 = load_file('{}://{}'.format(algorithm, hash), config=config)
+    if path0 is None:
+        return None
+    with open(path0, 'r') as f:
+        dd = simplejson.load(f)
+    index = dict()
+    _index_dir_object(dd, prefix='', index=index)
+    if config['dir_cache_max_bytes']:
+        # the size of the json is used as an estimate of the size of the parsed object
+        _dir_cache.set(key, index, size=os.path.getsize(path0), max_bytes=config['dir_cache_max_bytes'])
+    return index
+
+def _index_dir_object(dd: dict, *, prefix: str, index: Dict[str, Tuple[str, dict]]) -> None:
+    index[prefix.rstrip('/')] = ('dir', dd)
+    if not dd:
+        # placeholder of a non-recursive listing
+        return
+    for fname, entry in dd['files'].items():
+        index[prefix + fname] = ('file', entry)
+    for dname, subdir in dd['dirs'].items():
+        if _is_subdir_ref(subdir):
+            index[prefix + dname] = ('dir', subdir)
+        else:
+            _index_dir_object(subdir, prefix=prefix + dname + '/', index=index)
+
+def _is_subdir_ref(entry: dict) -> bool:
+    return ('files' not in entry) and ('dirs' not in entry) and (_get_hash_of_file_entry(entry)[0] is not None)
+
+def _copy_dir_object(dd: dict, *, recursive: bool, config: dict) -> dict:
+    # a copy (that the caller may modify) with the subdirectories stored separately loaded if recursive,
+    # or with empty subdirectories if not recursive
+    if not dd:
+        return {}
+    if not recursive:
+        return dict(files=deepcopy(dd['files']), dirs=dict([(dname, {}) for dname in dd['dirs']]))
+    ret: dict = dict(files=deepcopy(dd['files']), dirs=dict())
+    for dname, subdir in dd['dirs'].items():
+        if _is_subdir_ref(subdir):
+            hash1, algorithm1 = _get_hash_of_file_entry(subdir)
+            assert (hash1 is not None) and (algorithm1 is not None)
+            x = _lookup_dir_object_path(algorithm=algorithm1, hash=hash1, path='', config=config)
+            if x is None:
+                raise Exception('Unable to load directory object for subdirectory: {}'.format(dname))
+            subdir = x[1]
+        ret['dirs'][dname] = _copy_dir_object(subdir, recursive=True, config=config)
+    return ret
+
 def _compute_local_file_hash(path: str, *, algorithm: str, config: dict) -> Union[str, None]:
-    return _hash_caches[algorithm].computeFileHash(path)
+    return _hash_caches[algorithm].computeFileHash(path, also_compute=config.get('extra_hash_algorithms', None))
+
+def _ingest_transfer_strategy(config: dict) -> str:
+    if config['use_hard_links']:
+        return 'link'
+    return config['transfer_strategy']
 
 def _store_local_file_in_cache(path: str, *, hash: str, algorithm: str, config: dict) -> None:
-    _, hash2 = _hash_caches[algorithm].copyFileToCache(path, use_hard_links=config['use_hard_links'], _known_hash=hash)
+    _, hash2 = _hash_caches[algorithm].copyFileToCache(path, _known_hash=hash, strategy=_ingest_transfer_strategy(config))
     if hash2 is None:
         raise Exception('Unable to store local file in cache: {}'.format(path))
 
+def _is_local_file_in_cache(path: str, *, algorithm: str, config: dict) -> bool:
+    # only uses the hash if it is already known (from the stat record)
+    hash0 = _hash_caches[algorithm].computeFileHash(path, _cache_only=True)
+    if hash0 is None:
+        return False
+    return _hash_caches[algorithm].hasFileInCache(hash0)
+
 def _find_file_locally(path: str, *, config: dict, hash_only=False) -> Tuple[Union[str, None], Union[str, None], Union[str, None]]:
     if _is_hash_url(path):
         hash0, algorithm = _determine_file_hash_from_url(path, config=config)
@@ -709,20 +1338,43 @@ def _check_remote_file(hash_url: str, *, config: dict) -> Tuple[Union[str, None]
             # This is an empty file, we handle it differently because the server has trouble
             return None, algorithm, hash0, 0
             
-        url_check: str = _form_check_url(hash=hash0, algorithm=algorithm, config=config)
-        check_resp: dict = _http_get_json(url_check, use_cache_on_found=True)
-        if not check_resp['success']:
-            print('Warning: Problem checking for file: ' + check_resp['error'])
-            return None, None, None, None
-        if check_resp['found']:
+        check = _lookup_remote_check(algorithm=algorithm, hash=hash0, config=config)
+        if check is None:
+            url_check: str = _form_check_url(hash=hash0, algorithm=algorithm, config=config)
+            check_resp: dict = _http_get_json(url_check, use_cache_on_found=True)
+            if not check_resp['success']:
+                print('Warning: Problem checking for file: ' + check_resp['error'])
+                return None, None, None, None
+            check = (check_resp['found'], check_resp.get('size', None))
+            _record_remote_check(algorithm=algorithm, hash=hash0, found=check[0], size=check[1], config=config)
+        if check[0]:
             url_download = _form_download_url(hash=hash0, algorithm=algorithm, config=config)
-            size = check_resp['size']
+            size = check[1]
             return url_download, algorithm, hash0, size
         else:
             return None, None, None, None
     else:
         raise Exception('Unexpected')
 
+def _lookup_remote_check(*, algorithm: str, hash: str, config: dict) -> Union[Tuple[bool, Optional[int]], None]:
+    # (found, size) from a recent check for the file on the server of config['fr'] (see remote_check_ttl), if any
+    fr = config['fr']
+    try:
+        return _hash_caches[algorithm].hashDatabase().lookupRemoteCheck(
+            url=fr['url'], channel=fr['channel'], algorithm=algorithm, hash=hash,
+            max_age_found=config['remote_check_ttl'], max_age_not_found=config['remote_check_negative_ttl']
+        )
+    except Exception as e:
+        print('Warning: problem reading remote check from hash database: {}'.format(str(e)))
+        return None
+
+def _record_remote_check(*, algorithm: str, hash: str, found: bool, size: Optional[int], config: dict) -> None:
+    fr = config['fr']
+    try:
+        _hash_caches[algorithm].hashDatabase().recordRemoteCheck(url=fr['url'], channel=fr['channel'], algorithm=algorithm, hash=hash, found=found, size=size)
+    except Exception as e:
+        print('Warning: problem recording remote check in hash database: {}'.format(str(e)))
+
 def _get_password(x):
     if type(x) == str:
         return x
@@ -773,7 +1425,20 @@ def _form_upload_url(*, algorithm: str, hash: str, config: dict) -> str:
     return '{}/set/{}/{}?channel={}&signature={}'.format(url, algorithm, hash, channel, signature)
 
 def _upload_local_file(path: str, *, hash: str, algorithm: str, config: dict) -> None:
-    size0 = os.path.getsize(path)
+    _upload_to_remote(path=path, data=None, hash=hash, algorithm=algorithm, config=config)
+
+def _upload_data(data: bytes, *, hash: str, algorithm: str, config: dict) -> None:
+    _upload_to_remote(path=None, data=data, hash=hash, algorithm=algorithm, config=config)
+
+def _upload_to_remote(*, path: Optional[str], data: Optional[bytes], hash: str, algorithm: str, config: dict) -> None:
+    # exactly one of path and data is given
+    if data is not None:
+        size0 = len(data)
+        label = '<{} in memory>'.format(_format_file_size(size0))
+    else:
+        assert path is not None
+        size0 = os.path.getsize(path)
+        label = path
     if size0 == 0:
         # don't upload an empty file. The server cannot handle it - and we'll just take care of this case separately
         return
@@ -784,15 +1449,18 @@ def _upload_local_file(path: str, *, hash: str, algorithm: str, config: dict) ->
     if url_ch is not None:
         # already on the remote server
         if size_ch != size0:
-            raise Exception('Unexpected: size of file on remote server does not match local file {} - {} <> {}'.format(path, size_ch, size0))
+            raise Exception('Unexpected: size of file on remote server does not match local file {} - {} <> {}'.format(label, size_ch, size0))
         return
 
     url0 = _form_upload_url(algorithm=algorithm, hash=hash, config=config)
     if size0 > 10000:
-        print('Uploading to kachery --- ({}): {} -> {}'.format(_format_file_size(size0), path, url0))
+        print('Uploading to kachery --- ({}): {} -> {}'.format(_format_file_size(size0), label, url0))
 
     timer = time.time()
-    resp_obj = _http_post_file_data(url0, path)
+    if data is not None:
+        resp_obj = _http_post_data(url0, data)
+    else:
+        resp_obj = _http_post_file_data(url0, path)
     elapsed = time.time() - timer
 
     if size0 > 10000:
@@ -801,39 +1469,27 @@ def _upload_local_file(path: str, *, hash: str, algorithm: str, config: dict) ->
 
     if not resp_obj.get('success', False):
         raise Exception('Problem posting file data: ' + resp_obj.get('error', ''))
+    # replaces a recorded negative check
+    _record_remote_check(algorithm=algorithm, hash=hash, found=True, size=size0, config=config2)
 
 def _determine_file_hash_from_url(url: str, *, config: dict) -> Tuple[Union[str, None], Union[str, None]]:
     protocol, algorithm, hash0, additional_path = _parse_kachery_url(url)
     if not protocol.endswith('dir'):
         return hash0, algorithm
-    dd = load_object('{}://{}'.format(algorithm, hash0))
-    if dd is None:
+    x = _lookup_dir_object_path(algorithm=algorithm, hash=hash0, path=additional_path, config=config)
+    if (x is None) or (x[0] != 'file'):
         return None, None
-    if additional_path:
-        list0 = additional_path.split('/')
-    else:
-        list0 = []
-    ii = 0
-    while ii < len(list0):
-        assert dd is not None
-        name0 = list0[ii]
-        if name0 in dd['dirs']:
-            dd = dd['dirs'][name0]
-        elif name0 in dd['files']:
-            if ii + 1 == len(list0):
-                hash1 = None
-                algorithm1 = None
-                for alg in ['sha1', 'md5']:
-                    if alg in dd['files'][name0]:
-                        hash1 = dd['files'][name0][alg]
-                        algorithm1 = alg
-                return hash1, algorithm1
-            else:
-                return None, None
-        else:
-            return None, None
-        ii = ii + 1
-    return None, None
+    return _get_hash_of_file_entry(x[1])
+
+def _get_hash_of_file_entry(entry: dict) -> Tuple[Union[str, None], Union[str, None]]:
+    # the (hash, algorithm) of a file in a directory object
+    hash1 = None
+    algorithm1 = None
+    for alg in ['sha1', 'md5']:
+        if alg in entry:
+            hash1 = entry[alg]
+            algorithm1 = alg
+    return hash1, algorithm1
 
 def _parse_kachery_url(url: str) -> Tuple[str, str, str, str]:
     listA = url.split('?')
@@ -880,7 +1536,8 @@ def _http_get_json(url: str, use_cache_on_found: bool=False, verbose: Optional[b
     if verbose:
         print('_http_get_json::: ' + url)
     try:
-        req = request.urlopen(url)
+        req = http_get(url)
+        req.raise_for_status()
     except:
         if len(retry_delays) > 0:
             print('Retrying http request in {} sec: {}'.format(
@@ -890,7 +1547,7 @@ def _http_get_json(url: str, use_cache_on_found: bool=False, verbose: Optional[b
         else:
             return dict(success=False, error='Unable to open url: ' + url)
     try:
-        ret = json.load(req)
+        ret = req.json()
     except:
         return dict(success=False, error='Unable to load json from url: ' + url)
     if verbose:
@@ -903,6 +1560,8 @@ def _http_get_json(url: str, use_cache_on_found: bool=False, verbose: Optional[b
 
 def reset():
     setattr(_http_get_json, 'cache', dict())
+    _memo_cache.clear()
+    _dir_cache.clear()
 
 reset()
 
@@ -930,11 +1589,7 @@ def _http_post_file_data(url: str, fname: str, verbose: Optional[bool]=None) ->
         print('_http_post_file_data::: ' + fname)
     with open(fname, 'rb') as f:
         try:
-            import requests
-        except:
-            raise Exception('Error importing requests')
-        try:
-            req = requests.post(url, data=f)
+            req = http_post(url, data=f)
         except:
             raise Exception('Error posting file data.')
     if req.status_code != 200:
@@ -946,17 +1601,32 @@ def _http_post_file_data(url: str, fname: str, verbose: Optional[bool]=None) ->
         print('Elapsed time for _http_post_file_Data: {}'.format(time.time() - timer))
     return json.loads(req.content)
 
-def _http_post_json(url: str, data: dict, verbose: Optional[bool]=None) -> dict:
+def _http_post_data(url: str, data: bytes, verbose: Optional[bool]=None) -> dict:
     timer = time.time()
     if verbose is None:
         verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
     if verbose:
-        print('_http_post_json::: ' + url)
+        print('_http_post_data::: {} bytes'.format(len(data)))
     try:
-        import requests
+        req = http_post(url, data=data)
     except:
-        raise Exception('Error importing requests *')
-    req = requests.post(url, json=data)
+        raise Exception('Error posting data.')
+    if req.status_code != 200:
+        return dict(
+            success=False,
+            error='Error posting data: {} {}'.format(req.status_code, req.content.decode('utf-8'))
+        )
+    if verbose:
+        print('Elapsed time for _http_post_data: {}'.format(time.time() - timer))
+    return json.loads(req.content)
+
+def _http_post_json(url: str, data: dict, verbose: Optional[bool]=None) -> dict:
+    timer = time.time()
+    if verbose is None:
+        verbose = (os.environ.get('HTTP_VERBOSE', '') == 'TRUE')
+    if verbose:
+        print('_http_post_json::: ' + url)
+    req = http_post(url, json=data)
     if req.status_code != 200:
         return dict(
             success=False,
@@ -967,41 +1637,136 @@ def _http_post_json(url: str, data: dict, verbose: Optional[bool]=None) -> dict:
     return json.loads(req.content)
 
 def _read_file_system_dir(path: str, *, recursive: bool, include_hashes: bool, store_files: bool, git_annex_mode: bool, config: dict) -> Union[dict, None]:
+    # The directory is walked in this thread while the files are hashed (and, with store_files, put in
+    # the cache in the same read) by a pool of threads. Uploads go to a second pool so that hashing
+    # goes on while waiting for the network. Both pools take at most a few files per worker at a time,
+    # so that the walk does not run far ahead. The directory object does not depend on the order in
+    # which the files are processed, since its entries are created by the walk.
+    if (not include_hashes) and (not store_files):
+        return _scan_file_system_dir(path, recursive=recursive, git_annex_mode=git_annex_mode, on_file=None)
+    algorithm = config['algorithm']
+    upload = (config['to']['url'] is not None) and (not git_annex_mode)
+    num_workers = max(1, config['num_ingest_workers'])
+    hash_slots = threading.BoundedSemaphore(4 * num_workers)
+    upload_slots = threading.BoundedSemaphore(4 * num_workers)
+    progress = _IngestProgress(label=path, action='Stored' if store_files else 'Hashed', always_report=store_files)
+    errors: List[Exception] = []
+
+    def upload_file(path0: str, hash0: str, manifest0: Union[dict, None]) -> None:
+        try:
+            if upload:
+                _upload_local_file(path0, algorithm=algorithm, hash=hash0, config=config)
+            # stores the manifest (like store_file)
+            _form_stored_file_uri(algorithm=algorithm, hash=hash0, basename=os.path.basename(path0), manifest=manifest0, config=config)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            upload_slots.release()
+
+    def process_file(file0: dict, path0: str) -> None:
+        try:
+            if store_files:
+                hash0, manifest0 = _store_file_locally(path0, no_manifest=False, config=config)
+                if upload or (manifest0 is not None):
+                    upload_slots.acquire()
+                    upload_executor.submit(upload_file, path0, hash0, manifest0)
+            else:
+                hash0 = _compute_local_file_hash(path0, algorithm=algorithm, config=config)
+            if include_hashes:
+                file0[algorithm] = hash0
+            progress.addFile(file0['size'])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            hash_slots.release()
+
+    def on_file(file0: dict, path0: str) -> None:
+        if errors:
+            raise errors[0]
+        hash_slots.acquire()
+        hash_executor.submit(process_file, file0, path0)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as upload_executor:
+        with ThreadPoolExecutor(max_workers=num_workers) as hash_executor:
+            ret = _scan_file_system_dir(path, recursive=recursive, git_annex_mode=git_annex_mode, on_file=on_file)
+    if errors:
+        raise errors[0]
+    progress.finish()
+    return ret
+
+def _scan_file_system_dir(path: str, *, recursive: bool, git_annex_mode: bool, on_file) -> dict:
+    # on_file(file_entry, path) is called for each regular file (the entry only has the size)
     ret: dict = dict(
         files={},
         dirs={}
     )
-    algorithm = config['algorithm']
-    list0 = os.listdir(path)
-    for name0 in list0:
-        path0 = path + '/' + name0
-        if git_annex_mode and os.path.islink(path0) and ('.git/annex/objects' in os.path.realpath(path0)):
-            hash1, algorithm1, size1 = _get_info_from_git_annex_link(path0)
-            ret['files'][name0] = dict(
-                size=size1
-            )
-            ret['files'][name0][algorithm1] = hash1
-        elif os.path.isfile(path0):
-            ret['files'][name0] = dict(
-                size=os.path.getsize(path0)
-            )
-            if include_hashes:
-                hash1b = _compute_local_file_hash(path0, algorithm=algorithm, config=config)
-                ret['files'][name0][algorithm] = hash1b
-            if store_files:
-                store_file(path0, git_annex_mode=git_annex_mode, config=config)
-        elif os.path.isdir(path0):
-            include = True
-            if git_annex_mode:
-                if name0 in ['.git', '.datalad']:
-                    include = False
-            if include:
-                ret['dirs'][name0] = {}
-                if recursive:
-                    ret['dirs'][name0] = _read_file_system_dir(
-                        path=path0, recursive=recursive, include_hashes=include_hashes, store_files=store_files, git_annex_mode=git_annex_mode, config=config)
+    subdir_names = []
+    # in the same order as os.listdir, so that the directory object is the same as before
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name0 = entry.name
+            path0 = path + '/' + name0
+            if git_annex_mode and entry.is_symlink() and ('.git/annex/objects' in os.path.realpath(path0)):
+                hash1, algorithm1, size1 = _get_info_from_git_annex_link(path0)
+                ret['files'][name0] = dict(
+                    size=size1
+                )
+                ret['files'][name0][algorithm1] = hash1
+            elif entry.is_file():
+                ret['files'][name0] = dict(
+                    size=entry.stat().st_size
+                )
+                if on_file is not None:
+                    on_file(ret['files'][name0], path0)
+            elif entry.is_dir():
+                include = True
+                if git_annex_mode:
+                    if name0 in ['.git', '.datalad']:
+                        include = False
+                if include:
+                    ret['dirs'][name0] = {}
+                    if recursive:
+                        subdir_names.append(name0)
+    # after closing the listing, so that the number of open directories does not grow with the depth
+    for name0 in subdir_names:
+        ret['dirs'][name0] = _scan_file_system_dir(path + '/' + name0, recursive=recursive, git_annex_mode=git_annex_mode, on_file=on_file)
     return ret
 
+class _IngestProgress:
+    def __init__(self, *, label: str, action: str, always_report: bool, interval: float=10):
+        # prints the number of files, bytes and the throughput every interval seconds, and at the end
+        # (unless it took less than interval and always_report is False)
+        self._label = label
+        self._action = action
+        self._always_report = always_report
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._timer = time.time()
+        self._last_report = self._timer
+        self._num_files = 0
+        self._num_bytes = 0
+
+    def addFile(self, size: int) -> None:
+        with self._lock:
+            self._num_files = self._num_files + 1
+            self._num_bytes = self._num_bytes + size
+            if time.time() - self._last_report < self._interval:
+                return
+            self._last_report = time.time()
+            self._report()
+
+    def finish(self) -> None:
+        with self._lock:
+            if self._always_report or (time.time() - self._timer >= self._interval):
+                self._report()
+
+    def _report(self) -> None:
+        elapsed = time.time() - self._timer
+        print('{} {} files ({}) from {} in {:.1f} sec ({}/sec)'.format(
+            self._action, self._num_files, _format_file_size(self._num_bytes), self._label, elapsed,
+            _format_file_size(int(self._num_bytes / max(elapsed, 1e-6)))
+        ))
+
 def _get_info_from_git_annex_link(path) -> Tuple[str, str, int]:
     path1 = os.path.realpath(path)
     # Example: /home/magland/data/najafi-2018-nwb/.git/annex/objects/Gx/pw/MD5E-s167484154--c8bc43bb1868301737797b09266c01a1.mat/MD5E-s167484154--c8bc43bb1868301737797b09266c01a1.mat
@@ -1048,23 +1813,22 @@ def _load_bytes_from_remote_file(*, url: str, config: dict, size: int, start: Un
     if start == end:
         return bytes()
     headers = {
-        'Range': 'bytes={}-{}'.format(start, end-1)
+        'Range': 'bytes={}-{}'.format(start, end-1),
+        # so that the range is of the file itself, not of a compressed representation
+        'Accept-Encoding': 'identity'
     }
     bb = io.BytesIO()
     timer = time.time()
     if (end - start > 10000) and (not write_to_stdout):
         print('Downloading {} of {} (bytes {}-{})'.format(_format_file_size(end - start), url, start, end))
-    try:
-        import requests
-    except:
-        raise Exception('Error importing requests **')
-    response = requests.get(url, headers=headers, stream=True)
-    for chunk in response.iter_content(chunk_size=5120):
-        if chunk:  # filter out keep-alive new chunks
-            if write_to_stdout:
-                sys.stdout.buffer.write(chunk)
-            else:
-                bb.write(chunk)
+    with http_get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=hash_block_size()):
+            if chunk:  # filter out keep-alive new chunks
+                if write_to_stdout:
+                    sys.stdout.buffer.write(chunk)
+                else:
+                    bb.write(chunk)
     elapsed = time.time() - timer
     if (end - start > 10000) and (not write_to_stdout):
         print('Downloaded {} in {} sec from {}'.format(_format_file_size(end - start), elapsed, url))
@@ -1,3 +1,4 @@
+import os
 import sys
 _win32 = (sys.platform == 'win32')
 if _win32:
@@ -43,38 +44,87 @@ class FileLock():
         self._exclusive = exclusive
 
     def __enter__(self) -> None:
+        self.acquire()
+
+    def __exit__(self, type, value: object, traceback) -> None:
+        self.release()
+        return None
+
+    def acquire(self, blocking: bool=True) -> bool:
+        """Acquire the lock
+
+        A lock file may be unlinked by whoever holds it (see
+        PartialFile.remove and LocalHashCache.cleanup), so once the lock is
+        obtained, it is checked that the path still refers to the locked
+        file; otherwise the lock is retried on the new file.
+
+        Parameters
+        ----------
+        blocking : bool, optional
+            Whether to wait for the lock, by default True
+
+        Returns
+        -------
+        bool
+            True if the lock was acquired (always the case when blocking)
+        """
         if self._disable_lock:
-            return
-        self._file = open(self._path, 'w+')
+            return True
         num_tries = 0
         while True:
+            self._file = open(self._path, 'a')
             try:
-                if self._exclusive:
-                    if _win32:
-                        portalocker.lock(self._file, portalocker.LOCK_EX | portalocker.LOCK_NB)
-                    else:
-                        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)                    
-                else:
-                    if _win32:
-                        portalocker.lock(self._file, portalocker.LOCK_SH | portalocker.LOCK_NB)
-                    else:
-                        fcntl.flock(self._file, fcntl.LOCK_SH | fcntl.LOCK_NB)                    
-                if num_tries > 10:
-                    print('Locked file {} after {} tries (exclusive={})...'.format(self._path, num_tries, self._exclusive))
-                break
+                _lock(self._file, exclusive=self._exclusive)
             except IOError as e:
-                if e.errno != errno.EAGAIN:
+                self._file.close()
+                self._file = None
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
                     raise
-                else:
-                    num_tries = num_tries + 1
-                    time.sleep(random.uniform(0, 0.1))
+                if not blocking:
+                    return False
+                num_tries = num_tries + 1
+                time.sleep(random.uniform(0, 0.1))
+                continue
+            if _win32 or _is_same_file(self._file, self._path):
+                break
+            # unlinked (or replaced) by the previous holder
+            _unlock(self._file)
+            self._file.close()
+            self._file = None
+        if num_tries > 10:
+            print('Locked file {} after {} tries (exclusive={})...'.format(self._path, num_tries, self._exclusive))
+        return True
 
-    def __exit__(self, type, value: object, traceback) -> None:
+    def release(self) -> None:
         if self._disable_lock:
             return
         if self._file is not None:
-            if _win32:
-                portalocker.unlock(self._file)
-            else:
-                fcntl.flock(self._file, fcntl.LOCK_UN)            
+            _unlock(self._file)
             self._file.close()
+            self._file = None
+
+def _lock(f: IO, *, exclusive: bool) -> None:
+    if exclusive:
+        if _win32:
+            portalocker.lock(f, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        if _win32:
+            portalocker.lock(f, portalocker.LOCK_SH | portalocker.LOCK_NB)
+        else:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+def _unlock(f: IO) -> None:
+    if _win32:
+        portalocker.unlock(f)
+    else:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def _is_same_file(f: IO, path: str) -> bool:
+    try:
+        stat0 = os.stat(path)
+    except OSError:
+        return False
+    stat1 = os.fstat(f.fileno())
+    return (stat0.st_ino == stat1.st_ino) and (stat0.st_dev == stat1.st_dev)
@@ -0,0 +1,446 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import atexit
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+
+_ALGORITHMS = ['sha1', 'md5']
+_BATCH_SIZE = 500
+_ACCESS_FLUSH_INTERVAL = 10
+
+class HashDatabase:
+    def __init__(self, path: str):
+        """An indexed store of the hashes of files outside the cache
+
+        Replaces the per-file .record.json and per-hash .hints.json files.
+        Each row is keyed on the path of a file and is only trusted when the (size, ino, mtime, ctime)
+        of the file still match the stat values recorded alongside the hashes.
+        An index on the hash columns makes it double as the hash -> external
+        path index used by LocalHashCache.findFile.
+        The database is an SQLite file in WAL mode so that any number of
+        processes can read concurrently while one of them writes.
+        It also holds the access times and pins of the cached files and the
+        results of recent checks for files on remote servers.
+
+        Parameters
+        ----------
+        path : str
+            Path to the sqlite file
+        """
+        self._path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._migrated_directories: set = set()
+        self._pending_accesses: Dict[tuple, list] = dict()
+        self._last_access_flush = time.time()
+        # (url, channel, algorithm, hash) -> (found, size, check time)
+        self._pending_remote_checks: Dict[tuple, tuple] = dict()
+        # (timer, pid): flushes the pending accesses and remote checks of a process that goes quiet
+        self._flush_timer: Optional[Tuple[threading.Timer, int]] = None
+        atexit.register(self.flush)
+
+    def path(self) -> str:
+        return self._path
+
+    def lookupHashes(self, stat_objects: List[Optional[dict]], *, algorithm: str) -> List[Optional[str]]:
+        _check_algorithm(algorithm)
+        return [r.get(algorithm, None) if r is not None else None for r in self.lookupRecords(stat_objects)]
+
+    def lookupRecords(self, stat_objects: List[Optional[dict]]) -> List[Optional[Dict[str, str]]]:
+        # for each stat object, all the digests recorded for the file (or None if its stat has changed)
+        ret: List[Optional[Dict[str, str]]] = [None for _ in stat_objects]
+        paths = list(set([s['path'] for s in stat_objects if s is not None]))
+        rows: Dict[str, Any] = dict()
+        conn = self._connection()
+        for batch in _batches(paths):
+            cursor = conn.execute(
+                'SELECT path, size, ino, mtime, ctime, {} FROM file_hashes WHERE path IN ({})'.format(', '.join(_ALGORITHMS), ','.join('?' * len(batch))),
+                batch
+            )
+            for row in cursor.fetchall():
+                rows[row[0]] = row
+        for ii, s in enumerate(stat_objects):
+            if s is None:
+                continue
+            row = rows.get(s['path'], None)
+            if row is not None and _row_matches_stat(row, s):
+                ret[ii] = dict([(alg, row[5 + jj]) for jj, alg in enumerate(_ALGORITHMS) if row[5 + jj]])
+        return ret
+
+    def findStatObjects(self, hash: str, *, algorithm: str) -> List[dict]:
+        # reverse lookup (served by an index on the hash columns): stat objects of all files recorded with this hash
+        _check_algorithm(algorithm)
+        conn = self._connection()
+        cursor = conn.execute('SELECT path, size, ino, mtime, ctime FROM file_hashes WHERE {} = ?'.format(algorithm), (hash,))
+        return [_stat_object_from_row(row) for row in cursor.fetchall()]
+
+    def removePaths(self, paths: Iterable[str]) -> None:
+        paths = list(paths)
+        if not paths:
+            return
+        conn = self._connection()
+        with self._transaction(conn):
+            for batch in _batches(paths):
+                conn.execute('DELETE FROM file_hashes WHERE path IN ({})'.format(','.join('?' * len(batch))), batch)
+
+    def pruneStale(self) -> int:
+        # remove every record whose file no longer exists or has changed, returns the number removed
+        conn = self._connection()
+        stale_paths = []
+        for row in conn.execute('SELECT path, size, ino, mtime, ctime FROM file_hashes').fetchall():
+            if not _stat_object_is_current(_stat_object_from_row(row)):
+                stale_paths.append(row[0])
+        self.removePaths(stale_paths)
+        return len(stale_paths)
+
+    def insertHashes(self, records: Iterable[dict]) -> None:
+        # Each record is dict(stat=<stat object>, sha1=..., md5=...) with any subset of the algorithms.
+        # Digests already stored for an unchanged stat are kept, so records for different
+        # algorithms accumulate on the same row.
+        values = []
+        for r in records:
+            s = r['stat']
+            values.append((s['path'], s['size'], s['ino'], s['mtime'], s['ctime'], r.get('sha1', None), r.get('md5', None)))
+        if not values:
+            return
+        conn = self._connection()
+        with self._transaction(conn):
+            conn.executemany(_UPSERT_SQL, values)
+
+    def recordAccess(self, hash: str, *, algorithm: str) -> None:
+        # accesses are buffered in memory and written in batches, at the latest
+        # _ACCESS_FLUSH_INTERVAL seconds later (by a timer, so that other processes see them)
+        key = (algorithm, hash)
+        with self._lock:
+            if key in self._pending_accesses:
+                self._pending_accesses[key][0] = time.time()
+                self._pending_accesses[key][1] += 1
+            else:
+                self._pending_accesses[key] = [time.time(), 1]
+            do_flush = (len(self._pending_accesses) >= _BATCH_SIZE) or (time.time() - self._last_access_flush > _ACCESS_FLUSH_INTERVAL)
+            if not do_flush:
+                self._schedule_flush()
+        if do_flush:
+            self.flushAccesses()
+
+    def flush(self) -> None:
+        # write all the buffered accesses and remote checks
+        with self._lock:
+            if (self._flush_timer is not None) and (self._flush_timer[1] == os.getpid()):
+                self._flush_timer[0].cancel()
+            self._flush_timer = None
+        self.flushAccesses()
+        self.flushRemoteChecks()
+
+    def flushAccesses(self) -> None:
+        with self._lock:
+            pending = self._pending_accesses
+            self._pending_accesses = dict()
+            self._last_access_flush = time.time()
+        if not pending:
+            return
+        values = [(k[0], k[1], v[0], v[1]) for k, v in pending.items()]
+        try:
+            conn = self._connection()
+            with self._transaction(conn):
+                conn.executemany(_ACCESS_UPSERT_SQL, values)
+        except Exception as e:
+            print('Warning: problem recording cache accesses in hash database: {} ({})'.format(self._path, str(e)))
+
+    def getAccesses(self, *, algorithm: str) -> Dict[str, Tuple[float, int]]:
+        # hash -> (last access time, access count)
+        self.flushAccesses()
+        conn = self._connection()
+        cursor = conn.execute('SELECT hash, last_access, access_count FROM cache_accesses WHERE algorithm = ?', (algorithm,))
+        return dict([(row[0], (row[1], row[2])) for row in cursor.fetchall()])
+
+    def removeAccesses(self, hashes: Iterable[str], *, algorithm: str) -> None:
+        hashes = list(hashes)
+        if not hashes:
+            return
+        conn = self._connection()
+        with self._transaction(conn):
+            for batch in _batches(hashes):
+                conn.execute('DELETE FROM cache_accesses WHERE algorithm = ? AND hash IN ({})'.format(','.join('?' * len(batch))), [algorithm] + batch)
+
+    def setPinned(self, hash: str, pinned: bool, *, algorithm: str) -> None:
+        _check_algorithm(algorithm)
+        conn = self._connection()
+        with self._transaction(conn):
+            if pinned:
+                conn.execute('INSERT OR IGNORE INTO pins (algorithm, hash) VALUES (?, ?)', (algorithm, hash))
+            else:
+                conn.execute('DELETE FROM pins WHERE algorithm = ? AND hash = ?', (algorithm, hash))
+
+    def getPinned(self, *, algorithm: str) -> List[str]:
+        conn = self._connection()
+        cursor = conn.execute('SELECT hash FROM pins WHERE algorithm = ?', (algorithm,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def lookupRemoteCheck(self, *, url: str, channel: Optional[str], algorithm: str, hash: str, max_age_found: float, max_age_not_found: float) -> Optional[Tuple[bool, Optional[int]]]:
+        # (found, size) from a check of at most the given age (in seconds), or None
+        key = (url, channel or '', algorithm, hash)
+        with self._lock:
+            row = self._pending_remote_checks.get(key, None)
+        if row is None:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT found, size, check_time FROM remote_checks WHERE url = ? AND channel = ? AND algorithm = ? AND hash = ?',
+                key
+            ).fetchone()
+        if row is None:
+            return None
+        found = bool(row[0])
+        max_age = max_age_found if found else max_age_not_found
+        if time.time() - row[2] > max_age:
+            return None
+        return found, row[1]
+
+    def recordRemoteCheck(self, *, url: str, channel: Optional[str], algorithm: str, hash: str, found: bool, size: Optional[int]) -> None:
+        # like the accesses, the results are buffered in memory and written in batches (see recordAccess),
+        # so that concurrent checks do not each take the write lock of the database
+        with self._lock:
+            self._pending_remote_checks[(url, channel or '', algorithm, hash)] = (1 if found else 0, size, time.time())
+            do_flush = len(self._pending_remote_checks) >= _BATCH_SIZE
+            if not do_flush:
+                self._schedule_flush()
+        if do_flush:
+            self.flushRemoteChecks()
+
+    def flushRemoteChecks(self) -> None:
+        with self._lock:
+            pending = self._pending_remote_checks
+            self._pending_remote_checks = dict()
+        if not pending:
+            return
+        values = [k + v for k, v in pending.items()]
+        try:
+            conn = self._connection()
+            with self._transaction(conn):
+                conn.executemany(_REMOTE_CHECK_UPSERT_SQL, values)
+        except Exception as e:
+            print('Warning: problem recording remote checks in hash database: {} ({})'.format(self._path, str(e)))
+
+    def pruneRemoteChecks(self, max_age: float) -> int:
+        # returns the number of checks removed
+        self.flushRemoteChecks()
+        conn = self._connection()
+        with self._transaction(conn):
+            cursor = conn.execute('DELETE FROM remote_checks WHERE check_time < ?', (time.time() - max_age,))
+        return cursor.rowcount
+
+    def ensureMigrated(self, directory: str) -> None:
+        if directory in self._migrated_directories:
+            return
+        with self._lock:
+            if directory in self._migrated_directories:
+                return
+            key = 'migrated_legacy_files:' + directory
+            conn = self._connection()
+            row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._migrate_legacy_files(directory)
+                with self._transaction(conn):
+                    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, '1'))
+            self._migrated_directories.add(directory)
+
+    def _migrate_legacy_files(self, directory: str) -> None:
+        # import the .record.json and .hints.json files written by older versions
+        # only entries that still match the file on disk are kept, since there
+        # may be several legacy records for the same path
+        if not os.path.isdir(directory):
+            return
+        records = []
+        num_migrated = 0
+        for dirpath, _, filenames in os.walk(directory):
+            for fname in filenames:
+                if fname.endswith('.record.json'):
+                    obj = _read_legacy_json_file(os.path.join(dirpath, fname))
+                    candidates = [obj] if obj is not None else []
+                elif fname.endswith('.hints.json'):
+                    obj = _read_legacy_json_file(os.path.join(dirpath, fname))
+                    candidates = obj.get('files', []) if isinstance(obj, dict) else []
+                else:
+                    continue
+                for c in candidates:
+                    r = _record_from_legacy_object(c)
+                    if r is not None and _stat_object_is_current(r['stat']):
+                        records.append(r)
+                if len(records) >= _BATCH_SIZE:
+                    self.insertHashes(records)
+                    num_migrated = num_migrated + len(records)
+                    records = []
+        self.insertHashes(records)
+        num_migrated = num_migrated + len(records)
+        if num_migrated > 0:
+            print('Migrated {} legacy .record.json/.hints.json entries into {}'.format(num_migrated, self._path))
+
+    def _schedule_flush(self) -> None:
+        # (called with self._lock held) a timer started before a fork does not run in the child
+        if (self._flush_timer is None) or (self._flush_timer[1] != os.getpid()):
+            timer = threading.Timer(_ACCESS_FLUSH_INTERVAL, self.flush)
+            timer.daemon = True
+            timer.start()
+            self._flush_timer = (timer, os.getpid())
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        dirname = os.path.dirname(self._path)
+        if dirname and not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except:
+                if not os.path.exists(dirname):
+                    raise Exception('Unable to make directory: ' + dirname)
+        conn = sqlite3.connect(self._path, timeout=60, isolation_level=None, check_same_thread=False)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            print('Warning: unable to enable WAL mode for hash database: ' + self._path)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction(conn):
+            for sql in _SCHEMA_SQL:
+                conn.execute(sql)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, conn: sqlite3.Connection):
+        return _Transaction(conn)
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+    def __enter__(self):
+        self._conn.execute('BEGIN IMMEDIATE')
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._conn.execute('COMMIT')
+        else:
+            self._conn.execute('ROLLBACK')
+
+_SCHEMA_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS file_hashes (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        ctime REAL NOT NULL,
+        sha1 TEXT,
+        md5 TEXT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS file_hashes_sha1 ON file_hashes (sha1)',
+    'CREATE INDEX IF NOT EXISTS file_hashes_md5 ON file_hashes (md5)',
+    '''
+    CREATE TABLE IF NOT EXISTS cache_accesses (
+        algorithm TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        last_access REAL NOT NULL,
+        access_count INTEGER NOT NULL,
+        PRIMARY KEY (algorithm, hash)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS pins (
+        algorithm TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (algorithm, hash)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS remote_checks (
+        url TEXT NOT NULL,
+        channel TEXT NOT NULL,
+        algorithm TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        found INTEGER NOT NULL,
+        size INTEGER,
+        check_time REAL NOT NULL,
+        PRIMARY KEY (url, channel, algorithm, hash)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    '''
+]
+
+_SAME_STAT_SQL = 'size = excluded.size AND ino = excluded.ino AND mtime = excluded.mtime AND ctime = excluded.ctime'
+
+_UPSERT_SQL = '''
+    INSERT INTO file_hashes (path, size, ino, mtime, ctime, sha1, md5) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(path) DO UPDATE SET
+        sha1 = CASE WHEN {same} THEN COALESCE(excluded.sha1, sha1) ELSE excluded.sha1 END,
+        md5 = CASE WHEN {same} THEN COALESCE(excluded.md5, md5) ELSE excluded.md5 END,
+        size = excluded.size,
+        ino = excluded.ino,
+        mtime = excluded.mtime,
+        ctime = excluded.ctime
+'''.format(same=_SAME_STAT_SQL)
+
+_ACCESS_UPSERT_SQL = '''
+    INSERT INTO cache_accesses (algorithm, hash, last_access, access_count) VALUES (?, ?, ?, ?)
+    ON CONFLICT(algorithm, hash) DO UPDATE SET
+        last_access = MAX(last_access, excluded.last_access),
+        access_count = access_count + excluded.access_count
+'''
+
+# a check does not replace a more recent one (e.g., written by another process)
+_REMOTE_CHECK_UPSERT_SQL = '''
+    INSERT INTO remote_checks (url, channel, algorithm, hash, found, size, check_time) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(url, channel, algorithm, hash) DO UPDATE SET
+        found = excluded.found,
+        size = excluded.size,
+        check_time = excluded.check_time
+    WHERE excluded.check_time > remote_checks.check_time
+'''
+
+def _row_matches_stat(row: tuple, stat_object: dict) -> bool:
+    return (row[1] == stat_object['size']) and (row[2] == stat_object['ino']) and (row[3] == stat_object['mtime']) and (row[4] == stat_object['ctime'])
+
+def _stat_object_from_row(row: tuple) -> dict:
+    return dict(path=row[0], size=row[1], ino=row[2], mtime=row[3], ctime=row[4])
+
+def _stat_object_is_current(stat_object: dict) -> bool:
+    try:
+        stat0 = os.stat(stat_object['path'])
+    except:
+        return False
+    return (stat0.st_size == stat_object['size']) and (stat0.st_ino == stat_object['ino']) and (stat0.st_mtime == stat_object['mtime']) and (stat0.st_ctime == stat_object['ctime'])
+
+def _read_legacy_json_file(path: str) -> Any:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except:
+        print('Warning: unable to read legacy json file during migration: ' + path)
+        return None
+
+def _record_from_legacy_object(obj: Any) -> Optional[dict]:
+    if (not isinstance(obj, dict)) or (not isinstance(obj.get('stat', None), dict)):
+        return None
+    stat0 = obj['stat']
+    for k in ['path', 'size', 'ino', 'mtime', 'ctime']:
+        if k not in stat0:
+            return None
+    ret: Dict[str, Any] = dict(stat=stat0)
+    for alg in _ALGORITHMS:
+        if obj.get(alg, None):
+            ret[alg] = obj[alg]
+    return ret
+
+def _check_algorithm(algorithm: str) -> None:
+    if algorithm not in _ALGORITHMS:
+        raise Exception('Unexpected algorithm: {}'.format(algorithm))
+
+def _batches(items: list) -> Iterable[list]:
+    for ii in range(0, len(items), _BATCH_SIZE):
+        yield items[ii:ii + _BATCH_SIZE]
@@ -2,21 +2,63 @@ import json
 import os
 import shutil
 import hashlib
-from shutil import copyfile
-from .steady_download_and_compute_hash import steady_download_and_compute_hash
+from ._transfer import transfer_file, try_transfer_file, check_transfer_strategy
+from .steady_download_and_compute_hash import steady_download_and_compute_hash, segmented_download_and_compute_hash, RangeRequestsNotSupported, DEFAULT_DOWNLOAD_SEGMENT_SIZE
 import random
 import time
+from .hashdatabase import HashDatabase, _stat_object_is_current
 from .filelock import FileLock
+from .partialfile import PartialFile
+from ._hashing import compute_file_hashes, StreamHasher, hash_block_size, advise_sequential
+import threading
 # import mtlogging
 from typing import Optional, List, Any, Dict, Tuple, Union
 
-# TODO: implement cleanup() for LocalHashCache
-# removing .record.json and .hints.json files that are no longer relevant
-
 _global = dict(
     printed_warning = False
 )
 
+_hash_databases: Dict[str, HashDatabase] = dict()
+_hash_databases_lock = threading.Lock()
+
+# path of the lock file -> [lock, number of users] (see _DownloadLock)
+_download_locks: Dict[str, list] = dict()
+_download_locks_lock = threading.Lock()
+
+class _DownloadLock:
+    def __init__(self, path: str):
+        # Serializes the downloads of a hash into its partial file: the threads of this process wait on an
+        # in-process lock, and other processes on a FileLock on path, which is unlinked on release
+        self._path = path
+        self._file_lock = FileLock(path, exclusive=True)
+
+    def __enter__(self) -> None:
+        with _download_locks_lock:
+            entry = _download_locks.setdefault(self._path, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            self._file_lock.acquire()
+        except:
+            self._release_entry()
+            raise
+
+    def __exit__(self, type, value: object, traceback) -> None:
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+        self._file_lock.release()
+        self._release_entry()
+
+    def _release_entry(self) -> None:
+        with _download_locks_lock:
+            entry = _download_locks[self._path]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _download_locks[self._path]
+
 class LocalHashCache:
     def __init__(self, *, algorithm):
         self._directory = None
@@ -53,6 +95,7 @@ class LocalHashCache:
             hash=hash, create=False)
         # if file is available return it
         if os.path.exists(path):
+            self.hashDatabase().recordAccess(hash, algorithm=self._algorithm)
             return path
 
         # check alternate location
@@ -63,33 +106,19 @@ class LocalHashCache:
         if os.path.exists(path_alt):
             return path_alt
 
-        hints_fname = path + '.hints.json'
-        # if path.hints.json exists then read it
-        if os.path.exists(hints_fname):
-            hints = _read_json_file(hints_fname, delete_on_error=True)
-            if hints and ('files' in hints):
-                files = hints['files']
-                matching_files = []
-                for file in files:
-                    path0 = file['stat']['path']
-                    if os.path.exists(path0) and os.path.isfile(path0):
-                        stat_obj0 = _get_stat_object(path0)
-                        if stat_obj0:
-                            if (_stat_objects_match(stat_obj0, file['stat'])):
-                                matching_files.append(file)
-                if matching_files:
-                    hints['files'] = matching_files
-                    try:
-                        _write_json_file(hints, hints_fname)
-                    except:
-                        print('Warning: problem writing hints file: ' + hints_fname)
-                    return matching_files[0]['stat']['path']
-                else:
-                    _safe_remove_file(hints_fname)
-            else:
-                print(
-                    'Warning: failed to load hints json file, or invalid file. Removing: ' + hints_fname)
-                _safe_remove_file(hints_fname)
+        # check the files outside the cache that were recorded with this hash
+        db = self.hashDatabase()
+        found_path = None
+        stale_paths = []
+        for stat_obj0 in db.findStatObjects(hash, algorithm=self._algorithm):
+            if _stat_object_is_current(stat_obj0):
+                found_path = stat_obj0['path']
+                break
+            stale_paths.append(stat_obj0['path'])
+        db.removePaths(stale_paths)
+        if found_path is not None:
+            return found_path
+
         kachery_bootstrap_mountaintools_dir = os.getenv('KACHERY_BOOTSTRAP_MOUNTAINTOOLS_DIR', None)
         if kachery_bootstrap_mountaintools_dir and self._algorithm == 'sha1':
             path_mt = os.path.join(kachery_bootstrap_mountaintools_dir, hash[0], hash[1:3], hash)
@@ -110,23 +139,101 @@ class LocalHashCache:
     
     def store_file_by_code(self, *, code: str, data: bytes) -> str:
         path = self._get_path_by_code(code=code, create=True)
-        with open(path, 'wb') as f:
+        # write to a temporary file first so that a concurrent reader never sees a partial file
+        path_tmp = path + '.tmp.' + _random_string(6)
+        with open(path_tmp, 'wb') as f:
             f.write(data)
+        _rename_file(path_tmp, path, remove_if_exists=False)
+        if os.path.exists(path_tmp):
+            # it was already there
+            _safe_remove_file(path_tmp)
         return path
 
-    def downloadFile(self, url: str, hash: str, target_path: Optional[str]=None, size: Optional[int]=None, verbose: bool=False, show_progress: bool=False) -> Optional[str]:
-        alternate_target_path = False
+    def partialFile(self, hash: str, *, size: int, create: bool=False) -> PartialFile:
+        # the partially downloaded file <aa>/<bb>/<cc>/<hash>.partial (see PartialFile)
+        return PartialFile(self._get_path(hash, create=create) + '.partial', size=size)
+
+    def readFileRange(self, hash: str, *, size: int, start: int, end: int) -> Optional[bytes]:
+        # from the partially downloaded file, or None if the range is not all there
+        pf = self.partialFile(hash, size=size)
+        data = pf.read(start, end)
+        if data is not None:
+            self.hashDatabase().recordAccess(hash, algorithm=self._algorithm)
+        return data
+
+    def writeFileRange(self, hash: str, *, size: int, start: int, data: bytes) -> Optional[str]:
+        """Store a range of a remote file in its partially downloaded file
+
+        Once all the ranges are present, the content is verified and the file
+        is promoted to the regular cache entry for the hash.
+
+        Returns
+        -------
+        Optional[str]
+            The path of the cached file if this completed it, otherwise None
+        """
+        pf = self.partialFile(hash, size=size, create=True)
+        if not pf.write(start, data):
+            return None
+        path0 = self._get_path(hash, create=True)
+        # not while a download of the hash is using the partial file (see downloadFile)
+        with _DownloadLock(path0 + '.download.lock'):
+            if os.path.exists(path0):
+                # promoted by that download
+                return path0
+            hash2 = _compute_file_hash(pf.path(), algorithm=self._algorithm)
+            if hash2 != hash:
+                print('Warning: unexpected {} of completed partial file {}: {} <> {}'.format(self._algorithm, pf.path(), hash2, hash))
+                pf.remove()
+                return None
+            _rename_file(pf.path(), path0, remove_if_exists=False)
+            pf.remove()
+        return path0
+
+    def downloadFile(self, url: str, hash: str, target_path: Optional[str]=None, size: Optional[int]=None, verbose: bool=False, show_progress: bool=False, num_workers: int=1, segment_size: Optional[int]=None, manifest: Optional[dict]=None) -> Optional[str]:
+        # a file of known size larger than segment_size is downloaded as byte ranges, num_workers at a time,
+        # into the partially downloaded file for the hash, so that an interrupted download is resumed by
+        # the next attempt (see segmented_download_and_compute_hash). With a (sha1) manifest, the ranges are
+        # its chunks, and each of them is verified.
+        if manifest is not None:
+            if (self._algorithm != 'sha1') or (manifest.get('sha1', None) != hash) or (size is None) or (not _is_valid_manifest(manifest, size=size)):
+                print('Warning: ignoring manifest that does not match the file: {}'.format(url))
+                manifest = None
+        path0 = self._get_path(hash=hash, create=True)
         if target_path is None:
-            target_path = self._get_path(hash=hash, create=True)
-        else:
-            alternate_target_path = True
+            target_path = path0
 
-        path_tmp = target_path + '.downloading.' + _random_string(6)
         if (verbose) or (show_progress) or ((size is not None) and (size > 10000)):
             print(
                 'Downloading file --- ({}): {} -> {}'.format(_format_file_size(size), url, target_path))
 
         timer = time.time()
+        if (size is not None) and ((manifest is not None) or (size > (segment_size or DEFAULT_DOWNLOAD_SEGMENT_SIZE))):
+            # all the downloads of the hash share its partial file, so they take turns, and the completed
+            # file goes into the cache, from where it is transferred to an alternate target path
+            try:
+                with _DownloadLock(path0 + '.download.lock'):
+                    if not os.path.exists(path0):
+                        self._segmented_download(url, hash, size=size, num_workers=num_workers, segment_size=segment_size, manifest=manifest)
+                segmented = True
+            except RangeRequestsNotSupported:
+                print('Warning: range requests not supported, downloading as a single stream: {}'.format(url))
+                segmented = False
+            if segmented:
+                if target_path != path0:
+                    path_tmp = target_path + '.copying.' + _random_string(6)
+                    try:
+                        transfer_file(path0, path_tmp, strategy='auto')
+                        _rename_file(path_tmp, target_path, remove_if_exists=True)
+                    finally:
+                        if os.path.exists(path_tmp):
+                            _safe_remove_file(path_tmp)
+                    self.reportFileHash(target_path, hash=hash)
+                if (verbose) or (show_progress) or (size > 10000):
+                    print('Downloaded file ({}) in {} sec.'.format(_format_file_size(size), time.time() - timer))
+                return target_path
+
+        path_tmp = target_path + '.downloading.' + _random_string(6)
         hash_b = steady_download_and_compute_hash(url=url, algorithm=self._algorithm, target_path=path_tmp)
         elapsed = time.time() - timer
 
@@ -142,7 +249,7 @@ class LocalHashCache:
             print(path_tmp)
             raise Exception(
                 'hash of downloaded file does not match expected {} {} <> {}'.format(url, hash_b, hash))
-        if alternate_target_path:
+        if target_path != path0:
             if os.path.exists(target_path):
                 _safe_remove_file(target_path)
             _rename_file(path_tmp, target_path, remove_if_exists=True)
@@ -158,6 +265,25 @@ class LocalHashCache:
 
         return target_path
 
+    def _segmented_download(self, url: str, hash: str, *, size: int, num_workers: int, segment_size: Optional[int], manifest: Optional[dict]) -> None:
+        # download into the partial file for the hash and move it into the cache (the caller holds the _DownloadLock)
+        pf = self.partialFile(hash, size=size, create=True)
+        num_bytes_present = pf.numBytesPresent()
+        if num_bytes_present > 0:
+            print('Resuming download ({} of {} present): {}'.format(_format_file_size(num_bytes_present), _format_file_size(size), url))
+        hash_b = segmented_download_and_compute_hash(url=url, algorithm=self._algorithm, partial_file=pf, segment_size=segment_size, num_workers=max(1, num_workers), manifest=manifest)
+        if hash_b != hash:
+            # do not resume from content that does not match
+            pf.remove()
+            raise Exception(
+                'hash of downloaded file does not match expected {} {} <> {}'.format(url, hash_b, hash))
+        if not pf.isComplete():
+            # the hash was computed from the downloaded bytes, but the file was removed in the meantime (e.g., by cleanup)
+            pf.remove()
+            raise Exception('Partially downloaded file was removed during the download: {}'.format(url))
+        _rename_file(pf.path(), self._get_path(hash, create=True), remove_if_exists=False)
+        pf.remove()
+
     def moveFileToCache(self, path: str) -> str:
         hash0 = self.computeFileHash(path)
         assert hash0 is not None
@@ -173,7 +299,10 @@ class LocalHashCache:
         return path0
 
     # @mtlogging.log()
-    def copyFileToCache(self, path: str, use_hard_links=False, _known_hash=None) -> Tuple[str, str]:
+    def copyFileToCache(self, path: str, use_hard_links=False, _known_hash=None, strategy: Optional[str]=None) -> Tuple[str, str]:
+        # strategy: see transfer_file (by default 'link' if use_hard_links, otherwise 'copy')
+        if strategy is None:
+            strategy = 'link' if use_hard_links else 'copy'
         if _known_hash is not None:
             hash0 = _known_hash
         else:
@@ -182,76 +311,363 @@ class LocalHashCache:
         path0 = self._get_path(hash0, create=True)
         if not os.path.exists(path0):
             tmp_path = path0 + '.copying.' + _random_string(6)
-            if use_hard_links:
-                os.link(path, tmp_path)
-            else:
-                copyfile(path, tmp_path)
+            transfer_file(path, tmp_path, strategy=strategy)
             _rename_file(tmp_path, path0, remove_if_exists=False)
         return path0, hash0
 
+    def ingestFile(self, path: str, *, also_compute: Optional[List[str]]=None, compute_manifest: bool=False, strategy: str='copy', num_hash_workers: int=1) -> Tuple[str, Dict[str, str], Optional[dict]]:
+        """Copy a file into the cache while hashing it, reading it at most once
+
+        With strategy 'copy' (or 'auto' when a reflink is not possible), the
+        file is streamed into a .copying. temporary file in the cache directory
+        while its digest(s) and (optionally) its sha1 manifest are computed.
+        With 'link', 'reflink' or 'copy_file_range' (or 'auto' when a reflink
+        works) the temporary file is made by transfer_file and the file is only
+        read if the hashes are not in its stat record or a manifest is needed.
+        Either way the temporary file is then renamed to its content address
+        and the hashes are recorded for the source file. With num_hash_workers
+        > 1, the chunks of the manifest are hashed on a pool of that many
+        threads from the buffers that are streamed (see StreamHasher).
+
+        Returns
+        -------
+        Tuple[str, Dict[str, str], Optional[dict]]
+            The path in the cache, the hashes and the manifest
+        """
+        check_transfer_strategy(strategy)
+        algorithms = [self._algorithm] + [alg for alg in (also_compute or []) if alg != self._algorithm]
+        if compute_manifest and 'sha1' not in algorithms:
+            algorithms.append('sha1')
+        path = os.path.abspath(path)
+        stat0 = _get_stat_object(path)
+        if stat0 is None:
+            raise Exception('Unable to stat file: {}'.format(path))
+        directory = self.directory()
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except:
+                if not os.path.exists(directory):
+                    raise Exception('Unable to make directory: ' + directory)
+        tmp_path = os.path.join(directory, 'ingest.copying.' + _random_string(10))
+        try:
+            if strategy == 'auto':
+                transferred = try_transfer_file(path, tmp_path, strategy='reflink')
+            elif strategy != 'copy':
+                transfer_file(path, tmp_path, strategy=strategy)
+                transferred = True
+            else:
+                transferred = False
+            if transferred and not compute_manifest:
+                hashes = self.computeFileHashes(path, algorithms)
+                if hashes is None:
+                    raise Exception('Unable to compute hash of file: {}'.format(path))
+                manifest = None
+            else:
+                # the whole-file digests are sequential, but the chunks of the manifest are hashed on the pool
+                hasher = StreamHasher(algorithms=algorithms, manifest=compute_manifest, size=stat0['size'], num_workers=num_hash_workers)
+                if (stat0['size'] > 1024 * 1024 * 100):
+                    print('{} while computing {}: {}'.format('Hashing file' if transferred else 'Copying file to cache', ' and '.join(algorithms), path))
+                try:
+                    _stream_file(path, hasher, copy_to=None if transferred else tmp_path)
+                    hashes = hasher.hexdigests()
+                    manifest = hasher.manifest()
+                finally:
+                    hasher.close()
+                if stat0['size'] >= 100000:
+                    self._record_file_hashes(path, hashes, stat_object=stat0)
+            path0 = self._get_path(hashes[self._algorithm], create=True)
+            _rename_file(tmp_path, path0, remove_if_exists=False)
+        finally:
+            if os.path.exists(tmp_path):
+                _safe_remove_file(tmp_path)
+        return path0, hashes, manifest
+
+    def storeBytes(self, data: bytes, *, also_compute: Optional[List[str]]=None, compute_manifest: bool=False) -> Tuple[str, Dict[str, str], Optional[dict]]:
+        # hash an in-memory buffer and write it once, directly to its content address (unless already there)
+        algorithms = [self._algorithm] + [alg for alg in (also_compute or []) if alg != self._algorithm]
+        if compute_manifest and 'sha1' not in algorithms:
+            algorithms.append('sha1')
+        hasher = StreamHasher(algorithms=algorithms, manifest=compute_manifest, size=len(data))
+        hasher.update(data)
+        hashes = hasher.hexdigests()
+        path0 = self._get_path(hashes[self._algorithm], create=True)
+        if not os.path.exists(path0):
+            tmp_path = path0 + '.copying.' + _random_string(6)
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                _rename_file(tmp_path, path0, remove_if_exists=False)
+            finally:
+                if os.path.exists(tmp_path):
+                    _safe_remove_file(tmp_path)
+        return path0, hashes, hasher.manifest()
+
+    def openWriter(self, *, also_compute: Optional[List[str]]=None, compute_manifest: bool=False) -> '_CacheWriter':
+        # a file-like object that hashes the bytes as they are written to a temporary file in the cache
+        algorithms = [self._algorithm] + [alg for alg in (also_compute or []) if alg != self._algorithm]
+        if compute_manifest and 'sha1' not in algorithms:
+            algorithms.append('sha1')
+        directory = self.directory()
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except:
+                if not os.path.exists(directory):
+                    raise Exception('Unable to make directory: ' + directory)
+        tmp_path = os.path.join(directory, 'ingest.copying.' + _random_string(10))
+        return _CacheWriter(self, tmp_path=tmp_path, hasher=StreamHasher(algorithms=algorithms, manifest=compute_manifest))
+
+    def hasFileInCache(self, hash: str) -> bool:
+        return os.path.exists(self._get_path(hash, create=False))
+
     # @mtlogging.log()
-    def computeFileHash(self, path: str, _known_hash: str = None, _cache_only: bool = False) -> Optional[str]:
+    def computeFileHash(self, path: str, _known_hash: str = None, _cache_only: bool = False, also_compute: Optional[List[str]] = None) -> Optional[str]:
+        # also_compute: other algorithms to compute (and record) in the same read, in case the file needs to be read
+        if _known_hash is not None:
+            if os.path.getsize(path) < 100000:
+                return _compute_file_hash(path, algorithm=self._algorithm)
+            self._record_file_hashes(os.path.abspath(path), {self._algorithm: _known_hash})
+            return _known_hash
+        hashes = self._compute_file_hashes(path, required=[self._algorithm], optional=also_compute or [], cache_only=_cache_only)
+        if hashes is None:
+            return None
+        return hashes[self._algorithm]
+
+    def computeFileHashes(self, path: str, algorithms: List[str], _cache_only: bool = False) -> Optional[Dict[str, str]]:
+        # all the requested hashes of a file, reading it at most once
+        # digests already in the stat record are not recomputed
+        return self._compute_file_hashes(path, required=algorithms, optional=[], cache_only=_cache_only)
+
+    def _compute_file_hashes(self, path: str, *, required: List[str], optional: List[str], cache_only: bool) -> Optional[Dict[str, str]]:
+        algorithms = required + [alg for alg in optional if alg not in required]
         if os.path.getsize(path) < 100000:
             # if it is a small file, we can compute the hash directory
             # this is important when the KACHERY_STORAGE_DIR is not a remote file system
-            return _compute_file_hash(path, algorithm=self._algorithm)
+            return _compute_file_hashes(path, algorithms=algorithms)
         path = os.path.abspath(path)
+        ret: Dict[str, str] = dict()
         basename = os.path.basename(path)
         if len(basename) == _length_of_hash_for_algorithm(self._algorithm):
             # suspect it is itself a file in the cache
             if self._get_path(hash=basename) == path:
                 # in that case we don't need to compute
-                return basename
+                ret[self._algorithm] = basename
+                if all([alg in ret for alg in required]):
+                    return ret
 
         aa = _get_stat_object(path)
-        aa_sha1 = _compute_string_sha1(json.dumps(aa, sort_keys=True))
-
-        path0 = self._get_path(aa_sha1, create=True) + '.record.json'
-        if not _known_hash:
-            if os.path.exists(path0):
-                obj = _read_json_file(path0, delete_on_error=True)
-                if obj:
-                    bb = obj['stat']
-                    if _stat_objects_match(aa, bb):
-                        if obj.get(self._algorithm, None):
-                            return str(obj[self._algorithm])
-
-        if _known_hash is None:
-            if _cache_only:
-                return None
-            hash1 = _compute_file_hash(path, algorithm=self._algorithm)
-        else:
-            hash1 = _known_hash
-
-        if not hash1:
+        if aa is None:
+            return _compute_file_hashes(path, algorithms=algorithms)
+        db = self.hashDatabase()
+
+        record = db.lookupRecords([aa])[0]
+        if record is not None:
+            for alg in algorithms:
+                if (alg in record) and (alg not in ret):
+                    ret[alg] = record[alg]
+        if all([alg in ret for alg in required]):
+            return ret
+
+        if cache_only:
+            return None
+        computed = _compute_file_hashes(path, algorithms=[alg for alg in algorithms if alg not in ret])
+        if computed is None:
             return None
+        ret.update(computed)
+        self._record_file_hashes(path, computed, stat_object=aa)
+        return ret
 
+    def _record_file_hashes(self, path: str, hashes: Dict[str, str], stat_object: Optional[dict]=None) -> None:
+        aa = stat_object if stat_object is not None else _get_stat_object(path)
+        if aa is None:
+            return
         obj: Dict[str, Union[str, dict, None]] = dict(
             stat=aa
         )
-        obj[self._algorithm] = hash1
-        try:
-            _write_json_file(obj, path0)
-        except:
-            print('Warning: problem writing .record.json file: ' + path0)
-
-        path1 = self._get_path(hash=hash1, create=True, directory=self.directory()) + '.hints.json'
-        hints: Union[dict, None] = None
-        if os.path.exists(path1):
-            hints = _read_json_file(path1, delete_on_error=True)
-        if hints is None:
-            hints = dict(files=[])
-        hints['files'].append(obj)
+        obj.update(hashes)
+        db = self.hashDatabase()
         try:
-            _write_json_file(hints, path1)
-        except:
-            print('Warning: problem writing .hints.json file: ' + path1)
-        # todo: use hints for findFile
-        return hash1
+            db.insertHashes([obj])
+        except Exception as e:
+            print('Warning: problem writing to hash database: {} ({})'.format(db.path(), str(e)))
 
     def reportFileHash(self, path: str, hash: str) -> None:
         self.computeFileHash(path, _known_hash=hash)
 
+    def lookupFileHashes(self, paths: List[str]) -> List[Optional[str]]:
+        # batch version of computeFileHash(path, _cache_only=True) for files outside the cache
+        stat_objects = [_get_stat_object(os.path.abspath(p)) for p in paths]
+        return self.hashDatabase().lookupHashes(stat_objects, algorithm=self._algorithm)
+
+    def reportFileHashes(self, paths: List[str], hashes: List[str]) -> None:
+        # batch version of reportFileHash
+        records = []
+        for p, h in zip(paths, hashes):
+            aa = _get_stat_object(os.path.abspath(p))
+            if aa is not None:
+                obj: Dict[str, Union[str, dict, None]] = dict(stat=aa)
+                obj[self._algorithm] = h
+                records.append(obj)
+        self.hashDatabase().insertHashes(records)
+
+    def hashDatabase(self) -> HashDatabase:
+        if (not self._directory) and ('KACHERY_STORAGE_DIR' in os.environ):
+            # shared by all algorithms so that a record can hold several digests
+            db_path = os.path.join(str(os.getenv('KACHERY_STORAGE_DIR')), 'hashdb.sqlite')
+        else:
+            db_path = os.path.join(self.directory(), 'hashdb.sqlite')
+        with _hash_databases_lock:
+            if db_path not in _hash_databases:
+                _hash_databases[db_path] = HashDatabase(db_path)
+            db = _hash_databases[db_path]
+        db.ensureMigrated(self.directory())
+        return db
+
+    def pinHash(self, hash: str) -> None:
+        # pinned files are never evicted by cleanup()
+        self.hashDatabase().setPinned(hash, True, algorithm=self._algorithm)
+
+    def unpinHash(self, hash: str) -> None:
+        self.hashDatabase().setPinned(hash, False, algorithm=self._algorithm)
+
+    def pinnedHashes(self) -> List[str]:
+        return self.hashDatabase().getPinned(algorithm=self._algorithm)
+
+    def cleanup(self, *, max_bytes: Optional[int]=None, policy: str='lru', min_age: float=600, temp_file_max_age: float=24 * 3600, partial_file_max_age: float=7 * 24 * 3600, remote_check_max_age: float=7 * 24 * 3600, dry_run: bool=False, verbose: bool=False) -> dict:
+        """Remove stale files from the cache directory and enforce a size quota
+
+        Temporary files (.downloading., .copying., .tmp. and bootstrap copies)
+        and .lock files that are not held are removed once they are older than temp_file_max_age,
+        partially downloaded files that have not been written to for
+        partial_file_max_age are removed, and the .record.json/.hints.json files of older versions are removed
+        (they have been imported into the hash database). The results of remote
+        checks older than remote_check_max_age are removed from the hash database. If max_bytes is given,
+        cached files, partially downloaded files and remote file blocks are then evicted, least recently
+        used first (policy='lru') or least frequently used first (policy='lfu'),
+        until the total size is at most max_bytes. Pinned hashes and files
+        accessed within the last min_age seconds are never evicted.
+
+        This is safe to run while other processes use the cache: files are only
+        unlinked (open readers are unaffected), in-progress temporary files are
+        protected by temp_file_max_age, and recently found files by min_age.
+        The accesses of other processes are recorded in the hash database
+        within a few seconds (see HashDatabase.recordAccess), and the access
+        and modification times of the files are also taken into account.
+
+        Parameters
+        ----------
+        max_bytes : Optional[int], optional
+            The size quota for the cache directory, by default None (no quota)
+        policy : str, optional
+            'lru' or 'lfu', by default 'lru'
+        min_age : float, optional
+            Seconds since last access before a file may be evicted, by default 600
+        temp_file_max_age : float, optional
+            Seconds before temporary and lock files are considered orphaned, by default one day
+        partial_file_max_age : float, optional
+            Seconds before an interrupted download is no longer worth resuming, by default one week
+        remote_check_max_age : float, optional
+            Seconds before the recorded result of a remote check is removed, by default one week
+        dry_run : bool, optional
+            Only report what would be removed, by default False
+        verbose : bool, optional
+            Print every removed file, by default False
+
+        Returns
+        -------
+        dict
+            Counts and sizes of what was removed and of what remains
+        """
+        if policy not in ['lru', 'lfu']:
+            raise Exception('Unexpected cleanup policy: {}'.format(policy))
+        directory = self.directory()
+        ret = dict(
+            num_temp_files_removed=0,
+            num_legacy_files_removed=0,
+            num_partial_files_removed=0,
+            num_remote_checks_removed=0,
+            num_files_evicted=0,
+            num_bytes_evicted=0,
+            num_files=0,
+            num_bytes=0
+        )
+        if not os.path.isdir(directory):
+            return ret
+        db = self.hashDatabase()
+        # only one cleanup at a time for a given cache directory
+        with FileLock(os.path.join(directory, 'cleanup.lock'), exclusive=True):
+            # the accesses recorded by this process are buffered (see HashDatabase.recordAccess)
+            db.flushAccesses()
+            now = time.time()
+            entries = []
+            for kind, path0, stat0 in _walk_cache_directory(directory, hash_length=_length_of_hash_for_algorithm(self._algorithm)):
+                if kind == 'temp':
+                    if now - stat0.st_mtime > temp_file_max_age:
+                        if _remove_for_cleanup(path0, dry_run=dry_run, verbose=verbose):
+                            ret['num_temp_files_removed'] += 1
+                elif kind == 'lock':
+                    # a lock file is not written to while it is held, so its age says nothing about whether it is in use
+                    if now - stat0.st_mtime > temp_file_max_age:
+                        if _remove_lock_file_for_cleanup(path0, dry_run=dry_run, verbose=verbose):
+                            ret['num_temp_files_removed'] += 1
+                elif kind == 'legacy':
+                    if _remove_for_cleanup(path0, dry_run=dry_run, verbose=verbose):
+                        ret['num_legacy_files_removed'] += 1
+                elif kind == 'partial' and now - stat0.st_mtime > partial_file_max_age:
+                    # the ranges sidecar goes first
+                    _remove_for_cleanup(path0 + '.ranges', dry_run=dry_run, verbose=verbose)
+                    if _remove_for_cleanup(path0, dry_run=dry_run, verbose=verbose):
+                        ret['num_partial_files_removed'] += 1
+                else:
+                    entries.append((kind, path0, stat0))
+            if not dry_run:
+                ret['num_remote_checks_removed'] = db.pruneRemoteChecks(remote_check_max_age)
+            ret['num_files'] = len(entries)
+            ret['num_bytes'] = sum([_size_on_disk(kind, stat0) for kind, _, stat0 in entries])
+            if (max_bytes is None) or (ret['num_bytes'] <= max_bytes):
+                return ret
+
+            accesses = db.getAccesses(algorithm=self._algorithm)
+            pinned = set(db.getPinned(algorithm=self._algorithm))
+            candidates = []
+            for kind, path0, stat0 in entries:
+                name0 = os.path.basename(path0)
+                if kind == 'partial':
+                    name0 = name0[:-len('.partial')]
+                if kind == 'hash' and name0 in pinned:
+                    continue
+                last_access, access_count = accesses.get(name0, (0, 0))
+                # the access time of the file covers accesses not (yet) recorded, e.g., by a process that was killed
+                last_access = max(last_access, stat0.st_mtime, stat0.st_atime)
+                if now - last_access < min_age:
+                    continue
+                if policy == 'lru':
+                    key = (last_access,)
+                else:
+                    key = (access_count, last_access)
+                candidates.append((key, kind, path0, _size_on_disk(kind, stat0)))
+            candidates.sort(key=lambda c: c[0])
+            evicted_hashes = []
+            for _, kind, path0, size0 in candidates:
+                if ret['num_bytes'] <= max_bytes:
+                    break
+                if kind == 'partial':
+                    # the ranges sidecar goes first
+                    _remove_for_cleanup(path0 + '.ranges', dry_run=dry_run, verbose=verbose)
+                if _remove_for_cleanup(path0, dry_run=dry_run, verbose=verbose):
+                    ret['num_files_evicted'] += 1
+                    ret['num_bytes_evicted'] += size0
+                    ret['num_files'] -= 1
+                    ret['num_bytes'] -= size0
+                    if kind == 'hash':
+                        evicted_hashes.append(os.path.basename(path0))
+            if not dry_run:
+                db.removeAccesses(evicted_hashes, algorithm=self._algorithm)
+            if ret['num_bytes'] > max_bytes:
+                print('Warning: unable to reduce the size of {} below {} (pinned or recently used files)'.format(directory, _format_file_size(max_bytes)))
+        return ret
+
     def _get_path(self, hash: str, *, create: bool=True, directory: Optional[str]=None) -> str:
         return str(self._get_path_ext(hash=hash, create=create, directory=directory))
 
@@ -287,20 +703,70 @@ class LocalHashCache:
                         raise Exception('Unable to make directory: ' + path0)
         return os.path.join(path0, code)
 
+class _CacheWriter:
+    def __init__(self, hash_cache: LocalHashCache, *, tmp_path: str, hasher: StreamHasher):
+        self._hash_cache = hash_cache
+        self._tmp_path = tmp_path
+        self._hasher = hasher
+        self._file = open(tmp_path, 'wb')
+    def write(self, data) -> int:
+        self._hasher.update(data)
+        return self._file.write(data)
+    def tell(self) -> int:
+        return self._hasher.numBytes()
+    def tmpPath(self) -> str:
+        return self._tmp_path
+    def finish(self) -> Tuple[Dict[str, str], Optional[dict]]:
+        # close the temporary file and return the hashes and the manifest
+        self._file.close()
+        return self._hasher.hexdigests(), self._hasher.manifest()
+    def commit(self) -> str:
+        # move the finished temporary file to its content address in the cache
+        hash0 = self._hasher.hexdigests()[self._hash_cache._algorithm]
+        path0 = self._hash_cache._get_path(hash0, create=True)
+        _rename_file(self._tmp_path, path0, remove_if_exists=False)
+        return path0
+    def abort(self) -> None:
+        # remove the temporary file (if it was not committed)
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._tmp_path):
+            _safe_remove_file(self._tmp_path)
+
+
+def _stream_file(path: str, hasher: StreamHasher, *, copy_to: Optional[str]) -> None:
+    buf = bytearray(hash_block_size())
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as fsrc:
+        advise_sequential(fsrc.fileno())
+        fdst = open(copy_to, 'wb') if copy_to is not None else None
+        try:
+            while True:
+                num_read = fsrc.readinto(buf)
+                if not num_read:
+                    break
+                hasher.update(view[:num_read])
+                if fdst is not None:
+                    fdst.write(view[:num_read])
+        finally:
+            if fdst is not None:
+                fdst.close()
+
+
 # @mtlogging.log()
 def _compute_file_hash(path: str, algorithm: str) -> Optional[str]:
+    hashes = _compute_file_hashes(path, algorithms=[algorithm])
+    if hashes is None:
+        return None
+    return hashes[algorithm]
+
+
+def _compute_file_hashes(path: str, algorithms: List[str]) -> Optional[Dict[str, str]]:
     if not os.path.exists(path):
         return None
     if (os.path.getsize(path) > 1024 * 1024 * 100):
-        print('Computing {} of {}'.format(algorithm, path))
-    BLOCKSIZE = 65536
-    hashsum = getattr(hashlib, algorithm)()
-    with open(path, 'rb') as file:
-        buf = file.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hashsum.update(buf)
-            buf = file.read(BLOCKSIZE)
-    return hashsum.hexdigest()
+        print('Computing {} of {}'.format(' and '.join(algorithms), path))
+    return compute_file_hashes(path, algorithms=algorithms)
 
 
 def _get_stat_object(fname: str) -> Optional[Dict]:
@@ -318,15 +784,99 @@ def _get_stat_object(fname: str) -> Optional[Dict]:
         return None
 
 
-def _stat_objects_match(aa: object, bb: object) -> bool:
-    str1 = json.dumps(aa, sort_keys=True)
-    str2 = json.dumps(bb, sort_keys=True)
-    return (str1 == str2)
+_TEMP_FILE_MARKERS = ['.downloading.', '.copying.', '.tmp.', 'tmp_bootstrap_']
+_LEGACY_FILE_SUFFIXES = ['.record.json', '.hints.json']
 
+def _walk_cache_directory(directory: str, *, hash_length: int):
+    # yields (kind, path, stat) for the files of a cache directory, where kind is one of
+    # 'hash' (<aa>/<bb>/<cc>/<hash>), 'partial' (<aa>/<bb>/<cc>/<hash>.partial, whose .ranges sidecar is
+    # not reported separately), 'block' (<a>/<bc>/<code>, see store_file_by_code), 'temp', 'lock' or 'legacy'.
+    # Anything else (e.g. the hash database) is skipped.
+    stack = [(directory, [])]
+    while stack:
+        dirpath, parts = stack.pop()
+        try:
+            it = list(os.scandir(dirpath))
+        except:
+            continue
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if len(parts) < 3:
+                        stack.append((entry.path, parts + [entry.name]))
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                stat0 = entry.stat(follow_symlinks=False)
+            except:
+                # removed by someone else in the meantime
+                continue
+            name0 = entry.name
+            if any([m in name0 for m in _TEMP_FILE_MARKERS]):
+                # includes the ingest.copying. files at the top level
+                yield 'temp', entry.path, stat0
+            elif not parts:
+                # top level: the hash database, cleanup.lock, etc.
+                continue
+            elif any([name0.endswith(x) or name0.endswith(x + '.lock') for x in _LEGACY_FILE_SUFFIXES]):
+                yield 'legacy', entry.path, stat0
+            elif name0.endswith('.lock'):
+                yield 'lock', entry.path, stat0
+            elif len(parts) == 3 and len(name0) == hash_length and parts == [name0[0:2], name0[2:4], name0[4:6]]:
+                yield 'hash', entry.path, stat0
+            elif len(parts) == 3 and name0.endswith('.partial'):
+                yield 'partial', entry.path, stat0
+            elif len(parts) == 3 and name0.endswith('.partial.ranges'):
+                if not os.path.exists(entry.path[:-len('.ranges')]):
+                    # orphaned
+                    yield 'temp', entry.path, stat0
+            elif len(parts) == 2 and len(name0) == 40 and parts == [name0[0], name0[1:3]]:
+                yield 'block', entry.path, stat0
+
+
+def _is_valid_manifest(manifest: dict, *, size: int) -> bool:
+    # the chunks must cover the file, in order
+    if manifest.get('size', None) != size:
+        return False
+    pos = 0
+    for c in manifest.get('chunks', []):
+        if (c.get('start', None) != pos) or (c.get('end', 0) <= pos) or (not isinstance(c.get('sha1', None), str)):
+            return False
+        pos = c['end']
+    return pos == size
+
+
+def _size_on_disk(kind: str, stat0: os.stat_result) -> int:
+    if kind == 'partial' and hasattr(stat0, 'st_blocks'):
+        # sparse
+        return min(stat0.st_size, stat0.st_blocks * 512)
+    return stat0.st_size
+
+
+def _remove_for_cleanup(path: str, *, dry_run: bool, verbose: bool) -> bool:
+    if verbose:
+        print('{}: {}'.format('Would remove' if dry_run else 'Removing', path))
+    if dry_run:
+        return True
+    try:
+        os.unlink(path)
+        return True
+    except:
+        # maybe it was removed by someone else
+        return False
 
-def _compute_string_sha1(txt: str) -> str:
-    hash_object = hashlib.sha1(txt.encode('utf-8'))
-    return hash_object.hexdigest()
+
+def _remove_lock_file_for_cleanup(path: str, *, dry_run: bool, verbose: bool) -> bool:
+    # skipped if it is held; otherwise unlinked while we hold it (FileLock retries on the new file)
+    lock = FileLock(path, exclusive=True)
+    if not lock.acquire(blocking=False):
+        if verbose:
+            print('Skipping lock file that is held: {}'.format(path))
+        return False
+    try:
+        return _remove_for_cleanup(path, dry_run=dry_run, verbose=verbose)
+    finally:
+        lock.release()
 
 
 def _safe_remove_file(fname: str) -> None:
@@ -336,31 +886,6 @@ def _safe_remove_file(fname: str) -> None:
         print('Warning: unable to remove file that we thought existed: ' + fname)
 
 
-# @mtlogging.log()
-def _read_json_file(path: str, *, delete_on_error: bool=False) -> Any:
-    with FileLock(path + '.lock', exclusive=False):
-        try:
-            with open(path) as f:
-                return json.load(f)
-        except:
-            if delete_on_error:
-                print('Warning: Unable to read or parse json file. Deleting: ' + path)
-                try:
-                    os.unlink(path)
-                except:
-                    print('Warning: unable to delete file: ' + path)
-                    pass
-            else:
-                print('Warning: Unable to read or parse json file: ' + path)
-            return None
-
-
-def _write_json_file(obj: object, path: str) -> None:
-    with FileLock(path + '.lock', exclusive=True):
-        with open(path, 'w') as f:
-            json.dump(obj, f)
-
-
 def _rename_or_copy(path1: str, path2: str) -> None:
     if os.path.abspath(path1) == os.path.abspath(path2):
         return
@@ -7,6 +7,8 @@ def _add_download_args(parser):
     parser.add_argument('--url', help='The URL of the kachery database server to download from when loading from remote (or use KACHERY_URL environment variable)', required=False, default=None)
     parser.add_argument('--channel', '-c', help='The channel of the kachery database server to download from when loading from remote (or use KACHERY_CHANNEL environment variable)', required=False, default=None)
     parser.add_argument('--password', '-p', help='The password of the kachery database server to download from when loading from remote (or use KACHERY_PASSWORD environment variable)', required=False, default=None)
+    parser.add_argument('--download-workers', type=int, help='The number of concurrent range requests used to download a large file', required=False, default=None)
+    parser.add_argument('--download-segment-size', type=int, help='The size (in bytes) of the ranges of a segmented download', required=False, default=None)
 
 def _add_upload_args(parser):
     parser.add_argument('--to', '-t', help='Where to store to', required=False, default='')
@@ -14,6 +16,7 @@ def _add_upload_args(parser):
     parser.add_argument('--url', help='The URL of the kachery database server to upload to when storing to remote (or use KACHERY_URL environment variable)', required=False, default=None)
     parser.add_argument('--channel', '-c', help='The channel of the kachery database server to upload to when storing to remote (or use KACHERY_CHANNEL environment variable)', required=False, default=None)
     parser.add_argument('--password', '-p', help='The password of the kachery database server to upload to when storing to remote (or use KACHERY_PASSWORD environment variable)', required=False, default=None)
+    parser.add_argument('--ingest-workers', type=int, help='The number of files of a directory hashed and uploaded concurrently', required=False, default=None)
 
 def _set_download_config_from_parsed_args(args):
     fr = args.fr or None
@@ -22,6 +25,10 @@ def _set_download_config_from_parsed_args(args):
     password = args.password or None
     remote_only = args.remote_only
 
+    ka.set_config(
+        num_download_workers=args.download_workers,
+        download_segment_size=args.download_segment_size
+    )
     if fr is not None:
         if url is not None or channel is not None or password is not None:
             raise Exception('Cannot use --url or --channel or --password together with --fr')
@@ -46,6 +53,9 @@ def _set_upload_config_from_parsed_args(args):
     password = args.password or None
     remote_only = args.remote_only
 
+    ka.set_config(
+        num_ingest_workers=args.ingest_workers
+    )
     if to is not None:
         if url is not None or channel is not None or password is not None:
             raise Exception('Cannot use --url or --channel or --password together with --to')
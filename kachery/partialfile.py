@@ -0,0 +1,153 @@
+import os
+import json
+import random
+from .filelock import FileLock
+from typing import List, Optional, Tuple
+
+class PartialFile:
+    def __init__(self, path: str, *, size: int):
+        """A sparse file of the given size of which only some byte ranges are present
+
+        The present ranges are kept (sorted and merged) in a <path>.ranges
+        sidecar, which is only updated after the data has been written, so
+        that a range is never reported as present before its bytes are in the
+        file. Writes are serialized (across threads and processes) by a lock
+        on <path>.lock. If the data file disappears (e.g., removed by cleanup),
+        the sidecar is disregarded.
+
+        Parameters
+        ----------
+        path : str
+            Path of the (sparse) data file
+        size : int
+            Size of the complete file
+        """
+        self._path = path
+        self._size = size
+
+    def path(self) -> str:
+        return self._path
+
+    def size(self) -> int:
+        return self._size
+
+    def rangesPath(self) -> str:
+        return self._path + '.ranges'
+
+    def lockPath(self) -> str:
+        return self._path + '.lock'
+
+    def exists(self) -> bool:
+        return os.path.exists(self._path)
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        if not os.path.exists(self._path):
+            return []
+        try:
+            with open(self.rangesPath(), 'r') as f:
+                obj = json.load(f)
+        except:
+            return []
+        if obj.get('size', None) != self._size:
+            return []
+        return [(int(r[0]), int(r[1])) for r in obj['ranges']]
+
+    def numBytesPresent(self) -> int:
+        return sum([r[1] - r[0] for r in self.ranges()])
+
+    def hasRange(self, start: int, end: int) -> bool:
+        return _ranges_cover(self.ranges(), start, end)
+
+    def isComplete(self) -> bool:
+        return self.hasRange(0, self._size)
+
+    def read(self, start: int, end: int) -> Optional[bytes]:
+        # returns None unless the whole range is present
+        if not self.hasRange(start, end):
+            return None
+        try:
+            f = open(self._path, 'rb')
+        except OSError:
+            # removed or promoted in the meantime
+            return None
+        with f:
+            f.seek(start)
+            buf = f.read(end - start)
+        if len(buf) != end - start:
+            return None
+        return buf
+
+    def write(self, start: int, data: bytes) -> bool:
+        """Write data at offset start and mark the range as present
+
+        Returns
+        -------
+        bool
+            True if this write completed the file (for exactly one writer)
+        """
+        end = start + len(data)
+        if start < 0 or end > self._size:
+            raise Exception('Invalid range for partial file of size {}: {} - {}'.format(self._size, start, end))
+        with FileLock(self.lockPath(), exclusive=True):
+            was_complete = self.isComplete()
+            if os.path.exists(self._path):
+                ranges = self.ranges()
+            else:
+                ranges = []
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, 'r+b') as f:
+                if os.fstat(fd).st_size != self._size:
+                    # the file is sparse: unwritten ranges do not take up space
+                    f.truncate(self._size)
+                f.seek(start)
+                f.write(data)
+            ranges = _merge_ranges(ranges + [(start, end)])
+            self._write_ranges(ranges)
+            return (not was_complete) and _ranges_cover(ranges, 0, self._size)
+
+    def removeRanges(self) -> None:
+        try:
+            os.unlink(self.rangesPath())
+        except OSError:
+            pass
+
+    def remove(self) -> None:
+        # the sidecar first, so that the ranges are never attributed to a missing or new file.
+        # The lock file is unlinked while we hold it (FileLock then retries on a new one).
+        with FileLock(self.lockPath(), exclusive=True):
+            self.removeRanges()
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+            try:
+                os.unlink(self.lockPath())
+            except OSError:
+                pass
+
+    def _write_ranges(self, ranges: List[Tuple[int, int]]) -> None:
+        path_tmp = self.rangesPath() + '.tmp.' + _random_string(6)
+        with open(path_tmp, 'w') as f:
+            json.dump(dict(size=self._size, ranges=[[r[0], r[1]] for r in ranges]), f)
+        os.replace(path_tmp, self.rangesPath())
+
+def _merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    ret: List[Tuple[int, int]] = []
+    for r in sorted([r for r in ranges if r[1] > r[0]]):
+        if ret and r[0] <= ret[-1][1]:
+            ret[-1] = (ret[-1][0], max(ret[-1][1], r[1]))
+        else:
+            ret.append(r)
+    return ret
+
+def _ranges_cover(ranges: List[Tuple[int, int]], start: int, end: int) -> bool:
+    if end <= start:
+        return True
+    for r in ranges:
+        if r[0] <= start and end <= r[1]:
+            return True
+    return False
+
+def _random_string(num_chars: int) -> str:
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    return ''.join(random.choice(chars) for _ in range(num_chars))
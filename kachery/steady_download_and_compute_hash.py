@@ -2,31 +2,168 @@ import string
 import random
 import hashlib
 import os
-# import requests
-import urllib
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, List, Optional, Tuple
 import time
+from ._hashing import hash_block_size
+from .partialfile import PartialFile
+from ._transport import http_get, http_head
+
+DEFAULT_DOWNLOAD_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# the content is read from response.raw, which is not decoded, so it must not be compressed
+# (and byte ranges are then ranges of the file itself)
+_IDENTITY_ENCODING = {'Accept-Encoding': 'identity'}
 
 def steady_download_and_compute_hash(url: str, algorithm: str, target_path: str) -> str:
-    remote = urllib.request.urlopen(url)
     str0 = ''.join(random.sample(string.ascii_lowercase, 8))
     path_tmp = target_path + '.tmp.' + str0
 
     hh = getattr(hashlib, algorithm)()
-    with open(path_tmp, 'wb') as f:
-        while True:
-            chunk = remote.read(4096)
-            if not chunk:
-                break
-            hh.update(chunk)
-            f.write(chunk)
+    # read into a single reused buffer rather than allocating a small bytes object per read
+    buf = bytearray(hash_block_size())
+    view = memoryview(buf)
+    with http_get(url, headers=_IDENTITY_ENCODING, stream=True) as response:
+        response.raise_for_status()
+        with open(path_tmp, 'wb') as f:
+            while True:
+                num_read = response.raw.readinto(buf)
+                if not num_read:
+                    break
+                hh.update(view[:num_read])
+                f.write(view[:num_read])
     os.rename(path_tmp, target_path)
     hash0 = hh.hexdigest()
     return hash0
 
+class RangeRequestsNotSupported(Exception):
+    pass
+
+def segmented_download_and_compute_hash(url: str, algorithm: str, partial_file: PartialFile, *, segment_size: Optional[int]=None, num_workers: int=4, retry_delays: Optional[List[float]]=None, manifest: Optional[dict]=None) -> str:
+    """Download a file of known size as byte ranges fetched concurrently, and compute its hash
+
+    The segments are written in place into the (preallocated) partial file,
+    which records the ranges that are present. Segments that are already
+    present, from an earlier interrupted download (possibly by another
+    process) or from reads of parts of the file, are read back from disk
+    instead of being downloaded again. Since the state of a digest cannot be
+    saved, the calling thread feeds all the segments, in order, into the digest
+    as they become available. At most 2 * num_workers segments are held in
+    memory at any time. Raises RangeRequestsNotSupported (before anything is
+    written) if the server ignores the Range header.
+
+    With a manifest (see compute_file_sha1_and_manifest), the segments are
+    the chunks of the manifest, and every chunk is verified against its sha1,
+    whether it was downloaded or already present. A chunk that does not match
+    is fetched again, so that a corrupted chunk does not cost the whole file.
+
+    Parameters
+    ----------
+    url : str
+        The download url
+    algorithm : str
+        'sha1' or 'md5'
+    partial_file : PartialFile
+        Where to write the file (its size is the size of the file)
+    segment_size : Optional[int], optional
+        The size of the byte ranges, by default DEFAULT_DOWNLOAD_SEGMENT_SIZE
+    num_workers : int, optional
+        The number of concurrent requests, by default 4
+    retry_delays : Optional[List[float]], optional
+        Delays before retrying a failed segment, by default [0.2, 0.5, 2]
+    manifest : Optional[dict], optional
+        The sha1 manifest of the file, by default None
+
+    Returns
+    -------
+    str
+        The hash of the downloaded file
+    """
+    if segment_size is None:
+        segment_size = DEFAULT_DOWNLOAD_SEGMENT_SIZE
+    if retry_delays is None:
+        retry_delays = [0.2, 0.5, 2]
+    size = partial_file.size()
+    # (start, end, expected sha1 or None)
+    segments: List[Tuple[int, int, Optional[str]]]
+    if manifest is not None:
+        segments = [(c['start'], c['end'], c['sha1']) for c in manifest['chunks']]
+    else:
+        segments = [(start, min(start + segment_size, size), None) for start in range(0, size, segment_size)]
+    def fetch_segment(start: int, end: int, expected_sha1: Optional[str]) -> bytearray:
+        for ii in range(len(retry_delays) + 1):
+            buf = _download_segment(url, start, end, retry_delays=retry_delays)
+            if (expected_sha1 is None) or (_sha1_of_buffer(buf) == expected_sha1):
+                partial_file.write(start, buf)
+                return buf
+            print('Warning: chunk {}-{} does not match the manifest, fetching it again: {}'.format(start, end, url))
+        raise Exception('Chunk {}-{} repeatedly does not match the manifest: {}'.format(start, end, url))
+    def get_segment(start: int, end: int, expected_sha1: Optional[str]) -> Union[bytes, bytearray]:
+        buf = partial_file.read(start, end)
+        if (buf is not None) and ((expected_sha1 is None) or (_sha1_of_buffer(buf) == expected_sha1)):
+            return buf
+        return fetch_segment(start, end, expected_sha1)
+    hh = getattr(hashlib, algorithm)()
+    # the first segment to download establishes that ranges are supported, before anything is written
+    missing = [seg for seg in segments if not partial_file.hasRange(seg[0], seg[1])]
+    if missing:
+        fetch_segment(*missing[0])
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        max_in_flight = 2 * num_workers
+        futures: list = []
+        next_index = 0
+        try:
+            for ii in range(len(segments)):
+                while next_index < len(segments) and next_index < ii + max_in_flight:
+                    futures.append(executor.submit(get_segment, *segments[next_index]))
+                    next_index = next_index + 1
+                buf = futures[ii].result()
+                futures[ii] = None
+                hh.update(buf)
+        except:
+            for ff in futures:
+                if ff is not None:
+                    ff.cancel()
+            raise
+    return hh.hexdigest()
+
+def _sha1_of_buffer(buf) -> str:
+    hh = hashlib.sha1()
+    hh.update(buf)
+    return hh.hexdigest()
+
+def _download_segment(url: str, start: int, end: int, *, retry_delays: List[float]) -> bytearray:
+    try:
+        return _download_range(url, start, end)
+    except RangeRequestsNotSupported:
+        raise
+    except Exception as e:
+        if len(retry_delays) == 0:
+            raise
+        print('Retrying download of bytes {}-{} in {} sec: {} ({})'.format(start, end, retry_delays[0], url, str(e)))
+        time.sleep(retry_delays[0])
+        return _download_segment(url, start, end, retry_delays=retry_delays[1:])
+
+def _download_range(url: str, start: int, end: int) -> bytearray:
+    with http_get(url, headers=dict(_IDENTITY_ENCODING, Range='bytes={}-{}'.format(start, end - 1)), stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeRequestsNotSupported('Server did not respond with partial content (status {}): {}'.format(response.status_code, url))
+        buf = bytearray(end - start)
+        view = memoryview(buf)
+        num_read = 0
+        while num_read < end - start:
+            n = response.raw.readinto(view[num_read:])
+            if not n:
+                break
+            num_read = num_read + n
+    if num_read != end - start:
+        raise Exception('Unexpected number of bytes downloaded for range {}-{}: {}'.format(start, end, num_read))
+    return buf
+
 ## somehow this was not always working -- some bits were wrong for large files!
 def old_steady_download_and_compute_hash(url: str, algorithm: str, target_path: str, chunk_size: int=1024 * 1024 * 40) -> str:
-    response = requests.head(url)
+    response = http_head(url)
     size_bytes = int(response.headers['content-length'])
     str0 = ''.join(random.sample(string.ascii_lowercase, 8))
     path_tmp = target_path + '.tmp.' + str0
@@ -40,7 +177,7 @@ def old_steady_download_and_compute_hash(url: str, algorithm: str, target_path:
                 headers = {
                     'Range': 'bytes={}-{}'.format(ii, jj - 1)
                 }
-                response = requests.get(url, headers=headers, stream=True)
+                response = http_get(url, headers=headers, stream=True)
                 for chunk in response.iter_content(chunk_size=5120):
                     if chunk:  # filter out keep-alive new chunks
                         hh.update(chunk)
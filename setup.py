@@ -16,11 +16,15 @@ setuptools.setup(
         'bin/kachery-cat',
         'bin/kachery-info',
 	    'bin/kachery-load-dir',
-        'bin/kachery-set-password'
+        'bin/kachery-set-password',
+        'bin/kachery-gc'
     ],
     install_requires=[
         'requests', 'simplejson'
     ],
+    extras_require={
+        'aio': ['aiohttp']
+    },
     classifiers=(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: Apache Software License",
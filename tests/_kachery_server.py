@@ -0,0 +1,122 @@
+import re
+import gzip
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict
+
+# A minimal stand-in for a kachery server (check, get with Range support, and set), for tests.
+# Signatures are not verified.
+
+class KacheryTestServer:
+    def __init__(self):
+        self._files: Dict[str, bytes] = dict()
+        self._lock = threading.Lock()
+        self.num_requests: Dict[str, int] = dict(check=0, get=0, set=0)
+        self.num_connections = 0
+        # to simulate servers without Range support, and transient errors
+        self.support_range = True
+        self.num_get_failures_to_simulate = 0
+        self.num_get_corruptions_to_simulate = 0
+        # to simulate servers (or proxies) that compress the content whenever the client accepts it
+        self.gzip_responses = False
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    def __enter__(self):
+        self._thread.start()
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+    def config(self) -> dict:
+        return dict(url=self.url(), channel='test', password='test')
+    def addFile(self, algorithm: str, hash: str, data: bytes) -> None:
+        with self._lock:
+            self._files[algorithm + '/' + hash] = data
+    def getFile(self, algorithm: str, hash: str):
+        with self._lock:
+            return self._files.get(algorithm + '/' + hash, None)
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.num_requests[name] = self.num_requests[name] + 1
+    def _simulate_failure(self) -> bool:
+        with self._lock:
+            if self.num_get_failures_to_simulate > 0:
+                self.num_get_failures_to_simulate = self.num_get_failures_to_simulate - 1
+                return True
+            return False
+    def _simulate_corruption(self) -> bool:
+        with self._lock:
+            if self.num_get_corruptions_to_simulate > 0:
+                self.num_get_corruptions_to_simulate = self.num_get_corruptions_to_simulate - 1
+                return True
+            return False
+
+def _make_handler(server: KacheryTestServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def log_message(self, format, *args):
+            pass
+        def setup(self):
+            with server._lock:
+                server.num_connections = server.num_connections + 1
+            super().setup()
+        def do_GET(self):
+            m = re.match(r'^/(check|get)/(\w+)/(\w+)', self.path)
+            if m is None:
+                self._send(404, b'')
+                return
+            name, algorithm, hash0 = m.group(1), m.group(2), m.group(3)
+            server._count(name)
+            data = server.getFile(algorithm, hash0)
+            if name == 'check':
+                if data is None:
+                    resp = dict(success=True, found=False)
+                else:
+                    resp = dict(success=True, found=True, size=len(data))
+                self._send(200, json.dumps(resp).encode('utf-8'), content_type='application/json')
+                return
+            if data is None:
+                self._send(404, b'')
+                return
+            if server._simulate_failure():
+                self._send(500, b'')
+                return
+            range0 = self.headers.get('Range', None)
+            if (range0 is None) or (not server.support_range):
+                self._send_content(200, data)
+                return
+            m2 = re.match(r'^bytes=(\d+)-(\d*)$', range0)
+            start = int(m2.group(1))
+            end = int(m2.group(2)) + 1 if m2.group(2) else len(data)
+            end = min(end, len(data))
+            body = data[start:end]
+            if server._simulate_corruption():
+                body = bytes([body[0] ^ 0xff]) + body[1:]
+            self._send_content(206, body, extra_headers={'Content-Range': 'bytes {}-{}/{}'.format(start, end - 1, len(data))})
+        def do_POST(self):
+            m = re.match(r'^/set/(\w+)/(\w+)', self.path)
+            if m is None:
+                self._send(404, b'')
+                return
+            server._count('set')
+            num_bytes = int(self.headers.get('Content-Length', '0'))
+            data = self.rfile.read(num_bytes)
+            server.addFile(m.group(1), m.group(2), data)
+            self._send(200, json.dumps(dict(success=True)).encode('utf-8'), content_type='application/json')
+        def _send_content(self, code: int, body: bytes, extra_headers: dict={}):
+            if server.gzip_responses and ('gzip' in self.headers.get('Accept-Encoding', '')):
+                body = gzip.compress(body)
+                extra_headers = dict(extra_headers, **{'Content-Encoding': 'gzip'})
+            self._send(code, body, extra_headers=extra_headers)
+        def _send(self, code: int, body: bytes, content_type: str='application/octet-stream', extra_headers: dict={}):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in extra_headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
@@ -0,0 +1,63 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+import pytest
+import kachery as ka
+from _kachery_server import KacheryTestServer
+
+pytest.importorskip('aiohttp')
+import kachery.aio as kaa
+
+def test_aio_load_and_store():
+    datas = [os.urandom(1000 + ii) for ii in range(40)] + [b'']
+    hashes = [hashlib.sha1(data).hexdigest() for data in datas]
+    with KacheryTestServer() as server:
+        for hash0, data in zip(hashes, datas):
+            server.addFile('sha1', hash0, data)
+        uris = ['sha1://{}/file.dat'.format(hash0) for hash0 in hashes]
+
+        async def load_all():
+            try:
+                infos = await asyncio.gather(*[kaa.get_file_info(uri, fr=server.config(), from_remote_only=True) for uri in uris])
+                paths = await asyncio.gather(*[kaa.load_file(uri, fr=server.config(), from_remote_only=True) for uri in uris])
+                parts = await asyncio.gather(*[kaa.load_bytes(uri, start=10, end=20, fr=server.config(), from_remote_only=True) for uri in uris[:5]])
+                missing = await kaa.load_file('sha1://' + 'c' * 40, fr=server.config())
+            finally:
+                await kaa.close()
+            return infos, paths, parts, missing
+        infos, paths, parts, missing = asyncio.run(load_all())
+        assert [info['size'] for info in infos] == [len(data) for data in datas]
+        for path0, data in zip(paths, datas):
+            with open(path0, 'rb') as f:
+                assert f.read() == data
+        assert parts == [data[10:20] for data in datas[:5]]
+        assert missing is None
+        # same cache as the synchronous api
+        assert ka.load_file(uris[0], fr='') == paths[0]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = tmpdir + '/new.dat'
+            data_new = os.urandom(5000)
+            with open(fname, 'wb') as f:
+                f.write(data_new)
+            async def store():
+                try:
+                    return await kaa.store_file(fname, to=server.config())
+                finally:
+                    await kaa.close()
+            uri_new = asyncio.run(store())
+        assert uri_new == 'sha1://{}/new.dat'.format(hashlib.sha1(data_new).hexdigest())
+        assert server.getFile('sha1', ka.get_file_hash(uri_new)) == data_new
+
+def test_aio_read_dir():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(tmpdir + '/dir1/sub')
+        with open(tmpdir + '/dir1/sub/a.txt', 'w') as f:
+            f.write('abc')
+        uri = ka.store_dir(tmpdir + '/dir1')
+    async def read():
+        return await kaa.read_dir(uri + '/sub', fr=''), await kaa.load_bytes(uri + '/sub/a.txt', fr='')
+    dd, data = asyncio.run(read())
+    assert dd == ka.read_dir(uri + '/sub', fr='')
+    assert data == b'abc'
@@ -0,0 +1,263 @@
+import os
+import hashlib
+import tempfile
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+import kachery as ka
+from kachery.localhashcache import LocalHashCache
+from kachery._hashing import compute_file_sha1_and_manifest
+from _kachery_server import KacheryTestServer
+
+def _download(server: KacheryTestServer, data: bytes, *, num_workers: int, segment_size: int, hash0=None):
+    hash0 = hash0 or hashlib.sha1(data).hexdigest()
+    server.addFile('sha1', hash0, data)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = LocalHashCache(algorithm='sha1')
+        hc.setDirectory(tmpdir + '/cache')
+        url = server.url() + '/get/sha1/' + hash0
+        path0 = hc.downloadFile(url=url, hash=hash0, size=len(data), num_workers=num_workers, segment_size=segment_size)
+        assert [f for _, _, files in os.walk(tmpdir + '/cache') for f in files if '.downloading.' in f] == []
+        with open(path0, 'rb') as f:
+            return f.read()
+
+@pytest.mark.parametrize('size,segment_size,num_workers', [
+    (1000, 100, 3),
+    (1001, 100, 3),
+    (99, 100, 3),
+    (100, 100, 3),
+    (250000, 7000, 8),
+    (5000, 1000, 1)
+])
+def test_segmented_download(size: int, segment_size: int, num_workers: int):
+    data = os.urandom(size)
+    with KacheryTestServer() as server:
+        assert _download(server, data, num_workers=num_workers, segment_size=segment_size) == data
+        if num_workers > 1 and size > segment_size:
+            # one request per segment
+            assert server.num_requests['get'] == (size + segment_size - 1) // segment_size
+
+def test_segmented_download_retry():
+    data = os.urandom(10000)
+    with KacheryTestServer() as server:
+        server.num_get_failures_to_simulate = 2
+        assert _download(server, data, num_workers=4, segment_size=1000) == data
+
+def test_segmented_download_without_range_support():
+    data = os.urandom(10000)
+    with KacheryTestServer() as server:
+        server.support_range = False
+        assert _download(server, data, num_workers=4, segment_size=1000) == data
+
+def test_download_from_compressing_server():
+    data = b'abcdefghij' * 10000
+    with KacheryTestServer() as server:
+        server.gzip_responses = True
+        # as a single stream, and as byte ranges
+        assert _download(server, data, num_workers=1, segment_size=1000000) == data
+        assert _download(server, data, num_workers=4, segment_size=1000) == data
+        hash0 = hashlib.sha1(data).hexdigest()
+        assert ka.load_bytes('sha1://{}'.format(hash0), start=1000, end=1010, fr=server.config(), from_remote_only=True) == data[1000:1010]
+
+def test_segmented_download_hash_mismatch():
+    data = os.urandom(10000)
+    with KacheryTestServer() as server:
+        with pytest.raises(Exception):
+            _download(server, data, num_workers=4, segment_size=1000, hash0='d' * 40)
+
+def test_load_file_segmented():
+    data = os.urandom(10000)
+    hash0 = hashlib.sha1(data).hexdigest()
+    with KacheryTestServer() as server:
+        server.addFile('sha1', hash0, data)
+        path0 = ka.load_file('sha1://{}/file.dat'.format(hash0), fr=server.config(), num_download_workers=3, download_segment_size=3000)
+        with open(path0, 'rb') as f:
+            assert f.read() == data
+        assert server.num_requests['get'] == 4
+
+def test_resume_download():
+    data = os.urandom(10000)
+    hash0 = hashlib.sha1(data).hexdigest()
+    with KacheryTestServer() as server:
+        server.addFile('sha1', hash0, data)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hc = LocalHashCache(algorithm='sha1')
+            hc.setDirectory(tmpdir + '/cache')
+            url = server.url() + '/get/sha1/' + hash0
+            # simulate an interrupted download
+            pf = hc.partialFile(hash0, size=10000, create=True)
+            pf.write(0, data[:3000])
+            pf.write(5000, data[5000:6000])
+            path0 = hc.downloadFile(url=url, hash=hash0, size=10000, num_workers=2, segment_size=1000)
+            with open(path0, 'rb') as f:
+                assert f.read() == data
+            # only the missing segments were requested
+            assert server.num_requests['get'] == 6
+            assert not pf.exists()
+            assert not os.path.exists(pf.rangesPath())
+
+            # stale partial files are removed
+            pf2 = hc.partialFile('e' * 40, size=10000, create=True)
+            pf2.write(0, data[:1000])
+            os.utime(pf2.path(), (1000, 1000))
+            report = hc.cleanup()
+            assert report['num_partial_files_removed'] == 1
+            assert not pf2.exists()
+
+def test_concurrent_downloads_of_same_hash():
+    data = os.urandom(200000)
+    hash0 = hashlib.sha1(data).hexdigest()
+    with KacheryTestServer() as server:
+        server.addFile('sha1', hash0, data)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            hc = LocalHashCache(algorithm='sha1')
+            hc.setDirectory(tmpdir + '/cache')
+            url = server.url() + '/get/sha1/' + hash0
+            dests = [tmpdir + '/dest{}.dat'.format(ii) for ii in range(8)]
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                paths = list(executor.map(lambda dest: hc.downloadFile(url=url, hash=hash0, target_path=dest, size=len(data), num_workers=2, segment_size=10000), dests))
+            assert paths == dests
+            for dest in dests:
+                with open(dest, 'rb') as f:
+                    assert f.read() == data
+            # downloaded once, into the cache
+            assert server.num_requests['get'] == 20
+            with open(hc.findFile(hash0), 'rb') as f:
+                assert f.read() == data
+            assert [f for _, _, files in os.walk(tmpdir + '/cache') for f in files if f.startswith(hash0 + '.')] == []
+
+def test_manifest_download():
+    data = os.urandom(10000)
+    hash0 = hashlib.sha1(data).hexdigest()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/data.dat'
+        with open(fname, 'wb') as f:
+            f.write(data)
+        _, manifest = compute_file_sha1_and_manifest(fname, chunk_size=2000)
+    manifest_uri = ka.store_object(manifest)
+    uri = 'sha1://{}/file.dat?manifest={}'.format(hash0, ka.get_file_hash(manifest_uri))
+    with KacheryTestServer() as server:
+        server.addFile('sha1', hash0, data)
+        # a corrupted chunk left by an earlier read
+        pf = ka.core._hash_caches['sha1'].partialFile(hash0, size=10000, create=True)
+        pf.write(2000, os.urandom(2000))
+        # and a corrupted chunk from the server
+        server.num_get_corruptions_to_simulate = 1
+        path0 = ka.load_file(uri, fr=server.config(), num_download_workers=2)
+        with open(path0, 'rb') as f:
+            assert f.read() == data
+        # five chunks, one of them fetched twice
+        assert server.num_requests['get'] == 6
+
+def test_load_files_batch():
+    datas = [os.urandom(2000 + ii) for ii in range(20)]
+    hashes = [hashlib.sha1(data).hexdigest() for data in datas]
+    with KacheryTestServer() as server:
+        for hash0, data in zip(hashes[1:], datas[1:]):
+            server.addFile('sha1', hash0, data)
+        # one of them is only in the local cache
+        uri_local = ka.store_bytes(datas[0])
+        uris = [uri_local] + ['sha1://{}/file.dat'.format(hash0) for hash0 in hashes[1:]] + ['sha1://' + 'a' * 40]
+        infos = ka.get_file_infos(uris, fr=server.config(), max_workers=4)
+        assert [info['size'] for info in infos[:-1]] == [len(data) for data in datas]
+        assert 'path' in infos[0]
+        assert infos[-1] is None
+        # one check for each uri not found locally
+        assert server.num_requests['check'] == 20
+        paths = ka.load_files(uris + uris[1:3], fr=server.config(), max_workers=4)
+        for path0, data in zip(paths[:len(datas)] + paths[len(datas) + 1:], datas + datas[1:3]):
+            with open(path0, 'rb') as f:
+                assert f.read() == data
+        assert paths[len(datas)] is None
+        # duplicates are downloaded once
+        assert server.num_requests['get'] == 19
+
+def test_remote_check_cache():
+    data = os.urandom(1000)
+    hash0 = hashlib.sha1(data).hexdigest()
+    uri = 'sha1://{}/file.dat'.format(hash0)
+    with KacheryTestServer() as server:
+        assert ka.get_file_info(uri, fr=server.config(), from_remote_only=True) is None
+        # the negative result is reused (also by other processes, through the hash database)
+        ka.reset()
+        assert ka.get_file_info(uri, fr=server.config(), from_remote_only=True) is None
+        assert server.num_requests['check'] == 1
+        # until it expires
+        server.addFile('sha1', hash0, data)
+        assert ka.get_file_info(uri, fr=server.config(), from_remote_only=True, remote_check_negative_ttl=0)['size'] == 1000
+        assert server.num_requests['check'] == 2
+        ka.reset()
+        assert ka.get_file_info(uri, fr=server.config(), from_remote_only=True)['size'] == 1000
+        assert server.num_requests['check'] == 2
+
+        # an upload replaces the negative result
+        data2 = os.urandom(1000)
+        uri2 = ka.store_bytes(data2)
+        assert ka.get_file_info(uri2, fr=server.config(), from_remote_only=True) is None
+        # (the check before uploading reuses it)
+        ka.store_bytes(data2, to=server.config())
+        assert server.num_requests['set'] == 1
+        assert ka.get_file_info(uri2, fr=server.config(), from_remote_only=True)['size'] == 1000
+        assert server.num_requests['check'] == 3
+
+def test_store_dir_upload():
+    with KacheryTestServer() as server:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(tmpdir + '/dir1/sub')
+            datas = dict()
+            for ii in range(10):
+                fname = 'dir1/file{}.dat'.format(ii) if ii % 2 == 0 else 'dir1/sub/file{}.dat'.format(ii)
+                datas[fname] = os.urandom(1000 + ii)
+                with open(tmpdir + '/' + fname, 'wb') as f:
+                    f.write(datas[fname])
+            uri = ka.store_dir(tmpdir + '/dir1', to=server.config(), num_ingest_workers=3)
+        # the files and the directory object
+        assert server.num_requests['set'] == 11
+        for fname, data in datas.items():
+            assert server.getFile('sha1', hashlib.sha1(data).hexdigest()) == data
+        dir_hash = uri.split('/')[2].split('.')[0]
+        assert server.getFile('sha1', dir_hash) is not None
+        assert len(ka.read_dir(uri, fr='')['files']) == 5
+
+def test_load_dir_remote():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(tmpdir + '/dir1/sub')
+        datas = dict()
+        for ii in range(10):
+            relpath = 'file{}.dat'.format(ii) if ii % 2 == 0 else 'sub/file{}.dat'.format(ii)
+            datas[relpath] = os.urandom(1000 + ii)
+            with open(tmpdir + '/dir1/' + relpath, 'wb') as f:
+                f.write(datas[relpath])
+        with KacheryTestServer() as server:
+            uri = ka.store_dir(tmpdir + '/dir1', to=server.config(), to_remote_only=True)
+            # one of the files is also in the local cache
+            ka.store_file(tmpdir + '/dir1/file0.dat')
+            report = ka.load_dir(uri, tmpdir + '/loaded', fr=server.config(), max_workers=4)
+            assert report['file0.dat'] == 'from_cache'
+            assert len([v for v in report.values() if v == 'downloaded']) == 9
+            for relpath, data in datas.items():
+                with open(tmpdir + '/loaded/' + relpath, 'rb') as f:
+                    assert f.read() == data
+            # the directory object was loaded once
+            assert server.num_requests['get'] == 10
+
+@pytest.mark.parametrize('support_range', [True, False])
+def test_load_dir_remote_duplicates(support_range: bool):
+    data = os.urandom(200000)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(tmpdir + '/dir1/sub')
+        relpaths = ['file{}.dat'.format(ii) if ii % 2 == 0 else 'sub/file{}.dat'.format(ii) for ii in range(8)]
+        for relpath in relpaths:
+            with open(tmpdir + '/dir1/' + relpath, 'wb') as f:
+                f.write(data)
+        with KacheryTestServer() as server:
+            server.support_range = support_range
+            uri = ka.store_dir(tmpdir + '/dir1', to=server.config(), to_remote_only=True)
+            num_gets = server.num_requests['get']
+            report = ka.load_dir(uri, tmpdir + '/loaded', fr=server.config(), from_remote_only=True, max_workers=8, num_download_workers=4, download_segment_size=10000)
+            assert [report[relpath] for relpath in relpaths] == ['downloaded'] * 8
+            for relpath in relpaths:
+                with open(tmpdir + '/loaded/' + relpath, 'rb') as f:
+                    assert f.read() == data
+            # the directory object, and the file once: in 20 segments, or as a single stream after the
+            # first range request is answered with the whole file
+            assert server.num_requests['get'] - num_gets == 1 + (20 if support_range else 2)
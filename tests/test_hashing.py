@@ -0,0 +1,56 @@
+import os
+import hashlib
+import tempfile
+from kachery._hashing import compute_file_sha1_and_manifest, compute_file_hash
+
+def test_parallel_manifest_matches_sequential():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/data.dat'
+        with open(fname, 'wb') as f:
+            f.write(os.urandom(2500003))
+        with open(fname, 'rb') as f:
+            expected_sha1 = hashlib.sha1(f.read()).hexdigest()
+        sha1_a, manifest_a = compute_file_sha1_and_manifest(fname, num_workers=1, chunk_size=100000)
+        sha1_b, manifest_b = compute_file_sha1_and_manifest(fname, num_workers=4, chunk_size=100000)
+        assert sha1_a == sha1_b == expected_sha1
+        assert manifest_a == manifest_b
+        assert len(manifest_b['chunks']) == 26
+        assert manifest_b['chunks'][-1] == dict(start=2500000, end=2500003, sha1=hashlib.sha1(open(fname, 'rb').read()[2500000:]).hexdigest())
+
+def test_compute_file_hash():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/data.dat'
+        data = os.urandom(1000001)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        for algorithm in ['sha1', 'md5']:
+            for block_size in [1000, 65536, None]:
+                assert compute_file_hash(fname, algorithm=algorithm, block_size=block_size) == getattr(hashlib, algorithm)(data).hexdigest()
+        assert compute_file_hash(tmpdir + '/does_not_exist.dat', algorithm='sha1') is None
+
+def test_stream_hasher():
+    import kachery._hashing as hashing
+    data = os.urandom(350003)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/data.dat'
+        with open(fname, 'wb') as f:
+            f.write(data)
+        old_threshold = hashing._MANIFEST_LARGE_FILE_SIZE
+        old_chunk_size = hashing.manifest_chunk_size
+        try:
+            # scale down the manifest parameters so that both chunk sizes are exercised
+            for threshold in [100000, 1000000]:
+                hashing._MANIFEST_LARGE_FILE_SIZE = threshold
+                hashing.manifest_chunk_size = lambda size: 10000 if size < threshold else 20000
+                _, expected_manifest = compute_file_sha1_and_manifest(fname, num_workers=1)
+                for size in [None, len(data)]:
+                    for num_workers in [1, 3]:
+                        hh = hashing.StreamHasher(algorithms=['sha1', 'md5'], manifest=True, size=size, num_workers=num_workers)
+                        for ii in range(0, len(data), 7777):
+                            hh.update(data[ii:ii + 7777])
+                        assert hh.hexdigests() == dict(sha1=hashlib.sha1(data).hexdigest(), md5=hashlib.md5(data).hexdigest())
+                        assert hh.manifest() == expected_manifest
+                        hh.close()
+        finally:
+            hashing._MANIFEST_LARGE_FILE_SIZE = old_threshold
+            hashing.manifest_chunk_size = old_chunk_size
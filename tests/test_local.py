@@ -1,16 +1,35 @@
+import os
+import hashlib
+import tempfile
 import kachery as ka
 import numpy as np
+from kachery._hashing import compute_file_sha1_and_manifest
 
 def test_local():
     print('Running test_local')
     _test_store_text('abctest')
     _test_store_object(dict(a=1, b=2, c=[1, 2, 3]))
     _test_store_npy(np.ones((12, 12)))
+    _test_store_bytes(os.urandom(1000))
+    _test_store_bytes(os.urandom(5000001))
+    _test_store_file(os.urandom(1000))
+    _test_store_file(os.urandom(5000001))
+    _test_store_writer([os.urandom(1000)])
+    _test_load_buffer(os.urandom(100000))
+    _test_load_buffer(b'')
+    _test_memo_cache()
+    _test_batch_local()
+    _test_store_dir()
+    _test_store_dir_incremental()
+    _test_load_dir()
+    _test_dir_cache()
+    _test_store_writer([os.urandom(3000000), b'', os.urandom(3000000)])
     print('Finished test_local')
 
 def _test_store_text(val: str):
     x = ka.store_text(val)
     assert x
+    assert x == 'sha1://{}/file.txt'.format(hashlib.sha1(val.encode('utf-8')).hexdigest())
     val2 = ka.load_text(x)
     assert val == val2
 
@@ -25,6 +44,178 @@ def _test_store_npy(val: np.ndarray):
     assert x
     val2 = ka.load_npy(x)
     assert np.array_equal(val, val2)
+    val3 = ka.load_npy(x, mmap_mode='r')
+    assert isinstance(val3, np.memmap)
+    assert np.array_equal(val, val3)
+
+def _test_store_bytes(data: bytes):
+    x = ka.store_bytes(data)
+    assert x
+    # same address as storing the data from a file
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/file.dat'
+        with open(fname, 'wb') as f:
+            f.write(data)
+        assert ka.store_file(fname) == x
+    assert ka.load_bytes(x) == data
+
+def _test_store_file(data: bytes):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = tmpdir + '/data.dat'
+        with open(fname, 'wb') as f:
+            f.write(data)
+        x = ka.store_file(fname)
+        assert x
+        assert x.startswith('sha1://{}/data.dat'.format(hashlib.sha1(data).hexdigest()))
+        if len(data) > 4000000:
+            _, manifest = compute_file_sha1_and_manifest(fname)
+            assert ka.load_object('sha1://' + x.split('?manifest=')[1]) == manifest
+        # storing it again uses the stat record
+        assert ka.store_file(fname) == x
+        with open(ka.load_file(x), 'rb') as f:
+            assert f.read() == data
+
+def _test_store_writer(parts: list):
+    data = b''.join(parts)
+    with ka.open_store_writer(basename='file.dat') as f:
+        for part in parts:
+            f.write(part)
+    # same address as storing the data from memory
+    assert f.uri() == ka.store_bytes(data)
+    assert ka.load_bytes(f.uri()) == data
+
+def _test_load_buffer(data: bytes):
+    x = ka.store_bytes(data)
+    buf = ka.load_buffer(x)
+    assert buf.readonly
+    assert buf.tobytes() == data
+
+def _test_memo_cache():
+    x = ka.store_object(dict(a=[1, 2, 3]))
+    with ka.config(memo_cache_max_bytes=10000):
+        stats0 = ka.get_memo_cache_stats()
+        obj = ka.load_object(x)
+        obj['a'].append(4)
+        # a hit returns a fresh copy, unaffected by the modification
+        assert ka.load_object(x) == dict(a=[1, 2, 3])
+        stats1 = ka.get_memo_cache_stats()
+        assert stats1['num_misses'] == stats0['num_misses'] + 1
+        assert stats1['num_hits'] == stats0['num_hits'] + 1
+        # entries larger than the bound are not kept
+        x2 = ka.store_text('a' * 20000)
+        assert ka.load_text(x2) == 'a' * 20000
+        assert ka.get_memo_cache_stats()['num_bytes'] <= 10000
+        # the bound is in bytes, not characters
+        x3 = ka.store_text('\u00e9' * 6000)
+        num_entries = ka.get_memo_cache_stats()['num_entries']
+        assert ka.load_text(x3) == '\u00e9' * 6000
+        assert ka.get_memo_cache_stats()['num_entries'] == num_entries
+    ka.reset()
+    assert ka.get_memo_cache_stats()['num_entries'] == 0
+
+def _test_batch_local():
+    x1 = ka.store_text('batch1')
+    x2 = ka.store_bytes(os.urandom(100))
+    x_missing = 'sha1://' + 'b' * 40 + '/missing.txt'
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infos = ka.get_file_infos([x1, x_missing, x2, tmpdir + '/missing.txt'], fr='')
+        assert infos[0]['size'] == 6
+        assert infos[1] is None
+        assert infos[2]['sha1'] == ka.get_file_hash(x2)
+        assert infos[3] is None
+        paths = ka.load_files([x1, x1, x_missing], dests=[None, tmpdir + '/copy.txt', None], fr='')
+        assert paths[0] == ka.load_file(x1)
+        assert paths[1] == tmpdir + '/copy.txt'
+        assert paths[2] is None
+        # errors are returned in place
+        paths = ka.load_files([x1, x2], dests=[tmpdir + '/nonexistent/copy.txt', None], fr='')
+        assert isinstance(paths[0], Exception)
+        assert paths[1] == ka.load_file(x2)
+
+def _test_store_dir():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirpath = tmpdir + '/dir1'
+        for subdir in ['', '/a', '/a/b', '/c']:
+            os.makedirs(dirpath + subdir, exist_ok=True)
+            for ii in range(5):
+                with open(dirpath + subdir + '/file{}.dat'.format(ii), 'wb') as f:
+                    f.write(os.urandom(ii * 100))
+        uri1 = ka.store_dir(dirpath, num_ingest_workers=1)
+        uri4 = ka.store_dir(dirpath, num_ingest_workers=4)
+        assert uri1 == uri4
+        dd = ka.read_dir(uri1)
+        assert sorted(dd['dirs'].keys()) == ['a', 'c']
+        assert dd['dirs']['a']['dirs']['b']['files']['file3.dat']['size'] == 300
+        assert ka.load_bytes(uri1 + '/a/b/file3.dat') == open(dirpath + '/a/b/file3.dat', 'rb').read()
+        assert ka.read_dir(dirpath) == dd
+        assert ka.read_dir(dirpath, recursive=False)['dirs'] == dict(a={}, c={})
+
+def _test_store_dir_incremental():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirpath = tmpdir + '/dir1'
+        for subdir in ['/a/b', '/c']:
+            os.makedirs(dirpath + subdir)
+            with open(dirpath + subdir + '/file.txt', 'w') as f:
+                f.write('content of ' + subdir)
+        uri = ka.store_dir(dirpath, incremental=True)
+        # same content as without the incremental mode
+        assert ka.read_dir(uri) == ka.read_dir(ka.store_dir(dirpath))
+        assert ka.read_dir(uri + '/a', recursive=False) == dict(files={}, dirs=dict(b={}))
+        assert ka.load_text(uri + '/a/b/file.txt') == 'content of /a/b'
+        # only the objects along the changed path change
+        top = ka.load_object('sha1://' + uri.split('/')[2].split('.')[0])
+        with open(dirpath + '/a/b/file.txt', 'w') as f:
+            f.write('new content')
+        uri2 = ka.store_dir(dirpath, incremental=True)
+        assert uri2 != uri
+        top2 = ka.load_object('sha1://' + uri2.split('/')[2].split('.')[0])
+        assert top2['dirs']['c'] == top['dirs']['c']
+        assert top2['dirs']['a'] != top['dirs']['a']
+        assert ka.load_text(uri2 + '/a/b/file.txt') == 'new content'
+
+def _test_load_dir():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirpath = tmpdir + '/dir1'
+        os.makedirs(dirpath + '/a/b')
+        os.makedirs(dirpath + '/empty')
+        datas = {'x.dat': os.urandom(100), 'a/y.dat': os.urandom(200), 'a/b/z.dat': os.urandom(300), 'a/b/e.txt': b''}
+        for relpath, data in datas.items():
+            with open(dirpath + '/' + relpath, 'wb') as f:
+                f.write(data)
+        for incremental in [False, True]:
+            uri = ka.store_dir(dirpath, incremental=incremental)
+            dest = tmpdir + '/loaded{}'.format(int(incremental))
+            report = ka.load_dir(uri, dest, fr='', max_workers=3)
+            assert report == {'x.dat': 'from_cache', 'a/y.dat': 'from_cache', 'a/b/z.dat': 'from_cache', 'a/b/e.txt': 'created'}
+            assert os.path.isdir(dest + '/empty')
+            for relpath, data in datas.items():
+                with open(dest + '/' + relpath, 'rb') as f:
+                    assert f.read() == data
+            # completing a partially loaded directory
+            os.unlink(dest + '/a/y.dat')
+            with open(dest + '/a/b/z.dat', 'wb') as f:
+                f.write(os.urandom(300))
+            report = ka.load_dir(uri, dest, fr='')
+            assert report == {'x.dat': 'existing', 'a/y.dat': 'from_cache', 'a/b/z.dat': 'from_cache', 'a/b/e.txt': 'existing'}
+            with open(dest + '/a/b/z.dat', 'rb') as f:
+                assert f.read() == datas['a/b/z.dat']
+
+def _test_dir_cache():
+    dd = dict(files=dict([('f{}.dat'.format(ii), dict(size=ii, sha1='{:040x}'.format(ii))) for ii in range(100)]), dirs=dict(sub=dict(files={'g.dat': dict(size=1, sha1='e' * 40)}, dirs={})))
+    uri = 'sha1dir://{}.test'.format(ka.get_file_hash(ka.store_object(dd)))
+    ka.reset()
+    for ii in range(100):
+        assert ka.get_file_info(uri + '/f{}.dat'.format(ii), hash_only=True)['sha1'] == '{:040x}'.format(ii)
+    assert ka.get_file_info(uri + '/sub/g.dat', hash_only=True)['sha1'] == 'e' * 40
+    assert ka.get_file_info(uri + '/sub/missing.dat', hash_only=True, fr='') is None
+    # the directory object was parsed once
+    stats = ka.core._dir_cache.stats()
+    assert stats['num_misses'] == 1
+    assert stats['num_entries'] == 1
+    # modifying the result of read_dir does not affect the cache
+    ka.read_dir(uri)['files'].clear()
+    assert len(ka.read_dir(uri)['files']) == 100
+    assert ka.read_dir(uri + '/sub', recursive=False) == dd['dirs']['sub']
 
 if __name__ == '__main__':
     test_local()
\ No newline at end of file
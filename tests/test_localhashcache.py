@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+import tempfile
+import time
+from kachery.localhashcache import LocalHashCache
+from kachery.filelock import FileLock
+from kachery._hashing import compute_file_sha1_and_manifest
+
+def test_hash_database():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = _make_hash_cache(tmpdir)
+        fname = _write_random_file(tmpdir + '/data.dat', 200000)
+        hash0 = _sha1_of_file(fname)
+        assert hc.computeFileHash(fname) == hash0
+        assert hc.computeFileHash(fname, _cache_only=True) == hash0
+        assert hc.lookupFileHashes([fname, tmpdir + '/does_not_exist.dat']) == [hash0, None]
+
+        # modifying the file invalidates the record
+        _write_random_file(fname, 200001)
+        assert hc.computeFileHash(fname, _cache_only=True) is None
+
+        fname2 = _write_random_file(tmpdir + '/data2.dat', 1000)
+        hc.reportFileHashes([fname2], ['f' * 40])
+        assert hc.lookupFileHashes([fname2]) == ['f' * 40]
+
+def test_combined_hash_records():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc_sha1 = _make_hash_cache(tmpdir)
+        hc_md5 = LocalHashCache(algorithm='md5')
+        hc_md5.setDirectory(tmpdir + '/cache')
+        fname = _write_random_file(tmpdir + '/data.dat', 200000)
+        with open(fname, 'rb') as f:
+            data = f.read()
+        assert hc_sha1.computeFileHash(fname, also_compute=['md5']) == hashlib.sha1(data).hexdigest()
+        # the md5 was computed in the same read and is answered from the record
+        assert hc_md5.computeFileHash(fname, _cache_only=True) == hashlib.md5(data).hexdigest()
+        assert hc_sha1.computeFileHashes(fname, ['md5', 'sha1'], _cache_only=True) == dict(md5=hashlib.md5(data).hexdigest(), sha1=hashlib.sha1(data).hexdigest())
+
+def test_find_file_from_hash_database():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = _make_hash_cache(tmpdir)
+        fname = _write_random_file(tmpdir + '/data.dat', 200000)
+        hash0 = hc.computeFileHash(fname)
+        hc.computeFileHash(fname, _known_hash=hash0)
+        assert [x['path'] for x in hc.hashDatabase().findStatObjects(hash0, algorithm='sha1')] == [fname]
+        assert hc.findFile(hash0) == fname
+        assert not any([f.endswith('.lock') or f.endswith('.hints.json') for _, _, files in os.walk(tmpdir) for f in files])
+
+        # stale entries are dropped on lookup
+        _write_random_file(fname, 200000)
+        assert hc.findFile(hash0) is None
+        assert hc.hashDatabase().findStatObjects(hash0, algorithm='sha1') == []
+
+def test_migrate_legacy_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = _write_random_file(tmpdir + '/data.dat', 200000)
+        fname2 = _write_random_file(tmpdir + '/data2.dat', 200000)
+        os.makedirs(tmpdir + '/cache/12/34/56')
+        with open(tmpdir + '/cache/12/34/56/123456.record.json', 'w') as f:
+            json.dump(dict(stat=_legacy_stat_object(fname), sha1='a' * 40), f)
+        with open(tmpdir + '/cache/12/34/56/bbbbbb.hints.json', 'w') as f:
+            json.dump(dict(files=[dict(stat=_legacy_stat_object(fname2), sha1='b' * 40)]), f)
+        hc = _make_hash_cache(tmpdir)
+        assert hc.computeFileHash(fname) == 'a' * 40
+        assert hc.findFile('b' * 40) == fname2
+
+def test_ingest_file_parallel_manifest(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = _make_hash_cache(tmpdir)
+        fname = _write_random_file(tmpdir + '/data.dat', 25000003)
+        sha1, manifest = compute_file_sha1_and_manifest(fname, num_workers=1)
+        path_a, hashes_a, manifest_a = hc.ingestFile(fname, compute_manifest=True, num_hash_workers=1)
+        os.unlink(path_a)
+        # the chunks are hashed from the streamed buffers, not by a second (positional) pass over the file
+        def no_pread(*args):
+            raise Exception('Unexpected positional read')
+        monkeypatch.setattr(os, 'pread', no_pread)
+        path_b, hashes_b, manifest_b = hc.ingestFile(fname, also_compute=['md5'], compute_manifest=True, num_hash_workers=4)
+        assert hashes_a['sha1'] == hashes_b['sha1'] == sha1
+        assert manifest_a == manifest_b == manifest
+        assert len(manifest_b['chunks']) == 3
+        assert _sha1_of_file(path_b) == sha1
+
+def _legacy_stat_object(fname: str) -> dict:
+    stat0 = os.stat(fname)
+    return dict(path=fname, size=stat0.st_size, ino=stat0.st_ino, mtime=stat0.st_mtime, ctime=stat0.st_ctime)
+
+def test_cleanup():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = _make_hash_cache(tmpdir)
+        hashes = []
+        for ii in range(4):
+            fname = _write_random_file(tmpdir + '/data{}.dat'.format(ii), 1000)
+            path0, hash0 = hc.copyFileToCache(fname)
+            os.utime(path0, (1000 + ii, 1000 + ii))
+            hashes.append(hash0)
+        hc.pinHash(hashes[0])
+        tmp_path = hc._get_path(hashes[1]) + '.downloading.abcdef'
+        _write_random_file(tmp_path, 10)
+        os.utime(tmp_path, (1000, 1000))
+
+        report = hc.cleanup(max_bytes=2000, min_age=0)
+        assert report['num_temp_files_removed'] == 1
+        assert report['num_files_evicted'] == 2
+        assert report['num_bytes'] == 2000
+        # the oldest files are evicted, except for the pinned one
+        assert [hc.findFile(h) is not None for h in hashes] == [True, False, False, True]
+
+        # recently accessed files are protected
+        report = hc.cleanup(max_bytes=0)
+        assert report['num_files_evicted'] == 0
+
+def test_accesses_are_flushed_by_timer(monkeypatch):
+    import kachery.hashdatabase as hashdatabase
+    monkeypatch.setattr(hashdatabase, '_ACCESS_FLUSH_INTERVAL', 0.2)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = _make_hash_cache(tmpdir)
+        _, hash0 = hc.copyFileToCache(_write_random_file(tmpdir + '/data.dat', 1000))
+        assert hc.findFile(hash0) is not None
+        # as seen by another process, once the process that found the file has gone quiet
+        db2 = hashdatabase.HashDatabase(hc.hashDatabase().path())
+        time.sleep(1)
+        assert hash0 in db2.getAccesses(algorithm='sha1')
+
+def test_remote_checks_are_buffered():
+    import kachery.hashdatabase as hashdatabase
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = hashdatabase.HashDatabase(tmpdir + '/db.sqlite')
+        db2 = hashdatabase.HashDatabase(tmpdir + '/db.sqlite')
+        def lookup(db0, hash0):
+            return db0.lookupRemoteCheck(url='http://x', channel='c', algorithm='sha1', hash=hash0, max_age_found=100, max_age_not_found=100)
+        for ii in range(10):
+            db.recordRemoteCheck(url='http://x', channel='c', algorithm='sha1', hash=str(ii) * 40, found=(ii % 2 == 0), size=ii)
+        # answered from the buffer, and written in a single batch
+        assert lookup(db, '3' * 40) == (False, 3)
+        assert lookup(db2, '3' * 40) is None
+        db.flush()
+        assert [lookup(db2, str(ii) * 40) for ii in range(10)] == [(ii % 2 == 0, ii) for ii in range(10)]
+        # an older result does not replace a more recent one
+        db.recordRemoteCheck(url='http://x', channel='c', algorithm='sha1', hash='1' * 40, found=True, size=1)
+        db2.recordRemoteCheck(url='http://x', channel='c', algorithm='sha1', hash='1' * 40, found=True, size=100)
+        db2.flush()
+        db.flush()
+        assert lookup(db2, '1' * 40) == (True, 100)
+
+def test_cleanup_lock_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = _make_hash_cache(tmpdir)
+        path0, hash0 = hc.copyFileToCache(_write_random_file(tmpdir + '/data.dat', 1000))
+        held_path = path0 + '.partial.lock'
+        orphan_path = path0 + '.download.lock'
+        with FileLock(held_path, exclusive=True):
+            _write_random_file(orphan_path, 0)
+            os.utime(held_path, (1000, 1000))
+            os.utime(orphan_path, (1000, 1000))
+            report = hc.cleanup()
+            # a held lock file is left alone, however old
+            assert report['num_temp_files_removed'] == 1
+            assert os.path.exists(held_path)
+            assert not os.path.exists(orphan_path)
+
+def test_partial_file():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hc = _make_hash_cache(tmpdir)
+        data = os.urandom(3000)
+        hash0 = hashlib.sha1(data).hexdigest()
+        assert hc.writeFileRange(hash0, size=3000, start=1000, data=data[1000:2000]) is None
+        assert hc.readFileRange(hash0, size=3000, start=1200, end=1800) == data[1200:1800]
+        assert hc.readFileRange(hash0, size=3000, start=500, end=1500) is None
+        assert hc.partialFile(hash0, size=3000).ranges() == [(1000, 2000)]
+        assert hc.writeFileRange(hash0, size=3000, start=0, data=data[0:1500]) is None
+        path0 = hc.writeFileRange(hash0, size=3000, start=2000, data=data[2000:])
+        assert path0 == hc.findFile(hash0)
+        assert not hc.partialFile(hash0, size=3000).exists()
+        assert not os.path.exists(hc.partialFile(hash0, size=3000).lockPath())
+
+        # a partial file whose content does not match is discarded
+        hash1 = 'c' * 40
+        assert hc.writeFileRange(hash1, size=10, start=0, data=b'0123456789') is None
+        assert hc.findFile(hash1) is None
+        assert not os.path.exists(hc.partialFile(hash1, size=10).rangesPath())
+
+        # partial files are evicted together with their sidecar
+        assert hc.writeFileRange(hash1, size=100000, start=0, data=os.urandom(5000)) is None
+        report = hc.cleanup(max_bytes=0, min_age=0)
+        assert report['num_files_evicted'] == 2
+        assert not os.path.exists(hc.partialFile(hash1, size=100000).rangesPath())
+
+def _make_hash_cache(tmpdir: str) -> LocalHashCache:
+    hc = LocalHashCache(algorithm='sha1')
+    hc.setDirectory(tmpdir + '/cache')
+    return hc
+
+def _write_random_file(fname: str, size: int) -> str:
+    with open(fname, 'wb') as f:
+        f.write(os.urandom(size))
+    return fname
+
+def _sha1_of_file(fname: str) -> str:
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
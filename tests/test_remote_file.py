@@ -0,0 +1,56 @@
+import os
+import hashlib
+import kachery as ka
+from _kachery_server import KacheryTestServer
+
+def test_remote_file_read_ahead():
+    data = os.urandom(25500)
+    hash0 = hashlib.sha1(data).hexdigest()
+    with KacheryTestServer() as server:
+        server.addFile('sha1', hash0, data)
+        uri = 'sha1://{}/file.dat'.format(hash0)
+        with ka.open_file(uri, fr=server.config(), block_size=1000, read_ahead=3, max_cached_blocks=2) as f:
+            chunks = []
+            while True:
+                buf = f.read(700)
+                if not buf:
+                    break
+                chunks.append(buf)
+            assert b''.join(chunks) == data
+            # re-reading a recent block is served from memory
+            f.seek(25000)
+            assert f.read(100) == data[25000:25100]
+            stats = f.stats()
+        assert stats['num_cache_hits'] > 0
+        # all blocks except (at least) the first were prefetched
+        assert stats['num_prefetch_hits'] + stats['num_prefetch_stalls'] + stats['num_blocks_loaded'] == 26
+        assert stats['num_blocks_loaded'] < 26
+
+        with ka.open_file(uri, fr=server.config(), block_size=1000) as f:
+            f.seek(1990)
+            assert f.read(2020) == data[1990:4010]
+            assert f.read() == data[4010:]
+
+def test_remote_file_partial_store():
+    data = os.urandom(5000)
+    hash0 = hashlib.sha1(data).hexdigest()
+    with KacheryTestServer() as server:
+        server.addFile('sha1', hash0, data)
+        uri = 'sha1://{}/file.dat'.format(hash0)
+        with ka.open_file(uri, fr=server.config(), block_size=1000) as f:
+            assert f.read(2500) == data[:2500]
+        num_gets = server.num_requests['get']
+        # the ranges are reused with a different block size
+        with ka.open_file(uri, fr=server.config(), block_size=1500) as f:
+            assert f.read(3000) == data[:3000]
+        assert server.num_requests['get'] == num_gets
+        assert ka.get_file_info(uri, fr='') is None
+        # completing the file promotes it to a regular cache entry
+        with ka.open_file(uri, fr=server.config(), block_size=1000) as f:
+            f.seek(3000)
+            assert f.read(2000) == data[3000:]
+        path0 = ka.load_file(uri, fr='')
+        assert path0 is not None
+        assert not os.path.exists(path0 + '.partial')
+        with open(path0, 'rb') as f:
+            assert f.read() == data
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import kachery as ka
+from kachery._transfer import transfer_file, TRANSFER_STRATEGIES
+
+def test_transfer_strategies():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = os.urandom(300000)
+        src = tmpdir + '/src.dat'
+        with open(src, 'wb') as f:
+            f.write(data)
+        for strategy in TRANSFER_STRATEGIES:
+            dst = tmpdir + '/dst_{}.dat'.format(strategy)
+            try:
+                used = transfer_file(src, dst, strategy=strategy)
+            except OSError:
+                # e.g., reflink on a file system without copy-on-write support
+                assert strategy in ['reflink', 'copy_file_range']
+                # no truncated file is left behind
+                assert not os.path.exists(dst)
+                continue
+            assert used == strategy or strategy == 'auto'
+            with open(dst, 'rb') as f:
+                assert f.read() == data
+        # auto never hard links
+        assert os.stat(tmpdir + '/dst_auto.dat').st_ino != os.stat(src).st_ino
+
+def test_load_file_with_transfer_strategy():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = os.urandom(300000)
+        src = tmpdir + '/src.dat'
+        with open(src, 'wb') as f:
+            f.write(data)
+        for strategy in ['copy', 'auto']:
+            with ka.config(transfer_strategy=strategy):
+                uri = ka.store_file(src)
+                dest = tmpdir + '/dest_{}.dat'.format(strategy)
+                assert ka.load_file(uri, dest=dest) == dest
+                with open(dest, 'rb') as f:
+                    assert f.read() == data
+
+def test_failed_transfer_removes_dst(monkeypatch):
+    import kachery._transfer as _transfer
+    def failing_copy_file_range(*args):
+        raise OSError('copy_file_range is not supported')
+    monkeypatch.setattr(os, 'copy_file_range', failing_copy_file_range, raising=False)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = tmpdir + '/src.dat'
+        with open(src, 'wb') as f:
+            f.write(os.urandom(1000))
+        dst = tmpdir + '/dst.dat'
+        try:
+            _transfer._transfer_file(src, dst, strategy='copy_file_range')
+            assert False, 'expected the transfer to fail'
+        except OSError:
+            pass
+        assert not os.path.exists(dst)
@@ -0,0 +1,32 @@
+import os
+import hashlib
+import threading
+import kachery as ka
+from kachery import _transport
+from _kachery_server import KacheryTestServer
+
+def test_connections_are_reused():
+    data = os.urandom(1000)
+    hash0 = hashlib.sha1(data).hexdigest()
+    with KacheryTestServer() as server:
+        server.addFile('sha1', hash0, data)
+        for _ in range(10):
+            ka.reset()
+            # without reusing recorded checks, so that every iteration makes a request
+            assert ka.get_file_info('sha1://' + hash0, fr=server.config(), from_remote_only=True, remote_check_ttl=0)['size'] == 1000
+            assert ka.load_bytes('sha1://' + hash0, start=0, end=100, fr=server.config(), from_remote_only=True, remote_check_ttl=0) == data[:100]
+        assert server.num_requests['check'] >= 10
+        assert server.num_connections == 1
+
+def test_sessions_are_per_thread():
+    sessions = []
+    def target():
+        sessions.append(_transport.get_session())
+    threads = [threading.Thread(target=target) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set([id(s) for s in sessions])) == 3
+    # all of them use the same connection pools
+    assert len(set([id(s.get_adapter('http://localhost')) for s in sessions])) == 1